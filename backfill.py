@@ -0,0 +1,199 @@
+"""
+Bulk backfill and replay for the covid table.
+
+The APIs only return the latest day, so covid.db normally fills up one day at
+a time. This script loads a history dump instead, or replays the rows already
+stored, recomputing the derived jj, firstDose and dailyVaccinations columns
+with the same logic updateDB.py uses.
+
+The input is read in chunks, derived with NumPy and bulk inserted with one
+executemany per chunk, each in its own transaction, so memory use stays flat
+however big the dump is.
+Rows in the dump replace any stored rows in the same date range.
+
+Supported inputs, oldest day first:
+    .csv    header row with relDate, firstDose, secondDose, totalAdministered, pf, modern, az
+    .jsonl  one object per line with those attributes, or {"attributes": {...}}
+    .json   an ArcGIS query response ({"features": [...]}), loaded in one go
+
+Usage:
+    python backfill.py history.csv
+    python backfill.py --replay
+"""
+import argparse, datetime, itertools, json, logging, os, sys, time
+from collections import OrderedDict
+import numpy as np
+
+# Shared helpers live alongside the bot in src/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+import dataset
+from ingest import RAW_FIELDS, derive_figures_batch
+from render_cache import bump_data_version, migrate as migrate_data_version
+import storage
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+def read_csv_chunks(path, chunk_size):
+    """ Parse a CSV dump straight into arrays with NumPy's parser, a chunk at a time """
+    with open(path) as f:
+        header = f.readline().strip().split(',')
+        columns = [header.index(field) for field in RAW_FIELDS]
+        while 1:
+            lines = list(itertools.islice(f, chunk_size))
+            if not lines:
+                return
+            values = np.loadtxt(lines, delimiter=',', usecols=columns, dtype=np.float64, ndmin=2)
+            yield dict((field, values[:, i].astype(np.int64)) for i, field in enumerate(RAW_FIELDS))
+
+
+def read_json_lines(path):
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                record = json.loads(line)
+                yield record.get('attributes', record)
+
+
+def read_arcgis_json(path):
+    with open(path) as f:
+        data = json.load(f)
+    for feature in data['features']:
+        yield feature['attributes']
+
+
+def read_stored_chunks(db, chunk_size, after=''):
+    """ Turn stored rows after a day back into API attributes, paging through the day index
+
+    Databases from before J&J was tracked have no jj column, their first and
+    second doses are read as they are.
+    """
+    jj = 'jj' if db['covid'].has_column('jj') else '0 AS jj'
+    sql = 'SELECT day, firstDose, secondDose, totalVaccinations, pfizer, moderna, astraZeneca, %s ' \
+          'FROM covid WHERE day > ? ORDER BY day LIMIT ?' % jj
+    last_day = after
+    while 1:
+        rows = db.executable.exec_driver_sql(sql, (last_day, chunk_size)).fetchall()
+        if not rows:
+            return
+        days, first, second, total, pfizer, moderna, az, jj = zip(*rows)
+        jj = np.array(jj, dtype=np.int64)
+        yield {'relDate': np.array(days, dtype='datetime64[D]').astype('datetime64[ms]').astype(np.int64),
+               'firstDose': np.array(first, dtype=np.int64) + jj,
+               'secondDose': np.array(second, dtype=np.int64) - jj,
+               'totalAdministered': np.array(total, dtype=np.int64),
+               'pf': np.array(pfizer, dtype=np.int64),
+               'modern': np.array(moderna, dtype=np.int64),
+               'az': np.array(az, dtype=np.int64)}
+        last_day = days[-1]
+
+
+def chunked(records, chunk_size):
+    """ Group records into dicts of int64 arrays keyed by RAW_FIELDS """
+    chunk = dict((field, []) for field in RAW_FIELDS)
+    count = 0
+    for record in records:
+        for field in RAW_FIELDS:
+            chunk[field].append(int(float(record[field])))
+        count += 1
+        if count == chunk_size:
+            yield dict((field, np.array(values, dtype=np.int64)) for field, values in chunk.items())
+            chunk = dict((field, []) for field in RAW_FIELDS)
+            count = 0
+    if count:
+        yield dict((field, np.array(values, dtype=np.int64)) for field, values in chunk.items())
+
+
+def last_row(columns):
+    """ The final row of a batch of derived columns, as a plain dict """
+    return OrderedDict((name, values[-1].item() if hasattr(values[-1], 'item') else values[-1])
+                       for name, values in columns.items())
+
+
+def write_chunk(db, columns):
+    """ Replace the chunk's date range with the derived rows in one transaction
+
+    Rows go to the driver as tuples in a single executemany, which skips
+    building a dict per row and is several times faster than insert_many.
+    """
+    names = list(columns)
+    rows = list(zip(*[values.tolist() if hasattr(values, 'tolist') else values for values in columns.values()]))
+    sql = 'INSERT INTO covid (%s) VALUES (%s)' % (', '.join('"%s"' % name for name in names),
+                                                  ', '.join('?' for _ in names))
+    with db as tx:
+        tx['covid'].delete(day={'between': [columns['day'][0], columns['day'][-1]]})
+        tx.executable.exec_driver_sql(sql, rows)
+
+
+def backfill(db, chunks):
+    """ Derive and store chunks of raw attributes. Returns the number of rows written """
+    covid_table = db['covid']
+    previous = None
+    written = 0
+    for raw in chunks:
+        if written == 0:
+            first_day = raw['relDate'][0] // 1000
+            first_date = datetime.datetime.utcfromtimestamp(int(first_day)).date()
+            previous = storage.row_for_date(covid_table, first_date - datetime.timedelta(days=1))
+            if previous is None:
+                logger.info("No stored row before %s, counting J&J from zero", first_date)
+            elif previous.get('jj') is None:
+                # Stored before J&J was tracked
+                previous['jj'] = 0
+
+        columns = derive_figures_batch(raw, previous)
+        previous = last_row(columns)
+        if written == 0:
+            # Make sure every column exists before the first transaction
+            for key, value in previous.items():
+                if not covid_table.has_column(key):
+                    covid_table.create_column_by_example(key, value)
+        write_chunk(db, columns)
+        written += len(columns['day'])
+        logger.info("Wrote %s rows, up to %s", written, previous['date'])
+
+    if written:
+        bump_data_version(db, previous['date'])
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill or replay the covid table")
+    parser.add_argument('dump', nargs='?', help="CSV, JSON lines or ArcGIS JSON history file")
+    parser.add_argument('--replay', action='store_true', help="recompute derived columns from stored rows")
+    parser.add_argument('--db', default="sqlite:///covid.db")
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    args = parser.parse_args()
+    if bool(args.dump) == args.replay:
+        parser.error("give either a dump file or --replay")
+
+    db = dataset.connect(args.db)
+    storage.migrate(db)
+    migrate_data_version(db)
+    started = time.time()
+
+    if args.replay:
+        # The first stored day has nothing before it, so it is kept as the base
+        # the rest are derived from. Each page is fully read before it is
+        # rewritten and the next page starts after it.
+        first = db['covid'].find_one(order_by='day')
+        if first is None:
+            logger.info("The covid table is empty, there is nothing to replay")
+            return
+        written = backfill(db, read_stored_chunks(db, args.chunk_size, after=first['day']))
+    elif args.dump.endswith('.csv'):
+        written = backfill(db, read_csv_chunks(args.dump, args.chunk_size))
+    elif args.dump.endswith('.jsonl'):
+        written = backfill(db, chunked(read_json_lines(args.dump), args.chunk_size))
+    else:
+        written = backfill(db, chunked(read_arcgis_json(args.dump), args.chunk_size))
+
+    logger.info("Backfilled %s rows in %.1fs", written, time.time() - started)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+"""
+Load test the command handlers and the daily fan-out against synthetic data.
+
+Builds covid.db in a temporary directory with --days of vaccine figures,
+--weeks of supply figures and --users subscribers, then imports vaccineBot
+against it and drives the handlers with fake Update and CallbackContext
+objects. For every command it reports p50/p99 latency and the number of
+database statements per call. Handlers served from the render cache are
+also timed cold, with the cache invalidated before every call, which is
+what the first request after new data pays. Finally it times a full
+deliver_update() fan-out to every subscriber through a fake bot.
+
+Results are written as JSON so a later run can be compared against them:
+
+    python benchmarks/bench_handlers.py --days 2000 --users 100000 --save before.json
+    python benchmarks/bench_handlers.py --days 2000 --users 100000 --compare before.json
+"""
+import argparse, datetime, json, math, os, platform, statistics, sys, tempfile, threading, time
+from collections import OrderedDict
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+sys.path.insert(0, os.path.join(SRC, '..'))
+import numpy as np
+import dataset
+
+FIRST_DAY = datetime.date(2020, 12, 29)
+ADMIN_ID = 1
+
+CONFIG = """[Credentials]
+telegram_token = 123456:bench
+admin_conversation_id = %s
+
+[Delivery]
+workers = %s
+global_rate = %s
+per_chat_rate = 1
+max_retries = 0
+"""
+
+
+def synthetic_raw(days, chunk_size=10000):
+    """ Chunks of API style cumulative figures, one row per day """
+    rng = np.random.default_rng(1)
+    start = np.datetime64(FIRST_DAY, 'ms').astype(np.int64)
+    totals = dict((field, 0) for field in ('pf', 'modern', 'az', 'jj', 'secondDose'))
+    for offset in range(0, days, chunk_size):
+        n = min(chunk_size, days - offset)
+        daily = dict((field, np.cumsum(rng.integers(low, high, n)) + totals[field])
+                     for field, low, high in (('pf', 20000, 40000), ('modern', 2000, 6000),
+                                              ('az', 1000, 8000), ('jj', 0, 3000),
+                                              ('secondDose', 5000, 20000)))
+        totals = dict((field, int(values[-1])) for field, values in daily.items())
+        total = daily['pf'] + daily['modern'] + daily['az'] + daily['jj']
+        yield {'relDate': start + (np.arange(offset, offset + n, dtype=np.int64) * 86400000),
+               'firstDose': total - daily['secondDose'],
+               'secondDose': daily['secondDose'],
+               'totalAdministered': total,
+               'pf': daily['pf'],
+               'modern': daily['modern'],
+               'az': daily['az']}
+
+
+def build_database(db, days, weeks, users):
+    import backfill, ingest, render_cache, storage, subscribers
+    storage.migrate(db)
+    render_cache.migrate(db)
+    backfill.backfill(db, synthetic_raw(days))
+
+    supply = []
+    for week in range(weeks):
+        day = FIRST_DAY + datetime.timedelta(days=7 * week)
+        supply.append(OrderedDict(date=storage.format_date(day), total=200000 * (week + 1),
+                                  pfizer=120000 * (week + 1), moderna=30000 * (week + 1),
+                                  astraZeneca=40000 * (week + 1), jj=10000 * (week + 1),
+                                  day=storage.day_key(day)))
+    ingest.store_supply(db, supply)
+
+    subscribers.migrate(db)
+    with db as tx:
+        # Every fifth user has unsubscribed
+        tx.executable.exec_driver_sql(
+            'INSERT INTO users (user, subscribed, active, bucket) VALUES (?, ?, ?, ?)',
+            [(str(1000000 + i), str(i % 5 != 0), i % 5 != 0, subscribers.bucket_for(1000000 + i))
+             for i in range(users)])
+
+
+class FakeBot:
+    """ Records messages instead of sending them. send_ms stands in for the API round trip """
+
+    def __init__(self, send_ms=0):
+        self.delay = send_ms / 1000
+        self.sent = 0
+        self.lock = threading.Lock()
+
+    def send_message(self, chat_id, text=None, parse_mode=None, **kwargs):
+        if self.delay:
+            time.sleep(self.delay)
+        with self.lock:
+            self.sent += 1
+
+
+class FakeMessage:
+    def __init__(self, bot, chat_id, text):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.text = text
+
+    def reply_text(self, text, *args, **kwargs):
+        self.bot.send_message(self.chat_id, text)
+
+    reply_markdown = reply_html = reply_text
+
+
+class FakeUpdate:
+    def __init__(self, bot, chat_id, text):
+        self.message = FakeMessage(bot, chat_id, text)
+        self.effective_chat = self.message
+
+
+class FakeJobQueue:
+    def jobs(self):
+        return ()
+
+    def get_jobs_by_name(self, name):
+        return ()
+
+    def run_repeating(self, *args, **kwargs):
+        pass
+
+    run_once = run_repeating
+
+
+class FakeContext:
+    def __init__(self, bot):
+        self.bot = bot
+        self.bot_data = {}
+        self.job_queue = FakeJobQueue()
+
+
+def percentile(timings, fraction):
+    """ Nearest rank percentile of sorted timings, never below the median """
+    return timings[min(len(timings) - 1, math.ceil(len(timings) * fraction) - 1)]
+
+
+def measure(call, iterations, counter, before=None):
+    """ Latency of each call in milliseconds and the statements it ran """
+    timings = []
+    counter.reset()
+    for i in range(iterations):
+        if before is not None:
+            before()
+        started = time.perf_counter()
+        call(i)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return OrderedDict(p50_ms=statistics.median(timings), p99_ms=percentile(timings, 0.99),
+                       queries=counter.count / iterations, samples=iterations)
+
+
+def run_commands(bot_module, iterations, cold_iterations, counter):
+    bot = FakeBot()
+    context = FakeContext(bot)
+
+    def command(handler, text, chat_id=None):
+        return lambda i: handler(FakeUpdate(bot, chat_id or 2000000 + i, text), context)
+
+    commands = OrderedDict([
+        ('/start', command(bot_module.start, '/start')),
+        ('/latest', command(bot_module.today, '/latest')),
+        ('/week', command(bot_module.week, '/week')),
+        ('/overall', command(bot_module.overall, '/overall')),
+        ('/supply', command(bot_module.supply, '/supply')),
+        ('/daily', command(bot_module.set_respond, '/daily')),
+        ('/unsubscribe', command(bot_module.unset_response, '/unsubscribe')),
+    ])
+    cached = ('/latest', '/week', '/overall')
+
+    results = OrderedDict()
+    bot_module.render_cache.get('date')
+    for name, call in commands.items():
+        results[name] = measure(call, iterations, counter)
+        if name in cached:
+            results[name + ' (cold)'] = measure(call, cold_iterations, counter,
+                                                before=bot_module.render_cache.invalidate)
+    return results
+
+
+def run_fanout(bot_module, send_ms, counter):
+    bot = FakeBot(send_ms)
+    bot_module.tenants.active().last_delivered_date = None
+    bot_module.DB[bot_module.preferences.DELIVERIES_TABLE].delete()
+    bot_module.DB.query('DELETE FROM outbox')
+    counter.reset()
+    started = time.perf_counter()
+    bot_module.deliver_update(FakeContext(bot))
+    elapsed = time.perf_counter() - started
+    return OrderedDict(messages=bot.sent, seconds=elapsed, per_second=bot.sent / elapsed if elapsed else 0,
+                       queries=counter.count)
+
+
+def print_results(results, baseline=None):
+    print("%-20s %10s %10s %8s" % ('command', 'p50 ms', 'p99 ms', 'queries'))
+    for name, result in results['commands'].items():
+        line = "%-20s %10.3f %10.3f %8.1f" % (name, result['p50_ms'], result['p99_ms'], result['queries'])
+        before = (baseline or {}).get('commands', {}).get(name)
+        if before:
+            line += "   p50 %+.0f%%  queries %+.1f" % (
+                (result['p50_ms'] / before['p50_ms'] - 1) * 100 if before['p50_ms'] else 0,
+                result['queries'] - before['queries'])
+        print(line)
+    fanout = results['fanout']
+    line = "fan-out %s messages in %.2fs, %.0f/s, %s queries" % (
+        '{:,}'.format(fanout['messages']), fanout['seconds'], fanout['per_second'], fanout['queries'])
+    if baseline:
+        before = baseline['fanout']
+        line += "   was %.0f/s" % before['per_second']
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--days', type=int, default=1000, help="rows in the covid table")
+    parser.add_argument('--weeks', type=int, default=150, help="rows in the supply table")
+    parser.add_argument('--users', type=int, default=10000, help="rows in the users table, 80%% subscribed")
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--cold-iterations', type=int, default=100,
+                        help="calls per cold cache measurement, a p99 needs about 100")
+    parser.add_argument('--workers', type=int, default=8, help="delivery workers for the fan-out")
+    parser.add_argument('--global-rate', type=float, default=1000000,
+                        help="fan-out rate limit, Telegram's real limit is 30")
+    parser.add_argument('--send-ms', type=float, default=0, help="simulated send_message latency")
+    parser.add_argument('--save', help="write results to this JSON file")
+    parser.add_argument('--compare', help="JSON file from an earlier --save to compare against")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    save = os.path.abspath(args.save) if args.save else None
+
+    # vaccineBot reads config.cfg and covid.db from the working directory
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        with open('config.cfg', 'w') as f:
+            f.write(CONFIG % (ADMIN_ID, args.workers, args.global_rate))
+
+        started = time.perf_counter()
+        db = dataset.connect('sqlite:///covid.db')
+        build_database(db, args.days, args.weeks, args.users)
+        db.close()
+        print("Built %s days, %s weeks and %s users in %.1fs" % (
+            '{:,}'.format(args.days), args.weeks, '{:,}'.format(args.users), time.perf_counter() - started))
+
+        import logging
+        import vaccineBot, storage
+        logging.getLogger().setLevel(logging.WARNING)
+        counter = storage.QueryCounter(vaccineBot.DB)
+
+        results = OrderedDict(
+            params=OrderedDict((key, value) for key, value in vars(args).items() if key not in ('save', 'compare')),
+            python=platform.python_version(),
+            timestamp=datetime.datetime.now().isoformat(timespec='seconds'),
+            commands=run_commands(vaccineBot, args.iterations, args.cold_iterations, counter),
+            fanout=run_fanout(vaccineBot, args.send_ms, counter))
+        vaccineBot.DB.close()
+        os.chdir(cwd)
+
+    print_results(results, baseline)
+    if save:
+        with open(save, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Saved results to %s" % save)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Compare persistence flush latency as the subscriber count grows.
+
+Populates bot_data with one key per user, the way /daily does, and an empty
+user_data and chat_data entry per user, the way PTB does for anyone who
+messages the bot. Then times a series of subscribe/unsubscribe updates
+followed by the update_bot_data call the dispatcher makes after every
+update, and the dispatcher's update_persistence() that runs after every job,
+with user_data and chat_data stored and with them turned off as the bot runs.
+
+Usage:
+    python benchmarks/bench_persistence.py --users 100000 --updates 50
+"""
+import argparse, os, statistics, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from telegram import Bot
+from telegram.ext import Dispatcher, PicklePersistence
+from persistence import CHAT_DATA, USER_DATA, SQLitePersistence
+
+# Never used to connect, Bot() only checks its format
+TOKEN = '123456:AAGFi2oLMPIky2BcsuCTQGbQS5vhCY6nFsQ'
+
+
+def populate(persistence, users):
+    bot_data = persistence.get_bot_data()
+    bot_data.update(dict((str(1000000 + i), 'True') for i in range(users)))
+    persistence.update_bot_data(bot_data)
+    keyed = [(1000000 + i, {}) for i in range(users)]
+    if isinstance(persistence, SQLitePersistence):
+        # The rows PTB wrote before the bot stopped storing them
+        persistence.write(USER_DATA, keyed)
+        persistence.write(CHAT_DATA, keyed)
+    else:
+        persistence.get_user_data()
+        persistence.get_chat_data()
+        persistence.user_data.update(keyed)
+        persistence.chat_data.update(keyed)
+    persistence.flush()
+
+
+def time_updates(persistence, users, updates):
+    """ Latency of each subscribe + update_bot_data, in milliseconds """
+    bot_data = persistence.get_bot_data()
+    timings = []
+    for i in range(updates):
+        started = time.perf_counter()
+        bot_data.update({str(1000000 + (i * 7919) % users): 'False' if i % 2 else 'True'})
+        persistence.update_bot_data(bot_data)
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def time_startup(make_persistence):
+    started = time.perf_counter()
+    persistence = make_persistence()
+    persistence.get_bot_data()
+    return (time.perf_counter() - started) * 1000
+
+
+def time_jobs(make_persistence, runs):
+    """ Dispatcher start, which loads persistence, and the update_persistence() after each job, in ms """
+    started = time.perf_counter()
+    dispatcher = Dispatcher(Bot(TOKEN), None, persistence=make_persistence())
+    startup = (time.perf_counter() - started) * 1000
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        dispatcher.update_persistence()
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings, startup
+
+
+def report(name, timings, startup):
+    timings = sorted(timings)
+    print("%-16s p50 %8.2fms  p99 %8.2fms  max %8.2fms  startup %8.2fms" % (
+        name, statistics.median(timings), timings[int(len(timings) * 0.99) - 1], timings[-1], startup))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--updates', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pickle_file = os.path.join(tmp, 'conv_persistence')
+        sqlite_file = os.path.join(tmp, 'bot_persistence.db')
+
+        # on_flush=False is how main() configured PicklePersistence, it
+        # rewrites the file on every update_bot_data call
+        make_pickle = lambda **kwargs: PicklePersistence(filename=pickle_file, **kwargs)
+        make_sqlite = lambda **kwargs: SQLitePersistence(filename=sqlite_file, **kwargs)
+
+        print("Flush latency with %s users over %s updates" % ('{:,}'.format(args.users), args.updates))
+        for name, make in (('pickle', make_pickle), ('sqlite', make_sqlite)):
+            persistence = make()
+            populate(persistence, args.users)
+            timings = time_updates(persistence, args.users, args.updates)
+            report(name, timings, time_startup(make))
+
+            # Jobs flush persistence too, which is where user_data and chat_data cost
+            print("%s, after each job run" % name)
+            for label, kwargs in (('all data', {}),
+                                  ('bot_data only', dict(store_user_data=False, store_chat_data=False))):
+                report('  ' + label, *time_jobs(lambda: make(**kwargs), args.updates))
+
+
+if __name__ == '__main__':
+    main()
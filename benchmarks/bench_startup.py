@@ -0,0 +1,129 @@
+"""
+Track the bot's cold start time as covid.db and the persistence file grow.
+
+For each --users size, builds covid.db and a persistence file in a
+temporary directory. The persistence file has one bot_data key per user, and
+the empty user_data and chat_data entries PTB leaves for everyone who has
+messaged the bot. Then runs `vaccineBot.py --check` in a fresh interpreter
+--runs times. It reports the
+median of each startup phase the bot prints, the time until it was ready
+and the wall time of the whole process, interpreter startup included. The
+first run after building isn't counted, since it also runs the one off
+migrations.
+
+Results are written as JSON so a later run can be compared against them:
+
+    python benchmarks/bench_startup.py --users 1000,100000 --save before.json
+    python benchmarks/bench_startup.py --users 1000,100000 --compare before.json
+"""
+import argparse, datetime, json, os, platform, re, statistics, subprocess, sys, tempfile, time
+from collections import OrderedDict
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS)
+from bench_handlers import ADMIN_ID, CONFIG, SRC, build_database
+from bench_persistence import populate
+import dataset
+
+PERSISTENCE = """
+[Persistence]
+backend = %s
+filename = bot_persistence.db
+"""
+
+PHASE_LINE = re.compile(r'^(\w+)\s+([\d.]+)ms$')
+
+
+def build(users, days, weeks, backend):
+    """ covid.db and a persistence file for users subscribers, in the working directory """
+    from telegram.ext import PicklePersistence
+    from persistence import SQLitePersistence
+    with open('config.cfg', 'w') as f:
+        f.write(CONFIG % (ADMIN_ID, 8, 30) + PERSISTENCE % backend)
+    db = dataset.connect('sqlite:///covid.db')
+    build_database(db, days, weeks, users)
+    db.close()
+    if backend == 'pickle':
+        populate(PicklePersistence(filename='conv_persistence'), users)
+    else:
+        populate(SQLitePersistence(filename='bot_persistence.db'), users)
+
+
+def run_check():
+    """ Phase timings in milliseconds from one `vaccineBot.py --check`, plus the process wall time """
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, os.path.join(SRC, 'vaccineBot.py'), '--check'],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    wall = (time.perf_counter() - started) * 1000
+    if result.returncode != 0:
+        raise RuntimeError("vaccineBot.py --check failed\n" + result.stdout + result.stderr)
+    phases = OrderedDict()
+    for line in result.stdout.splitlines():
+        match = PHASE_LINE.match(line.strip())
+        if match:
+            phases[match.group(1)] = float(match.group(2))
+    phases['wall'] = wall
+    return phases
+
+
+def measure(users, args):
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            build(users, args.days, args.weeks, args.backend)
+            sizes = OrderedDict((name, os.path.getsize(name)) for name in sorted(os.listdir('.'))
+                                if name.startswith(('covid.db', 'bot_persistence.db', 'conv_persistence')))
+            run_check()
+            runs = [run_check() for _ in range(args.runs)]
+        finally:
+            os.chdir(cwd)
+    medians = OrderedDict((phase, statistics.median(run[phase] for run in runs)) for phase in runs[0])
+    return OrderedDict(users=users, bytes=sum(sizes.values()), phases_ms=medians)
+
+
+def print_results(results, baseline=None):
+    phases = list(results['sizes'][0]['phases_ms'])
+    print("%10s %10s " % ('users', 'MB') + " ".join("%10s" % phase for phase in phases))
+    previous = dict((size['users'], size) for size in (baseline or {}).get('sizes', []))
+    for size in results['sizes']:
+        print("%10s %10.1f " % ('{:,}'.format(size['users']), size['bytes'] / 1e6)
+              + " ".join("%10.1f" % size['phases_ms'][phase] for phase in phases))
+        before = previous.get(size['users'])
+        if before is not None:
+            print("%10s %10s " % ('before', '')
+                  + " ".join("%10s" % ('%.1f' % before['phases_ms'][phase] if phase in before['phases_ms'] else '-')
+                             for phase in phases))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', default='1000,10000,100000',
+                        help="comma separated subscriber counts, one run of the bot per size")
+    parser.add_argument('--days', type=int, default=1000, help="rows in the covid table")
+    parser.add_argument('--weeks', type=int, default=150, help="rows in the supply table")
+    parser.add_argument('--backend', choices=('sqlite', 'pickle'), default='sqlite')
+    parser.add_argument('--runs', type=int, default=5, help="timed starts per size")
+    parser.add_argument('--save', help="write results to this JSON file")
+    parser.add_argument('--compare', help="JSON file from an earlier --save to compare against")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = OrderedDict(
+        params=OrderedDict((key, value) for key, value in vars(args).items() if key not in ('save', 'compare')),
+        python=platform.python_version(),
+        timestamp=datetime.datetime.now().isoformat(timespec='seconds'),
+        sizes=[measure(int(users), args) for users in args.users.split(',')])
+    print_results(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Drive the webhook server with a local fake Telegram.
+
+Starts a WebhookServer on localhost with a dispatcher whose handlers reply
+through a fake bot, so no requests leave the machine. Then it POSTs --updates
+/latest commands from --chats chats, with up to --concurrency requests open
+at once, and reports updates per second and the processing latency.
+--handler-ms adds a sleep to each handler to stand in for the Telegram API
+round trip a real reply makes.
+
+Usage:
+    python benchmarks/bench_webhook.py --updates 10000 --workers 16 --handler-ms 20
+"""
+import argparse, asyncio, os, statistics, sys, threading, time
+from queue import Queue
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import aiohttp
+from telegram import Bot, User
+from telegram.ext import CommandHandler, Dispatcher
+from webhook import WebhookServer
+
+PORT = 18443
+
+
+class FakeBot(Bot):
+    """ Bot that records replies instead of calling the Telegram API """
+
+    def __init__(self, delay):
+        super().__init__('123456:fake-token')
+        # CommandHandler asks for the bot's username, don't let it call getMe
+        self._bot = User(123456, 'Bench', True, username='bench_bot')
+        self.delay = delay
+        self.sent = 0
+        self.lock = threading.Lock()
+
+    def send_message(self, chat_id, text, *args, **kwargs):
+        if self.delay:
+            time.sleep(self.delay)
+        with self.lock:
+            self.sent += 1
+
+
+def make_update(update_id, chat_id):
+    chat = {'id': chat_id, 'type': 'private', 'first_name': 'Bench'}
+    return {'update_id': update_id,
+            'message': {'message_id': update_id, 'date': int(time.time()), 'chat': chat,
+                        'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Bench'},
+                        'text': '/latest', 'entities': [{'type': 'bot_command', 'offset': 0, 'length': 7}]}}
+
+
+async def post_updates(updates, chats, concurrency):
+    url = 'http://127.0.0.1:%s/bench' % PORT
+    slots = asyncio.Semaphore(concurrency)
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        async def post(i):
+            async with slots:
+                async with session.post(url, json=make_update(i, 1000 + i % chats)) as response:
+                    response.raise_for_status()
+        await asyncio.gather(*(post(i) for i in range(updates)))
+
+
+async def run(args, server, bot, latencies):
+    await server.start()
+    started = time.perf_counter()
+    await post_updates(args.updates, args.chats, args.concurrency)
+    accepted = time.perf_counter() - started
+    await server.drain()
+    elapsed = time.perf_counter() - started
+    print("%s updates from %s chats, %s workers, %sms per reply" % (
+        '{:,}'.format(args.updates), args.chats, args.workers, args.handler_ms))
+    print("accepted in %6.2fs  %8.0f updates/s" % (accepted, args.updates / accepted))
+    print("processed in %4.2fs  %8.0f updates/s  (%s replies, %s failed)" % (
+        elapsed, args.updates / elapsed, bot.sent, server.failed))
+    latencies.sort()
+    print("handler p50 %.2fms  p99 %.2fms" % (
+        statistics.median(latencies), latencies[int(len(latencies) * 0.99) - 1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--updates', type=int, default=10000)
+    parser.add_argument('--chats', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--handler-ms', type=float, default=0)
+    args = parser.parse_args()
+
+    bot = FakeBot(args.handler_ms / 1000)
+    dispatcher = Dispatcher(bot, Queue(), use_context=True)
+    latencies = []
+
+    def latest(update, context):
+        started = time.perf_counter()
+        context.bot.send_message(update.effective_chat.id, 'figures')
+        latencies.append((time.perf_counter() - started) * 1000)
+
+    dispatcher.add_handler(CommandHandler('latest', latest))
+    server = WebhookServer(dispatcher, port=PORT, url_path='bench', workers=args.workers,
+                           max_in_flight=args.concurrency)
+    asyncio.run(run(args, server, bot, latencies))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+Time series analytics over the covid table.
+
+load_series() reads the whole covid history in one query into a Series, which
+keeps one NumPy column per field. Rolling windows, per vaccine daily deltas
+and projections are then computed over the full series at once rather than
+with a query per day.
+"""
+import datetime, logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Cumulative counters stored in the covid table
+CUMULATIVE_FIELDS = ('firstDose', 'secondDose', 'totalVaccinations', 'pfizer', 'moderna', 'astraZeneca', 'jj')
+FIELDS = CUMULATIVE_FIELDS + ('dailyVaccinations',)
+VACCINES = ('pfizer', 'astraZeneca', 'moderna', 'jj')
+
+
+def _number(value):
+    """ Stored values can be None or '-' for days with no figure """
+    if isinstance(value, (int, float)):
+        return value
+    return np.nan
+
+
+class Series:
+    """ Columnar view of the covid table, oldest day first """
+
+    def __init__(self, rows):
+        self.dates = [row['date'] for row in rows]
+        self.days = np.array([row['day'] for row in rows], dtype='datetime64[D]')
+        # Day numbers make calendar windows a searchsorted away
+        self.day_numbers = self.days.astype(np.int64)
+        self.columns = {}
+        for field in FIELDS:
+            self.columns[field] = np.array([_number(row.get(field)) for row in rows], dtype=np.float64)
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __getitem__(self, field):
+        return self.columns[field]
+
+    def row(self, index):
+        """ A single day as a dict shaped like a covid table row """
+        row = {'date': self.dates[index], 'day': str(self.days[index])}
+        for field in FIELDS:
+            value = self.columns[field][index]
+            row[field] = 0 if np.isnan(value) else int(value)
+        return row
+
+    def index_of(self, day):
+        """ Index of a datetime.date in the series, or None """
+        key = np.datetime64(day, 'D').astype(np.int64)
+        index = np.searchsorted(self.day_numbers, key)
+        if index < len(self) and self.day_numbers[index] == key:
+            return int(index)
+        return None
+
+    def latest_pair(self, gap_days=1):
+        """ The newest row with a row gap_days before it, and that earlier row """
+        previous = np.searchsorted(self.day_numbers, self.day_numbers - gap_days)
+        found = (previous < len(self)) & (self.day_numbers[np.minimum(previous, len(self) - 1)] == self.day_numbers - gap_days)
+        candidates = np.nonzero(found)[0]
+        if len(candidates) == 0:
+            raise LookupError("No pair of rows %s days apart" % gap_days)
+        latest = candidates[-1]
+        return self.row(latest), self.row(previous[latest])
+
+    def daily_deltas(self, field):
+        """ Day on day change of a cumulative field. The first day is NaN """
+        values = self.columns[field]
+        deltas = np.empty_like(values)
+        deltas[0] = np.nan
+        deltas[1:] = np.diff(values)
+        return deltas
+
+    def rolling_sum(self, values, window):
+        """ Sum of values over the trailing window calendar days for every row
+
+        Days missing from the table count as zero, so a gap in the data never
+        stretches a window past window days.
+        """
+        totals = np.concatenate(([0.0], np.cumsum(np.nan_to_num(values))))
+        starts = np.searchsorted(self.day_numbers, self.day_numbers - window + 1)
+        return totals[np.arange(1, len(self) + 1)] - totals[starts]
+
+    def rolling_average(self, values, window):
+        return self.rolling_sum(values, window) / window
+
+    def vaccine_deltas(self):
+        """ Daily doses given per vaccine, as a dict of arrays """
+        return dict((vaccine, self.daily_deltas(vaccine)) for vaccine in VACCINES)
+
+    def days_to_target(self, field, target, window=7):
+        """ Days until a cumulative field reaches target at the trailing average rate
+
+        Returns an array with a projection for every row. NaN where the rate
+        is zero or negative, 0 once the target has been passed.
+        """
+        rate = self.rolling_average(self.daily_deltas(field), window)
+        remaining = target - self.columns[field]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            days = np.where(rate > 0, np.ceil(remaining / rate), np.nan)
+        return np.where(remaining <= 0, 0, days)
+
+    def projected_date(self, field, target, window=7):
+        """ Calendar date the latest row projects field to reach target, or None """
+        days = self.days_to_target(field, target, window)[-1]
+        if np.isnan(days):
+            return None
+        return self.days[-1].astype(datetime.date) + datetime.timedelta(days=int(days))
+
+
+def load_series(table):
+    """ Read the full history of a dated table in a single query """
+    rows = list(table.find(order_by='day'))
+    logger.debug("Loaded %s rows into a series", len(rows))
+    return Series(rows)
@@ -0,0 +1,110 @@
+"""
+Precomputed answers for inline queries and history browsing.
+
+build_index() renders the daily update message for every day in the covid
+history in one pass over a Series, alongside the current /week, /overall
+and /supply messages. The bot rebuilds the index when new data arrives, so
+inline queries (@bot 14/05/2021, @bot week) and the /history buttons are
+answered with dict lookups and never touch the database.
+"""
+import datetime, logging
+import numpy as np
+import storage, templates
+
+logger = logging.getLogger(__name__)
+
+# Inline keywords, the message they send and its markup
+KEYWORDS = (
+    ('latest', "Latest daily figures", templates.HTML),
+    ('week', "Rolling 7 day stats", templates.MARKDOWN),
+    ('overall', "Overall rollout stats", templates.MARKDOWN),
+    ('supply', "Latest supply figures", templates.MARKDOWN),
+)
+
+# Telegram shows at most 50 inline results
+MAX_RESULTS = 50
+
+
+def parse_query_date(text):
+    """ ISO day key for a D/MM/YYYY or YYYY-MM-DD query, None if it isn't a date """
+    try:
+        if '/' in text:
+            return storage.day_key(text)
+        return datetime.date.fromisoformat(text).isoformat()
+    except ValueError:
+        return None
+
+
+class AnswerIndex:
+    """ Rendered daily update for every day, plus the current command messages """
+
+    def __init__(self, days, dates, pages, payloads):
+        self.days = days
+        self.dates = dict(zip(days, dates))
+        self.pages = pages
+        self.positions = dict((day, i) for i, day in enumerate(days))
+        self.payloads = payloads
+
+    def __len__(self):
+        return len(self.days)
+
+    @property
+    def latest_day(self):
+        return self.days[-1] if self.days else None
+
+    def page(self, day):
+        """ Daily update HTML for an ISO day, or None """
+        return self.pages.get(day)
+
+    def neighbours(self, day):
+        """ The days before and after day that have pages, either can be None """
+        i = self.positions[day]
+        older = self.days[i - 1] if i > 0 else None
+        newer = self.days[i + 1] if i + 1 < len(self.days) else None
+        return older, newer
+
+    def search(self, query):
+        """ (id, title, text, markup) answers for an inline query """
+        query = query.strip().lower()
+        day = parse_query_date(query) if query else None
+        if day is not None:
+            if day not in self.pages:
+                return []
+            return [('day:' + day, "Figures for " + self.dates[day], self.pages[day], templates.HTML)]
+
+        results = []
+        for keyword, title, markup in KEYWORDS:
+            text = self.payloads.get(keyword)
+            if text is not None and keyword.startswith(query):
+                results.append((keyword, title, text, markup))
+        if not results and query:
+            # Part of a date, like 05/2021, lists the matching days newest first
+            for day in reversed(self.days):
+                if query in self.dates[day] or day.startswith(query):
+                    results.append(('day:' + day, "Figures for " + self.dates[day], self.pages[day], templates.HTML))
+                    if len(results) == MAX_RESULTS:
+                        break
+        return results
+
+
+def build_index(series, payloads, population=templates.POPULATION, population_12_plus=templates.POPULATION_12_PLUS):
+    """ Render every day of a Series with the daily update layout """
+    daily = series['dailyVaccinations']
+    seven_day = series.rolling_sum(daily, 7)
+    previous = np.searchsorted(series.day_numbers, series.day_numbers - 1)
+
+    days, dates, pages = [], [], {}
+    for i in range(len(series)):
+        j = previous[i]
+        if j >= len(series) or series.day_numbers[j] != series.day_numbers[i] - 1:
+            # The update compares with the day before, skip days without one
+            continue
+        today = series.row(i)
+        running_total = int(seven_day[i])
+        stats = templates.build_stats(today, series.row(j), running_total, round(running_total/7),
+                                      population=population, population_12_plus=population_12_plus)
+        days.append(today['day'])
+        dates.append(today['date'])
+        pages[today['day']] = templates.render('latest', stats)
+    logger.info("Built answer index for %s days", len(days))
+    return AnswerIndex(days, dates, pages, payloads)
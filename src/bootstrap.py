@@ -0,0 +1,128 @@
+"""
+Startup phases, lazy initialisation and health checks for the bot process.
+
+Startup times each phase of bringing the bot up, logs it and records it in
+the metrics registry as bot_startup_seconds, so a slow restart shows which
+phase it spent its time in. The process counts as ready once the caches are
+warm, and `vaccineBot.py --check` prints the phases and exits.
+
+Lazy stands in for an object that's expensive to create, like the database
+connection and its migrations. Nothing is created until the first attribute
+or item is looked up, so importing the bot module, --help and tools that
+only need part of it don't pay for it.
+
+check_health() runs named checks and reports each one. The metrics server
+serves it at /healthz, so a process supervisor can restart a bot that has
+stopped working as well as one that has exited.
+"""
+import logging, threading, time
+from collections import OrderedDict
+from contextlib import contextmanager
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Startup:
+    """ Times the startup phases of one process """
+
+    def __init__(self, started=None, clock=time.perf_counter):
+        self.clock = clock
+        self.started = started if started is not None else clock()
+        self.phases = OrderedDict()
+        self.ready_after = None
+        self.ready = threading.Event()
+
+    def record(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0) + seconds
+        metrics.REGISTRY.observe('bot_startup_seconds', seconds, phase=name)
+        logger.info("Startup phase %s took %.1fms", name, seconds * 1000)
+
+    @contextmanager
+    def phase(self, name):
+        started = self.clock()
+        try:
+            yield
+        finally:
+            self.record(name, self.clock() - started)
+
+    def mark_ready(self):
+        self.ready_after = self.clock() - self.started
+        self.ready.set()
+        logger.info("Ready %.1fms after the process started", self.ready_after * 1000)
+
+    def summary(self):
+        """ One "phase 12.3ms" line per phase, then the time until ready """
+        lines = ["%-12s %8.1fms" % (name, seconds * 1000) for name, seconds in self.phases.items()]
+        if self.ready_after is not None:
+            lines.append("%-12s %8.1fms" % ('ready', self.ready_after * 1000))
+        return "\n".join(lines)
+
+
+class Proxy:
+    """ Passes attribute and item lookups, iteration, len() and with blocks on to _target() """
+
+    def _target(self):
+        raise NotImplementedError
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+    def __getitem__(self, key):
+        return self._target()[key]
+
+    def __iter__(self):
+        return iter(self._target())
+
+    def __len__(self):
+        return len(self._target())
+
+    def __enter__(self):
+        return self._target().__enter__()
+
+    def __exit__(self, *exc):
+        return self._target().__exit__(*exc)
+
+
+class Lazy(Proxy):
+    """ Proxy for an object that's only created, once, when it's first used
+
+    get() returns the object factory() creates.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._value = None
+        self._lock = threading.Lock()
+
+    @property
+    def created(self):
+        return self._value is not None
+
+    def get(self):
+        value = self._value
+        if value is None:
+            with self._lock:
+                if self._value is None:
+                    self._value = self._factory()
+                value = self._value
+        return value
+
+    _target = get
+
+    def __repr__(self):
+        return "Lazy(%r)" % (self._value if self.created else self._factory)
+
+
+def check_health(checks):
+    """ Run each named check, returns (healthy, {name: result})
+
+    A check passes if it returns a true value and doesn't raise.
+    """
+    results = OrderedDict()
+    for name, check in checks.items():
+        try:
+            results[name] = 'ok' if check() else 'failing'
+        except Exception as e:
+            results[name] = 'error: %s' % e
+    return all(result == 'ok' for result in results.values()), results
@@ -0,0 +1,183 @@
+"""
+Trend charts for the /chart command.
+
+Charts are drawn with matplotlib in a pool of worker processes, so a slow
+render never holds up the dispatcher and the GIL isn't shared with the bot.
+The bot only sends the worker plain NumPy arrays. chart_data() builds them
+from a Series in the bot process, and render_png() draws them in the worker.
+
+ChartCache keeps the newest PNG for each chart type, keyed by the date of
+the data it was drawn from. After the first upload it also keeps the
+Telegram file_id, so later requests for the same chart resend the uploaded
+photo without rendering or uploading it again.
+
+matplotlib is optional. Without it AVAILABLE is False and /chart says so.
+It's only imported by the worker processes, so the bot starts without it.
+"""
+import importlib.util, io, logging, threading
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import numpy as np
+from templates import POPULATION_12_PLUS
+
+logger = logging.getLogger(__name__)
+
+AVAILABLE = importlib.util.find_spec('matplotlib') is not None
+
+DAILY = 'daily'
+COVERAGE = 'coverage'
+MIX = 'mix'
+SUPPLY = 'supply'
+
+# Chart type and the description shown by /chart
+CHARTS = {
+    DAILY: "Daily doses with the 7 day average",
+    COVERAGE: "Share of the 12+ population vaccinated",
+    MIX: "Daily doses by vaccine, 7 day average",
+    SUPPLY: "Doses delivered against doses given",
+}
+
+
+def chart_data(kind, series, supply_series=None, population_12_plus=POPULATION_12_PLUS):
+    """ The arrays render_png() needs for a chart, small enough to pickle cheaply """
+    data = {'days': series.days}
+    if kind == DAILY:
+        daily = series['dailyVaccinations']
+        data['daily'] = daily
+        data['average'] = series.rolling_average(daily, 7)
+    elif kind == COVERAGE:
+        for field in ('firstDose', 'secondDose', 'jj'):
+            data[field] = series[field] / population_12_plus * 100
+    elif kind == MIX:
+        for vaccine, deltas in series.vaccine_deltas().items():
+            data[vaccine] = series.rolling_average(deltas, 7)
+    elif kind == SUPPLY:
+        data['administered'] = series['totalVaccinations']
+        data['supply_days'] = supply_series.days
+        data['supplied'] = supply_series.totals
+    else:
+        raise ValueError("Unknown chart %s" % kind)
+    return data
+
+
+def render_png(kind, data, title):
+    """ Draw a chart and return the PNG bytes. Runs in a worker process """
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot as plt
+    from matplotlib.ticker import FuncFormatter
+
+    figure, axes = plt.subplots(figsize=(8, 4.5), dpi=100)
+    days = data['days']
+    if kind == DAILY:
+        axes.bar(days, np.nan_to_num(data['daily']), width=1, color='#9ecae1', label="Daily doses")
+        axes.plot(days, data['average'], color='#08519c', label="7 day average")
+    elif kind == COVERAGE:
+        axes.plot(days, data['firstDose'], label="First dose (of two)")
+        axes.plot(days, data['secondDose'], label="Fully vaccinated")
+        axes.plot(days, data['jj'], label="Single dose vaccine")
+        axes.yaxis.set_major_formatter(FuncFormatter(lambda value, _: '%d%%' % value))
+    elif kind == MIX:
+        labels = {'pfizer': "Pfizer", 'astraZeneca': "AstraZeneca", 'moderna': "Moderna", 'jj': "J&J"}
+        axes.stackplot(days, *[np.nan_to_num(data[vaccine]) for vaccine in labels],
+                       labels=list(labels.values()))
+    elif kind == SUPPLY:
+        axes.step(data['supply_days'], data['supplied'], where='post', label="Delivered")
+        axes.plot(days, data['administered'], label="Administered")
+    if kind != COVERAGE:
+        axes.yaxis.set_major_formatter(FuncFormatter(lambda value, _: '{:,.0f}'.format(value)))
+
+    axes.set_title(title)
+    axes.legend(loc='upper left')
+    axes.grid(alpha=0.3)
+    figure.autofmt_xdate()
+    figure.tight_layout()
+    png = io.BytesIO()
+    figure.savefig(png, format='png')
+    plt.close(figure)
+    return png.getvalue()
+
+
+class SupplySeries:
+    """ Delivery dates and cumulative totals from the supply table """
+
+    def __init__(self, rows):
+        self.days = np.array([row['day'] for row in rows], dtype='datetime64[D]')
+        self.totals = np.array([row['total'] for row in rows], dtype=np.float64)
+
+
+def load_supply_series(table):
+    return SupplySeries(list(table.find(order_by='day')))
+
+
+class _Entry:
+    def __init__(self, date, future):
+        self.date = date
+        self.future = future
+        self.file_id = None
+
+
+def _import_matplotlib():
+    """ Worker initializer, so the first /chart doesn't wait for matplotlib to import """
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot
+
+
+class ChartCache:
+    """ Renders charts in a process pool and remembers the result for each data date """
+
+    def __init__(self, workers=2, executor=None):
+        if executor is None:
+            # Workers are forked up front by start(), before the bot starts its
+            # own threads, so they don't inherit locks held by other threads
+            fork = 'fork' in multiprocessing.get_all_start_methods()
+            executor = ProcessPoolExecutor(max_workers=workers,
+                                           mp_context=multiprocessing.get_context('fork' if fork else None),
+                                           initializer=_import_matplotlib)
+        self.executor = executor
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        """ Fork the workers. They import matplotlib in the background, start() doesn't wait for them """
+        self.executor.submit(int)
+
+    def sharing(self):
+        """ A separate cache, for another dataset, that renders in this cache's worker processes """
+        return ChartCache(executor=self.executor)
+
+    def file_id(self, kind, date):
+        """ Telegram file_id of an uploaded chart for this data date, or None """
+        with self.lock:
+            entry = self.entries.get(kind)
+            if entry is not None and entry.date == date:
+                return entry.file_id
+        return None
+
+    def render(self, kind, date, load_data):
+        """ Future for the PNG of a chart, rendering it unless this date is cached or in progress
+
+        load_data() is only called on a miss and should return chart_data().
+        """
+        with self.lock:
+            entry = self.entries.get(kind)
+            if entry is not None and entry.date == date:
+                # Re-render if the last attempt failed
+                if not entry.future.done() or entry.future.exception() is None:
+                    return entry.future
+        # Data is loaded outside the lock, two misses at once just render twice
+        title = "%s, %s" % (CHARTS[kind], date)
+        future = self.executor.submit(render_png, kind, load_data(), title)
+        with self.lock:
+            self.entries[kind] = _Entry(date, future)
+        return future
+
+    def remember_upload(self, kind, date, file_id):
+        with self.lock:
+            entry = self.entries.get(kind)
+            if entry is not None and entry.date == date:
+                entry.file_id = file_id
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
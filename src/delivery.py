@@ -0,0 +1,201 @@
+"""
+Delivery engine for fanning messages out to many Telegram chats.
+
+Sends are spread over a bounded pool of worker threads and throttled by
+token buckets tuned to Telegram's limits (roughly 30 messages a second
+globally and 1 message a second to any single chat). Flood errors are
+honoured via their retry_after value, transient network errors are retried
+with exponential backoff, and chats that have blocked the bot are reported
+back to the caller rather than retried. deliver_each() can also report the
+result of every send as it happens, for callers that track progress.
+
+The engine only needs an object with a python-telegram-bot style
+send_message(chat_id, text=..., parse_mode=...) method, so a local fake Bot
+can be passed in place of context.bot.
+"""
+import logging, threading, time
+from telegram.error import BadRequest, ChatMigrated, NetworkError, RetryAfter, Unauthorized
+
+logger = logging.getLogger(__name__)
+
+# Telegram's documented broadcast limits
+GLOBAL_RATE = 30
+PER_CHAT_RATE = 1
+
+# Result of a single send. BLOCKED means the chat will never accept messages
+# again, because the user blocked the bot, deleted their account or the chat
+# no longer exists.
+SENT = 'sent'
+FAILED = 'failed'
+BLOCKED = 'blocked'
+
+
+def is_blocked(error):
+    """ Whether a permanent send error means the chat is gone for good """
+    if isinstance(error, Unauthorized):
+        return True
+    return isinstance(error, BadRequest) and 'chat not found' in str(error).lower()
+
+
+class TokenBucket:
+    """ Thread safe token bucket. acquire() blocks until a token is available """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated = now
+
+    def pause(self, seconds):
+        """ Stop handing out tokens for the given number of seconds (used for 429s) """
+        with self.lock:
+            now = self.clock()
+            self.paused_until = max(self.paused_until, now + seconds)
+            self.tokens = 0.0
+            self.updated = self.paused_until
+
+    def acquire(self):
+        while 1:
+            with self.lock:
+                now = self.clock()
+                if now >= self.paused_until:
+                    self._refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    wait = self.paused_until - now
+            self.sleep(wait)
+
+
+class DeliveryReport:
+    """ Counters for a single fan-out run """
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.blocked = []
+        self.lock = threading.Lock()
+
+    def add(self, sent=0, failed=0, retried=0, blocked=None):
+        with self.lock:
+            self.sent += sent
+            self.failed += failed
+            self.retried += retried
+            if blocked is not None:
+                self.blocked.append(blocked)
+
+    def __repr__(self):
+        return "DeliveryReport(sent=%d, failed=%d, retried=%d)" % (self.sent, self.failed, self.retried)
+
+
+class DeliveryEngine:
+    """ Send one message to many chats through a rate limited worker pool """
+
+    def __init__(self, bot, workers=8, global_rate=GLOBAL_RATE, per_chat_rate=PER_CHAT_RATE,
+                 max_retries=3, backoff=1.0, clock=time.monotonic, sleep=time.sleep):
+        self.bot = bot
+        self.workers = max(1, int(workers))
+        self.per_chat_rate = per_chat_rate
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.clock = clock
+        self.sleep = sleep
+        self.global_bucket = TokenBucket(global_rate, clock=clock, sleep=sleep)
+        self.chat_buckets = {}
+        self.chat_buckets_lock = threading.Lock()
+
+    def _chat_bucket(self, chat_id):
+        with self.chat_buckets_lock:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = TokenBucket(self.per_chat_rate, capacity=1, clock=self.clock, sleep=self.sleep)
+                self.chat_buckets[chat_id] = bucket
+            return bucket
+
+    def send_one(self, chat_id, text, report, parse_mode='HTML'):
+        """ Send to a single chat, retrying flood and network errors. Returns SENT, FAILED or BLOCKED """
+        attempt = 0
+        while 1:
+            self._chat_bucket(chat_id).acquire()
+            self.global_bucket.acquire()
+            try:
+                self.bot.send_message(chat_id, parse_mode=parse_mode, text=text)
+                report.add(sent=1)
+                return SENT
+            except RetryAfter as e:
+                logger.warning("Flood limit hit sending to %s, pausing %ss", chat_id, e.retry_after)
+                self.global_bucket.pause(e.retry_after)
+            except (Unauthorized, ChatMigrated, BadRequest) as e:
+                logger.info("Permanent failure sending to %s - %s", chat_id, e)
+                if is_blocked(e):
+                    report.add(failed=1, blocked=chat_id)
+                    return BLOCKED
+                report.add(failed=1)
+                return FAILED
+            except NetworkError as e:
+                logger.info("Network error sending to %s - %s", chat_id, e)
+                self.sleep(self.backoff * (2 ** attempt))
+            except Exception:
+                logger.exception("Got exception when sending update to %s", chat_id)
+                report.add(failed=1)
+                return FAILED
+
+            attempt += 1
+            if attempt > self.max_retries:
+                report.add(failed=1)
+                return FAILED
+            report.add(retried=1)
+
+    def deliver(self, chat_ids, text, parse_mode='HTML'):
+        """ Send text to every chat id in chat_ids, returns a DeliveryReport
+
+        chat_ids may be any iterable, including a lazy database cursor. It is
+        consumed by the workers as they go, so it is never fully materialised.
+        """
+        return self.deliver_each(((chat_id, text) for chat_id in chat_ids), parse_mode=parse_mode)
+
+    def deliver_each(self, messages, parse_mode='HTML', on_result=None):
+        """ Send each (chat_id, text) pair in messages, returns a DeliveryReport
+
+        Like deliver(), but every chat can get its own text. on_result, if
+        given, is called with (chat_id, result) after each send, from the
+        worker thread that sent it.
+        """
+        report = DeliveryReport()
+        message_iter = iter(messages)
+        iter_lock = threading.Lock()
+
+        def worker():
+            while 1:
+                with iter_lock:
+                    try:
+                        chat_id, text = next(message_iter)
+                    except StopIteration:
+                        return
+                result = self.send_one(chat_id, text, report, parse_mode=parse_mode)
+                if on_result is not None:
+                    on_result(chat_id, result)
+
+        started = time.monotonic()
+        threads = [threading.Thread(target=worker, name="delivery-%d" % i, daemon=True)
+                   for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        logger.info("Delivery finished in %.1fs - %s", time.monotonic() - started, report)
+        return report
@@ -0,0 +1,419 @@
+"""
+Async ingestion service for the HSE figures.
+
+Replaces the old blocking requests.get/time.sleep loop in updateDB.py. One
+aiohttp session is kept for the life of the service so connections are
+reused, every request has a timeout, and polls are conditional on the ETag
+and Last-Modified headers the server sent last time. How long to wait before
+the next poll is decided by PollSchedule: quickly around the usual publish
+time, slowly once the day's figures are in and backing off on errors.
+
+The built in sources are vaccine administration (the covid table), supply
+(the supply table read by /supply) and per age group figures.
+builtin_sources() builds them for one set of URLs. Each call returns new
+Source objects, so every tenant keeps its own URLs and polling state. Source
+URLs are configurable, so the service can be pointed at a local stub ArcGIS
+server.
+
+run_all() runs a service for each tenant on one event loop, sharing one
+aiohttp session and so one connection pool. Each service keeps its own
+database, sources and poll schedule.
+"""
+import asyncio, datetime, logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp, dataset
+import numpy as np
+from render_cache import bump_data_version, migrate as migrate_data_version
+import notify, pipeline, storage
+
+logger = logging.getLogger(__name__)
+
+ARCGIS_URL = 'https://services-eu1.arcgis.com/z6bHNio59iTqqSUY/arcgis/rest/services' \
+    '/Covid19_Vaccine_Administration_Hosted_View/FeatureServer/0/query?where=1%3D1&objectIds=&time=&geometry' \
+    '=&geometryType=esriGeometryEnvelope&inSR=&spatialRel=esriSpatialRelIntersects&resultType=none&distance=0.0' \
+    '&units=esriSRUnit_Meter&returnGeodetic=false&outFields=*&returnGeometry=true&featureEncoding=esriDefault' \
+    '&multipatchOption=xyFootprint&maxAllowableOffset=&geometryPrecision=&outSR=&datumTransformation' \
+    '=&applyVCSProjection=false&returnIdsOnly=false&returnUniqueIdsOnly=false&returnCountOnly=false' \
+    '&returnExtentOnly=false&returnQueryGeometry=false&returnDistinctValues=false&cacheHint=false&orderByFields' \
+    '=&groupByFieldsForStatistics=&outStatistics=&having=&resultOffset=&resultRecordCount=&returnZ=false' \
+    '&returnM=false&returnExceededLimitFeatures=true&quantizationParameters=&sqlFormat=none&f=json&token= '
+
+# Results of a single poll
+INSERTED = 'inserted'
+UPDATED = 'updated'
+UNCHANGED = 'unchanged'
+NOT_MODIFIED = 'not_modified'
+ERROR = 'error'
+
+# The source with the daily figures. The poll schedule only slows down once it has them
+VACCINES = 'vaccines'
+
+
+def derive_figures(today, previous):
+    """ Build a covid table row from the API attributes and the previous day's row
+
+    The API doesn't report J&J doses, so they are worked out from the total
+    given today minus the other three vaccines.
+    """
+    returned_date = datetime.datetime.utcfromtimestamp(int(today['relDate'] / 1000))
+
+    daily_total = today['totalAdministered'] - previous['totalVaccinations']
+    pfizer_today = today['pf'] - previous['pfizer']
+    moderna_today = today['modern'] - previous['moderna']
+    az_today = today['az'] - previous['astraZeneca']
+
+    johnson_today = daily_total - (pfizer_today + moderna_today + az_today)
+    johnson_total = johnson_today + previous['jj']
+    return OrderedDict(date=storage.format_date(returned_date),
+                       firstDose=today['firstDose'] - johnson_total,
+                       secondDose=today['secondDose'] + johnson_total,
+                       totalVaccinations=today['totalAdministered'],
+                       pfizer=today['pf'],
+                       moderna=today['modern'],
+                       astraZeneca=today['az'],
+                       dailyVaccinations=daily_total,
+                       jj=johnson_total,
+                       day=storage.day_key(returned_date)
+                       )
+
+
+# API attributes derive_figures_batch() needs, in the order they're stored
+RAW_FIELDS = ('relDate', 'firstDose', 'secondDose', 'totalAdministered', 'pf', 'modern', 'az')
+
+
+def derive_figures_batch(raw, previous=None):
+    """ Vectorised derive_figures() over consecutive days of API attributes
+
+    raw is a dict of equal length NumPy arrays keyed by RAW_FIELDS, oldest day
+    first. previous is the stored row for the day before the first entry, or
+    None when backfilling from the very start, in which case the first day
+    has no dailyVaccinations and J&J is counted from zero.
+
+    J&J running totals telescope: each day's total is the previous total plus
+    the doses not accounted for by the other three vaccines, so it can be
+    worked out for the whole batch with one subtraction.
+
+    Returns an OrderedDict of columns in covid table order.
+    """
+    total = raw['totalAdministered']
+    other = total - raw['pf'] - raw['modern'] - raw['az']
+    if previous is not None:
+        previous_other = previous['totalVaccinations'] - previous['pfizer'] - previous['moderna'] - previous['astraZeneca']
+        johnson_total = previous['jj'] + (other - previous_other)
+        daily = np.diff(total, prepend=previous['totalVaccinations']).tolist()
+    else:
+        johnson_total = other - other[0]
+        daily = [None] + np.diff(total).tolist()
+
+    days = (raw['relDate'] // 1000).astype('datetime64[s]').astype('datetime64[D]')
+    years = days.astype('datetime64[Y]').astype(np.int64) + 1970
+    months = days.astype('datetime64[M]').astype(np.int64) % 12 + 1
+    day_of_month = (days - days.astype('datetime64[M]')).astype(np.int64) + 1
+    dates = ["%d/%02d/%d" % parts for parts in zip(day_of_month.tolist(), months.tolist(), years.tolist())]
+
+    return OrderedDict(date=dates,
+                       firstDose=raw['firstDose'] - johnson_total,
+                       secondDose=raw['secondDose'] + johnson_total,
+                       totalVaccinations=total,
+                       pfizer=raw['pf'],
+                       moderna=raw['modern'],
+                       astraZeneca=raw['az'],
+                       dailyVaccinations=daily,
+                       jj=johnson_total,
+                       day=np.datetime_as_string(days, unit='D').tolist())
+
+
+def store_vaccine_figures(db, today):
+    """ Work out the daily figures from the API attributes and store them
+
+    The previous day and today's existing row are fetched in one query, and
+    the write plus the data version bump happen in one transaction.
+    Returns INSERTED, UPDATED or UNCHANGED.
+    """
+    # Calculate the returned date from API, and yesterdays date.
+    # so we can work out "dailyVaccinations" from total today vs yesterday
+    returned_date = datetime.datetime.utcfromtimestamp(int(today['relDate'] / 1000))
+    returned_day = storage.day_key(returned_date)
+    previous_day = storage.day_key(returned_date - datetime.timedelta(days=1))
+
+    with db as tx:
+        covid_table = tx['covid']
+        rows = dict((row['day'], row) for row in covid_table.find(day=[previous_day, returned_day]))
+        if previous_day not in rows:
+            raise LookupError("No figures stored for the day before " + returned_day)
+
+        today_dict = derive_figures(today, rows[previous_day])
+        todays = rows.get(returned_day)
+        if todays is None:
+            logger.info("Returned date %s did not exist in DB. Adding.", today_dict['date'])
+            covid_table.insert(today_dict)
+            result = INSERTED
+        elif all(todays.get(key) == value for key, value in today_dict.items()):
+            return UNCHANGED
+        else:
+            logger.info("Figures for %s changed, updating the entry", today_dict['date'])
+            covid_table.update(today_dict, ['day'])
+            result = UPDATED
+        bump_data_version(tx, today_dict['date'])
+    return result
+
+
+class PollSchedule:
+    """ Decides how long to wait before the next poll, in seconds """
+
+    def __init__(self, publish_start=14, publish_end=19, fast=60, normal=600, slow=3600, error=300,
+                 max_error=1800):
+        # Hours (local time) the HSE usually publishes between
+        self.publish_start = publish_start
+        self.publish_end = publish_end
+        self.fast = fast
+        self.normal = normal
+        self.slow = slow
+        self.error = error
+        self.max_error = max_error
+        self.errors = 0
+
+    def next_interval(self, result, now=None):
+        now = now or datetime.datetime.now()
+        if result == ERROR:
+            self.errors += 1
+            return min(self.error * (2 ** (self.errors - 1)), self.max_error)
+        self.errors = 0
+        if result == INSERTED:
+            # Today's figures are in, nothing new will turn up for a while
+            return self.slow
+        if self.publish_start <= now.hour < self.publish_end:
+            return self.fast
+        return self.normal
+
+
+def parse_vaccine_figures(data):
+    """ The administration API returns a single feature with the latest totals """
+    return data['features'][0]['attributes']
+
+
+def _feature_date(attributes):
+    return datetime.datetime.utcfromtimestamp(int(attributes['relDate'] / 1000))
+
+
+def parse_supply(data):
+    """ One feature per delivery week with cumulative totals per vaccine
+
+    Expects relDate, total, pf, az, modern and jj attributes, named the same
+    way as the administration API.
+    """
+    rows = []
+    for feature in data['features']:
+        attributes = feature['attributes']
+        supply_date = _feature_date(attributes)
+        rows.append(OrderedDict(date=storage.format_date(supply_date),
+                                total=attributes['total'],
+                                pfizer=attributes['pf'],
+                                moderna=attributes['modern'],
+                                astraZeneca=attributes['az'],
+                                jj=attributes['jj'],
+                                day=storage.day_key(supply_date)))
+    return rows
+
+
+def parse_age_groups(data):
+    """ One feature per age group with relDate, ageGroup, firstDose and secondDose """
+    rows = []
+    for feature in data['features']:
+        attributes = feature['attributes']
+        group_date = _feature_date(attributes)
+        rows.append(OrderedDict(date=storage.format_date(group_date),
+                                ageGroup=attributes['ageGroup'],
+                                firstDose=attributes['firstDose'],
+                                secondDose=attributes['secondDose'],
+                                day=storage.day_key(group_date)))
+    return rows
+
+
+def upsert_changed(db, table_name, rows, keys):
+    """ Write rows that are new or changed in one transaction
+
+    Returns INSERTED if anything was written, otherwise UNCHANGED.
+    """
+    if not rows:
+        return UNCHANGED
+    table = db[table_name]
+    existed = table.exists
+    existing = {}
+    if existed:
+        days = list(set(row['day'] for row in rows))
+        for row in table.find(day=days):
+            existing[tuple(row[key] for key in keys)] = row
+
+    changed = []
+    for row in rows:
+        current = existing.get(tuple(row[key] for key in keys))
+        if current is None or any(current.get(key) != value for key, value in row.items()):
+            changed.append(row)
+    if not changed:
+        return UNCHANGED
+
+    # Create any new table or columns before the transaction starts
+    for key, value in changed[0].items():
+        if not table.has_column(key):
+            table.create_column_by_example(key, value)
+    table.create_index(keys)
+
+    with db as tx:
+        for row in changed:
+            tx[table_name].upsert(row, keys, ensure=False)
+    if not existed:
+        # Index the day column of a table we just created
+        storage.migrate(db)
+    logger.info("Wrote %s rows to %s", len(changed), table_name)
+    return INSERTED
+
+
+def store_supply(db, rows):
+    result = upsert_changed(db, 'supply', rows, ['day'])
+    if result == INSERTED:
+        # /supply is rendered along with the covid messages
+        bump_data_version(db)
+    return result
+
+
+def store_age_groups(db, rows):
+    return upsert_changed(db, 'age_groups', rows, ['day', 'ageGroup'])
+
+
+def builtin_sources(vaccine_url=ARCGIS_URL, supply_url=None, age_group_url=None):
+    """ The built in sources for one tenant. Sources without a URL are skipped when polling """
+    return [
+        pipeline.Source(VACCINES, vaccine_url, parse_vaccine_figures, store_vaccine_figures),
+        pipeline.Source('supply', supply_url, parse_supply, store_supply),
+        pipeline.Source('age_groups', age_group_url, parse_age_groups, store_age_groups),
+    ]
+
+
+def combine_results(results):
+    """ Collapse per source results into one result, INSERTED if any source stored something """
+    results = list(results)
+    if INSERTED in results or UPDATED in results:
+        return INSERTED
+    if results and all(result == ERROR for result in results):
+        return ERROR
+    if UNCHANGED in results:
+        return UNCHANGED
+    return NOT_MODIFIED
+
+
+def schedule_result(results):
+    """ Collapse per source results into the one result the poll schedule goes by
+
+    New supply or age group figures don't mean the day's vaccine figures are
+    in, so only the vaccine source inserting a row backs the schedule off.
+    """
+    results = dict(results)
+    combined = combine_results(results.values())
+    if combined != INSERTED or VACCINES not in results:
+        return combined
+    return INSERTED if results[VACCINES] == INSERTED else UNCHANGED
+
+
+class IngestService:
+    """ Polls every registered source and stores new figures """
+
+    def __init__(self, db_url="sqlite:///covid.db", sources=None, schedule=None, timeout=30, notify_dir=None,
+                 tenant=None):
+        self.db_url = db_url
+        # Included in notifications, so only this tenant's bot checks for new data
+        self.tenant = tenant
+        self.notify_dir = notify_dir
+        self.sources = sources if sources is not None else list(pipeline.SOURCES.values())
+        self.schedule = schedule or PollSchedule()
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.stopping = asyncio.Event()
+        # dataset connections are per thread, so all DB work goes through
+        # one thread to keep a single persistent connection
+        self.db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ingest-db')
+        self.db = None
+        self.query_counter = None
+        self.last_round_trips = 0
+
+    def connect(self):
+        if self.db is None:
+            self.db = dataset.connect(self.db_url)
+            storage.migrate(self.db)
+            migrate_data_version(self.db)
+            self.query_counter = storage.QueryCounter(self.db)
+        return self.db
+
+    def store(self, fetched):
+        """ Write every source that returned new records. Runs on the DB thread """
+        db = self.connect()
+        self.query_counter.reset()
+        results = OrderedDict()
+        try:
+            for source, records in fetched:
+                try:
+                    results[source.name] = source.write(db, records)
+                except Exception:
+                    logger.exception("Failed to store %s", source.name)
+                    # Forget the body and validators so the same figures are retried next time
+                    source.reset()
+                    results[source.name] = ERROR
+        finally:
+            self.last_round_trips = self.query_counter.count
+            logger.info("DB round trips this cycle - %s", self.last_round_trips)
+        return results
+
+    async def run_cycle(self, session):
+        """ Poll every source once, returns a dict of source name to result """
+        # Cycles that store nothing make no round trips
+        self.last_round_trips = 0
+        results = OrderedDict()
+        to_store = []
+        for source, records in await pipeline.fetch_all(session, self.sources):
+            if records is None:
+                results[source.name] = NOT_MODIFIED
+            elif isinstance(records, Exception):
+                results[source.name] = ERROR
+            else:
+                to_store.append((source, records))
+
+        if to_store:
+            # dataset is blocking, keep it off the event loop
+            loop = asyncio.get_running_loop()
+            results.update(await loop.run_in_executor(self.db_executor, self.store, to_store))
+
+        if self.notify_dir and combine_results(results.values()) == INSERTED:
+            # Wake the bot up now rather than at its next poll
+            extra = {'tenant': self.tenant} if self.tenant else {}
+            notified = notify.notify_listeners(self.notify_dir, event='new_data', results=results, **extra)
+            logger.info("Notified %s bot processes of new data", notified)
+        return results
+
+    async def run(self, session=None):
+        """ Poll until stop() is called, on its own session unless one is given """
+        if session is None:
+            async with aiohttp.ClientSession(timeout=self.timeout) as session:
+                return await self.run(session)
+
+        while not self.stopping.is_set():
+            results = await self.run_cycle(session)
+            interval = self.schedule.next_interval(schedule_result(results))
+            logger.info("%sPoll results %s, next poll in %ss",
+                        self.tenant + " - " if self.tenant else "", dict(results), interval)
+            try:
+                await asyncio.wait_for(self.stopping.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+
+        if self.db is not None:
+            await asyncio.get_running_loop().run_in_executor(self.db_executor, self.db.close)
+        self.db_executor.shutdown()
+
+    def stop(self):
+        self.stopping.set()
+
+
+async def run_all(services, timeout=30):
+    """ Run several services until they're all stopped, sharing one aiohttp session """
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        await asyncio.gather(*[service.run(session) for service in services])
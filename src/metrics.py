@@ -0,0 +1,343 @@
+"""
+Counters and timers for the bot's hot paths.
+
+Handlers, database statements and Bot.send_message calls are timed into a
+process wide Registry. The numbers can be read two ways:
+
+    - render_prometheus() in the Prometheus text format, served over HTTP by
+      start_http_server() when [Metrics] port is set in config.cfg
+    - render_summary(), a short plain text report for the admin /metrics
+      command
+
+When one process serves several tenants, each tenant's handler, database,
+send and delivery metrics carry a tenant label, and render_summary() can
+be limited to one tenant so each admin only sees their own bot.
+
+SamplingProfiler is an optional background thread that looks at what every
+thread is running a few times a second and counts the innermost function,
+which is enough to see where time goes on a live bot without attaching a
+profiler.
+"""
+import functools, logging, sys, threading, time
+from collections import Counter, OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds, the same shape as prometheus_client's defaults
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """ Cumulative bucket counts plus a sum, like a Prometheus histogram """
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, fraction):
+        """ Upper bound of the bucket holding the given quantile, inf if past the last bucket """
+        target = self.count * fraction
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float('inf')
+
+
+class Registry:
+    """ Thread safe counters and histograms keyed by name and labels """
+
+    def __init__(self):
+        self.counters = OrderedDict()
+        self.histograms = OrderedDict()
+        self.help = {}
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def time(self, name, **labels):
+        return _Timer(self, name, labels)
+
+    def counter_value(self, name, **labels):
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.started = time.time()
+
+
+class _Timer:
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.observe(self.name, time.perf_counter() - self.started, **self.labels)
+
+
+REGISTRY = Registry()
+REGISTRY.describe('bot_handler_seconds', 'Time spent in each command handler')
+REGISTRY.describe('bot_handler_errors_total', 'Handler calls that raised')
+REGISTRY.describe('bot_db_query_seconds', 'Time spent executing database statements')
+REGISTRY.describe('bot_send_seconds', 'Time spent in Bot.send_message calls')
+REGISTRY.describe('bot_send_total', 'Bot.send_message calls by result')
+REGISTRY.describe('bot_delivery_seconds', 'Time taken by each daily update or broadcast fan-out')
+REGISTRY.describe('bot_delivery_messages_total', 'Daily update and broadcast deliveries by result')
+REGISTRY.describe('bot_startup_seconds', 'Time taken by each startup phase')
+
+
+def instrument_handler(name, callback, registry=REGISTRY, **labels):
+    """ Wrap a handler callback with a timer and an error counter. labels are added to both """
+    @functools.wraps(callback)
+    def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return callback(update, context)
+        except Exception:
+            registry.inc('bot_handler_errors_total', command=name, **labels)
+            raise
+        finally:
+            registry.observe('bot_handler_seconds', time.perf_counter() - started, command=name, **labels)
+    return wrapper
+
+
+def instrument_db(db, registry=REGISTRY, **labels):
+    """ Time every statement a dataset connection executes, labelled by the statement type """
+    from sqlalchemy import event
+
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+    def after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['metrics_started'].pop()
+        verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'OTHER'
+        registry.observe('bot_db_query_seconds', time.perf_counter() - started, statement=verb, **labels)
+
+    event.listen(db.engine, 'before_cursor_execute', before)
+    event.listen(db.engine, 'after_cursor_execute', after)
+
+
+def instrument_bot(bot, registry=REGISTRY, **labels):
+    """ Time and count send_message on a Bot instance, including replies made through Message.reply_* """
+    send_message = bot.send_message
+
+    @functools.wraps(send_message)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = send_message(*args, **kwargs)
+        except Exception as e:
+            registry.inc('bot_send_total', result=type(e).__name__, **labels)
+            raise
+        else:
+            registry.inc('bot_send_total', result='ok', **labels)
+            return result
+        finally:
+            registry.observe('bot_send_seconds', time.perf_counter() - started, **labels)
+
+    bot.send_message = wrapper
+    return bot
+
+
+def record_delivery(report, kind, registry=REGISTRY, **labels):
+    """ Add a DeliveryReport's totals to the delivery counters """
+    registry.inc('bot_delivery_messages_total', report.sent, kind=kind, result='sent', **labels)
+    registry.inc('bot_delivery_messages_total', report.failed, kind=kind, result='failed', **labels)
+    registry.inc('bot_delivery_messages_total', report.retried, kind=kind, result='retried', **labels)
+    registry.inc('bot_delivery_messages_total', len(report.blocked), kind=kind, result='blocked', **labels)
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in labels) + '}'
+
+
+def render_prometheus(registry=REGISTRY):
+    """ Everything in the registry in the Prometheus text exposition format """
+    lines = []
+    described = set()
+
+    def header(name, kind):
+        if name not in described:
+            described.add(name)
+            if name in registry.help:
+                lines.append('# HELP %s %s' % (name, registry.help[name]))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+    with registry.lock:
+        counters = list(registry.counters.items())
+        histograms = [(key, list(h.counts), h.count, h.sum) for key, h in registry.histograms.items()]
+
+    for (name, labels), value in sorted(counters):
+        header(name, 'counter')
+        lines.append('%s%s %s' % (name, _format_labels(labels), value))
+    for (name, labels), counts, count, total in sorted(histograms, key=lambda h: h[0]):
+        header(name, 'histogram')
+        cumulative = 0
+        for bound, bucket in zip(BUCKETS, counts):
+            cumulative += bucket
+            lines.append('%s_bucket%s %s' % (name, _format_labels(labels, [('le', bound)]), cumulative))
+        lines.append('%s_bucket%s %s' % (name, _format_labels(labels, [('le', '+Inf')]), count))
+        lines.append('%s_sum%s %s' % (name, _format_labels(labels), total))
+        lines.append('%s_count%s %s' % (name, _format_labels(labels), count))
+    header('bot_uptime_seconds', 'gauge')
+    lines.append('bot_uptime_seconds %.0f' % (time.time() - registry.started))
+    return '\n'.join(lines) + '\n'
+
+
+def _for_tenant(key, tenant):
+    """ key without its tenant label if it belongs to tenant or to no tenant, otherwise None """
+    name, labels = key
+    if tenant is None:
+        return key
+    if dict(labels).get('tenant', tenant) != tenant:
+        return None
+    return name, tuple(label for label in labels if label[0] != 'tenant')
+
+
+def render_summary(registry=REGISTRY, profiler=None, tenant=None):
+    """ Plain text summary for the /metrics command
+
+    With a tenant, only metrics labelled with that tenant or with no tenant
+    are included.
+    """
+    with registry.lock:
+        histograms = [(_for_tenant(key, tenant), h.count, h.sum, h.quantile(0.5), h.quantile(0.99), h.max)
+                      for key, h in registry.histograms.items()]
+        counters = [(_for_tenant(key, tenant), value) for key, value in registry.counters.items()]
+    histograms = [row for row in histograms if row[0] is not None]
+    counters = [(key, value) for key, value in counters if key is not None]
+
+    text = "Metrics for the last %.1f hours\n" % ((time.time() - registry.started) / 3600)
+    for heading, metric in (("Handlers", 'bot_handler_seconds'), ("Database", 'bot_db_query_seconds'),
+                            ("Sends", 'bot_send_seconds')):
+        rows = [row for row in histograms if row[0][0] == metric]
+        if not rows:
+            continue
+        text += "\n" + heading + "\n"
+        for (name, labels), count, total, p50, p99, slowest in sorted(rows, key=lambda row: -row[2]):
+            label = ','.join(str(value) for _, value in labels) or 'all'
+            text += "%s - %s calls, p50 <%sms, p99 <%sms, max %.0fms\n" % (
+                label, '{:,}'.format(count), '{:g}'.format(p50 * 1000), '{:g}'.format(p99 * 1000), slowest * 1000)
+    counted = [(name, labels, value) for (name, labels), value in counters if value]
+    if counted:
+        text += "\nCounters\n"
+        for name, labels, value in sorted(counted):
+            text += "%s %s - %s\n" % (name, ','.join('%s=%s' % label for label in labels), '{:,}'.format(value))
+    if profiler is not None:
+        text += "\nProfiler, %s samples\n" % '{:,}'.format(profiler.samples)
+        for location, count in profiler.top(10):
+            text += "%s - %s\n" % (location, count)
+    return text
+
+
+class SamplingProfiler:
+    """ Periodically sample every thread's innermost frame and count where they are """
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.counts = Counter()
+        self.samples = 0
+        self.running = False
+        self.thread = None
+
+    def sample(self):
+        me = threading.get_ident()
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == me:
+                continue
+            code = frame.f_code
+            self.counts['%s:%s %s' % (code.co_filename.rsplit('/', 1)[-1], frame.f_lineno, code.co_name)] += 1
+        self.samples += 1
+
+    def _run(self):
+        while self.running:
+            self.sample()
+            time.sleep(self.interval)
+
+    def top(self, n=10):
+        return self.counts.most_common(n)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self.thread.start()
+        logger.info("Sampling profiler running every %ss", self.interval)
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+
+def start_http_server(port, addr='127.0.0.1', registry=REGISTRY, health=None):
+    """ Serve render_prometheus() at /metrics from a background thread. Returns the server
+
+    health, if given, is served at /healthz. It should return (healthy,
+    {check: result}) like bootstrap.check_health(), and unhealthy answers 503.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split('?', 1)[0]
+            if path == '/metrics':
+                status, content_type = 200, 'text/plain; version=0.0.4; charset=utf-8'
+                body = render_prometheus(registry).encode()
+            elif path == '/healthz' and health is not None:
+                healthy, results = health()
+                status, content_type = (200 if healthy else 503), 'text/plain; charset=utf-8'
+                body = "".join("%s: %s\n" % item for item in results.items()).encode()
+            else:
+                self.send_error(404)
+                return
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((addr, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    logger.info("Serving Prometheus metrics on %s:%s/metrics", addr, port)
+    return server
@@ -0,0 +1,104 @@
+"""
+Push notifications from the ingester to running bot processes.
+
+Each bot process (including sharded delivery workers) binds a Unix datagram
+socket in a shared directory. When updateDB.py stores new figures it sends a
+small datagram to every socket in that directory, and the bot schedules an
+immediate delivery check instead of waiting for its next poll. Polling is
+still there as a fallback in case a notification is missed.
+
+Unix sockets aren't available everywhere; on those platforms both sides are
+no-ops and the bot relies on polling alone.
+"""
+import json, logging, os, socket, threading
+
+logger = logging.getLogger(__name__)
+
+SOCKET_PREFIX = 'bot-'
+SOCKET_SUFFIX = '.sock'
+SUPPORTED = hasattr(socket, 'AF_UNIX')
+
+
+def notify_listeners(socket_dir, **message):
+    """ Send message to every listening bot. Returns how many were notified """
+    if not SUPPORTED or not os.path.isdir(socket_dir):
+        return 0
+    payload = json.dumps(message).encode()
+    notified = 0
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        for name in os.listdir(socket_dir):
+            if not (name.startswith(SOCKET_PREFIX) and name.endswith(SOCKET_SUFFIX)):
+                continue
+            path = os.path.join(socket_dir, name)
+            try:
+                sock.sendto(payload, path)
+                notified += 1
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Left behind by a bot that didn't shut down cleanly
+                logger.info("Removing stale notification socket %s", path)
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            except OSError as e:
+                logger.warning("Couldn't notify %s - %s", path, e)
+    finally:
+        sock.close()
+    return notified
+
+
+class NotificationListener:
+    """ Background thread calling callback(message) for every notification received """
+
+    def __init__(self, socket_dir, callback):
+        self.socket_dir = socket_dir
+        self.callback = callback
+        self.path = os.path.join(socket_dir, SOCKET_PREFIX + str(os.getpid()) + SOCKET_SUFFIX)
+        self.sock = None
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        if not SUPPORTED:
+            logger.info("Unix sockets not supported, relying on polling for updates")
+            return
+        os.makedirs(self.socket_dir, exist_ok=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        self.sock.settimeout(1)
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="notification-listener", daemon=True)
+        self.thread.start()
+        logger.info("Listening for new data notifications on %s", self.path)
+
+    def _run(self):
+        while self.running:
+            try:
+                payload = self.sock.recv(4096)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            try:
+                message = json.loads(payload.decode())
+            except ValueError:
+                logger.warning("Ignoring malformed notification %r", payload)
+                continue
+            try:
+                self.callback(message)
+            except Exception:
+                logger.exception("Notification callback failed")
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        if self.sock is not None:
+            self.sock.close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
@@ -0,0 +1,150 @@
+"""
+Durable outbox for the daily update.
+
+Nothing is sent straight from the users table. When a segment's window
+opens, each of its recipients gets a 'pending' row in the outbox table,
+one per (day, kind, user), where kind is the daily update or an alert. The
+rows are inserted by a single INSERT ... SELECT in the same transaction that
+marks the segment delivered, so a segment is either queued completely or
+not at all.
+
+deliver() sends whatever is still pending for the day. The delivery workers
+report each result as it happens, and the results are written back to the
+outbox in batches, one transaction per batch_size sends. If the bot stops
+part way through, the next delivery tick after a restart carries on with
+the rows that are still pending. At most the last unwritten batch is sent
+twice.
+
+Chats that have blocked the bot or been deleted are unsubscribed in the same
+transaction that records their result, so later fan-outs don't try them
+again. Rows are kept for KEEP_DAYS days, so what happened to a delivery can
+still be looked up afterwards.
+"""
+import datetime, logging, threading
+import delivery, subscribers
+
+logger = logging.getLogger(__name__)
+
+UPDATE = 'update'
+ALERT = 'alert'
+KINDS = (UPDATE, ALERT)
+PENDING = 'pending'
+
+KEEP_DAYS = 7
+BATCH_SIZE = 100
+# Pending rows are read this many at a time while sending
+PAGE_SIZE = 1000
+
+
+def migrate(db):
+    """ Create the outbox table. Safe to run on every startup """
+    db.query('CREATE TABLE IF NOT EXISTS outbox ('
+             'day TEXT NOT NULL, kind TEXT NOT NULL, user TEXT NOT NULL, shard INTEGER NOT NULL, '
+             'variant TEXT, status TEXT NOT NULL, updated TIMESTAMP, '
+             'PRIMARY KEY (day, kind, user))')
+    db.query('CREATE INDEX IF NOT EXISTS ix_outbox_pending ON outbox (day, shard, status, kind)')
+
+
+def enqueue_segment(db, day, window, shard_index=0, shard_count=1):
+    """ Queue the daily update for the shard's active subscribers in a delivery window
+
+    variant is the subscriber's sections choice. Returns how many rows were queued.
+    """
+    result = db.executable.exec_driver_sql(
+        "INSERT OR IGNORE INTO outbox (day, kind, user, shard, variant, status) "
+        "SELECT ?, ?, user, ?, sections, ? FROM users "
+        "WHERE active = 1 AND bucket % ? = ? AND COALESCE(delivery_window, '') = ?",
+        (day, UPDATE, shard_index, PENDING, shard_count, shard_index, window))
+    return result.rowcount
+
+
+def enqueue_alerts(db, day, rows, shard_index=0):
+    """ Queue alerts for (user, alerts) rows, variant is the alerts column value """
+    rows = [(day, ALERT, str(user), shard_index, alerts, PENDING) for user, alerts in rows]
+    if rows:
+        db.executable.exec_driver_sql(
+            "INSERT OR IGNORE INTO outbox (day, kind, user, shard, variant, status) VALUES (?, ?, ?, ?, ?, ?)", rows)
+    return len(rows)
+
+
+def pending_count(db, day, shard_index=0, kind=None):
+    sql = "SELECT COUNT(*) FROM outbox WHERE day = ? AND shard = ? AND status = ?"
+    params = (day, shard_index, PENDING)
+    if kind is not None:
+        sql += " AND kind = ?"
+        params += (kind,)
+    return db.executable.exec_driver_sql(sql, params).scalar()
+
+
+def iter_pending(db, day, kind, shard_index=0):
+    """ Yield (user, variant) for a shard's pending rows, PAGE_SIZE rows at a time """
+    sql = ("SELECT rowid, user, variant FROM outbox "
+           "WHERE day = ? AND shard = ? AND status = ? AND kind = ? AND rowid > ? ORDER BY rowid LIMIT ?")
+    last = 0
+    while 1:
+        rows = db.executable.exec_driver_sql(sql, (day, shard_index, PENDING, kind, last, PAGE_SIZE)).fetchall()
+        for rowid, user, variant in rows:
+            yield user, variant
+        if len(rows) < PAGE_SIZE:
+            return
+        last = rows[-1][0]
+
+
+class Progress:
+    """ Collects send results from the delivery workers and writes them in batches
+
+    Pass as deliver_each()'s on_result, and call flush() when it returns.
+    """
+
+    def __init__(self, db, day, kind, batch_size=BATCH_SIZE):
+        self.db = db
+        self.day = day
+        self.kind = kind
+        self.batch_size = max(1, int(batch_size))
+        self.results = []
+        self.unsubscribed = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, chat_id, result):
+        with self.lock:
+            self.results.append((result, str(chat_id)))
+            if len(self.results) >= self.batch_size:
+                self._write()
+
+    def flush(self):
+        with self.lock:
+            self._write()
+
+    def _write(self):
+        if not self.results:
+            return
+        results, self.results = self.results, []
+        blocked = [user for result, user in results if result == delivery.BLOCKED]
+        with self.db as tx:
+            tx.executable.exec_driver_sql(
+                "UPDATE outbox SET status = ?, updated = CURRENT_TIMESTAMP WHERE day = ? AND kind = ? AND user = ?",
+                [(result, self.day, self.kind, user) for result, user in results])
+            self.unsubscribed += subscribers.deactivate(tx, blocked)
+        if blocked:
+            logger.info("Unsubscribed %s blocked or deleted chats", len(blocked))
+
+
+def deliver(db, engine, day, kind, render, shard_index=0, batch_size=BATCH_SIZE):
+    """ Send a shard's pending messages of one kind for a day, recording each result
+
+    render(variant) returns the text for a row. Returns the DeliveryReport
+    and the number of subscribers that were unsubscribed.
+    """
+    progress = Progress(db, day, kind, batch_size)
+    messages = ((user, render(variant)) for user, variant in iter_pending(db, day, kind, shard_index))
+    try:
+        report = engine.deliver_each(messages, on_result=progress)
+    finally:
+        progress.flush()
+    return report, progress.unsubscribed
+
+
+def expire(db, day, keep_days=KEEP_DAYS):
+    """ Delete outbox rows more than keep_days before an ISO day """
+    cutoff = (datetime.date.fromisoformat(day) - datetime.timedelta(days=keep_days)).isoformat()
+    return db.executable.exec_driver_sql("DELETE FROM outbox WHERE day < ?", (cutoff,)).rowcount
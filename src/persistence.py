@@ -0,0 +1,290 @@
+"""
+SQLite backed persistence for python-telegram-bot.
+
+PicklePersistence re-pickles the whole of bot_data every time it's flushed,
+and /daily and /unsubscribe write a key per user into bot_data, so the cost
+of each flush grows with the number of subscribers. SQLitePersistence keeps
+one row per key in a WAL mode SQLite file next to covid.db and only writes
+the keys that changed since the last update.
+
+bot_data is returned as a LazyBotData dict. It starts out empty and looks
+keys up in the database the first time they're read, so startup doesn't load
+every subscriber. Anything that needs the whole dict (iterating, len) loads
+the rest in one query first.
+
+The bot doesn't use user_data or chat_data, and creates its persistence with
+store_user_data and store_chat_data off. Otherwise the dispatcher would pickle
+every user's dict after each job run just to find that nothing changed.
+"""
+import logging, os, pickle, sqlite3, threading
+from collections import defaultdict
+from telegram.ext import BasePersistence
+
+logger = logging.getLogger(__name__)
+
+BOT_DATA = 'bot'
+USER_DATA = 'user'
+CHAT_DATA = 'chat'
+CONVERSATION = 'conversation:'
+
+_MISSING = object()
+
+
+class LazyBotData(dict):
+    """ bot_data dict that loads keys on demand and remembers which keys changed """
+
+    def __init__(self, persistence):
+        super().__init__()
+        self._persistence = persistence
+        self._loaded = False
+        self._dirty = set()
+        self._deleted = set()
+        self._lock = threading.RLock()
+
+    def _load_key(self, key):
+        value = self._persistence.load_value(BOT_DATA, key)
+        if value is not _MISSING:
+            dict.__setitem__(self, key, value)
+        return value
+
+    def _load_all(self):
+        with self._lock:
+            if self._loaded:
+                return
+            for key, value in self._persistence.load_all(BOT_DATA):
+                if key not in self._dirty and key not in self._deleted:
+                    dict.__setitem__(self, key, value)
+            self._loaded = True
+
+    def take_changes(self):
+        """ Return (changed items, deleted keys) since the last call and reset them """
+        with self._lock:
+            changed = [(key, dict.get(self, key)) for key in self._dirty if dict.__contains__(self, key)]
+            deleted = list(self._deleted)
+            self._dirty = set()
+            self._deleted = set()
+            return changed, deleted
+
+    def __missing__(self, key):
+        if self._loaded:
+            raise KeyError(key)
+        value = self._load_key(key)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        if dict.__contains__(self, key):
+            return True
+        if self._loaded or key in self._deleted:
+            return False
+        return self._load_key(key) is not _MISSING
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            dict.__setitem__(self, key, value)
+            self._dirty.add(key)
+            self._deleted.discard(key)
+
+    def __delitem__(self, key):
+        with self._lock:
+            if key not in self:
+                raise KeyError(key)
+            dict.__delitem__(self, key)
+            self._dirty.discard(key)
+            self._deleted.add(key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, default=_MISSING):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        if default is _MISSING:
+            raise KeyError(key)
+        return default
+
+    def clear(self):
+        self._load_all()
+        for key in list(dict.keys(self)):
+            del self[key]
+
+    def __iter__(self):
+        self._load_all()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self._load_all()
+        return dict.__len__(self)
+
+    def keys(self):
+        self._load_all()
+        return dict.keys(self)
+
+    def values(self):
+        self._load_all()
+        return dict.values(self)
+
+    def items(self):
+        self._load_all()
+        return dict.items(self)
+
+    def copy(self):
+        self._load_all()
+        return dict(dict.items(self))
+
+    def __repr__(self):
+        return "LazyBotData(%d loaded keys)" % dict.__len__(self)
+
+
+class SQLitePersistence(BasePersistence):
+    """ BasePersistence that stores each key as its own row in SQLite """
+
+    def __init__(self, filename='bot_persistence.db', store_user_data=True, store_chat_data=True,
+                 store_bot_data=True, import_pickle=None):
+        super().__init__(store_user_data=store_user_data,
+                         store_chat_data=store_chat_data,
+                         store_bot_data=store_bot_data)
+        self.filename = filename
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS persistence '
+                          '(kind TEXT NOT NULL, key BLOB NOT NULL, value BLOB, PRIMARY KEY (kind, key))')
+        self.bot_data = None
+        self.user_data = None
+        self.chat_data = None
+        self.written = {USER_DATA: {}, CHAT_DATA: {}}
+        if import_pickle and os.path.exists(import_pickle):
+            self.import_pickle(import_pickle)
+
+    # Bot instances are never stored in bot_data here, so skip PTB's deep copies
+    @classmethod
+    def replace_bot(cls, obj):
+        return obj
+
+    def insert_bot(self, obj):
+        return obj
+
+    def load_value(self, kind, key):
+        with self.lock:
+            row = self.conn.execute('SELECT value FROM persistence WHERE kind = ? AND key = ?',
+                                    (kind, pickle.dumps(key))).fetchone()
+        if row is None:
+            return _MISSING
+        return pickle.loads(row[0])
+
+    def load_all(self, kind):
+        with self.lock:
+            rows = self.conn.execute('SELECT key, value FROM persistence WHERE kind = ?', (kind,)).fetchall()
+        return [(pickle.loads(key), pickle.loads(value)) for key, value in rows]
+
+    def write(self, kind, changed, deleted=()):
+        """ Upsert changed (key, value) pairs and remove deleted keys in one transaction """
+        if not changed and not deleted:
+            return
+        with self.lock:
+            self.conn.execute('BEGIN')
+            try:
+                self.conn.executemany('INSERT OR REPLACE INTO persistence (kind, key, value) VALUES (?, ?, ?)',
+                                      [(kind, pickle.dumps(key), pickle.dumps(value)) for key, value in changed])
+                self.conn.executemany('DELETE FROM persistence WHERE kind = ? AND key = ?',
+                                      [(kind, pickle.dumps(key)) for key in deleted])
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def import_pickle(self, filename):
+        """ One off import of a PicklePersistence single file, if nothing is stored yet """
+        with self.lock:
+            if self.conn.execute('SELECT 1 FROM persistence LIMIT 1').fetchone():
+                return
+        with open(filename, 'rb') as f:
+            data = pickle.load(f)
+        logger.info("Importing %s into %s", filename, self.filename)
+        self.write(BOT_DATA, list(data.get('bot_data', {}).items()))
+        self.write(USER_DATA, list(data.get('user_data', {}).items()))
+        self.write(CHAT_DATA, list(data.get('chat_data', {}).items()))
+        for name, conversations in data.get('conversations', {}).items():
+            self.write(CONVERSATION + name, list(conversations.items()))
+
+    def get_bot_data(self):
+        if self.bot_data is None:
+            self.bot_data = LazyBotData(self)
+        return self.bot_data
+
+    def update_bot_data(self, data):
+        if data is self.bot_data:
+            changed, deleted = data.take_changes()
+        else:
+            # Someone replaced bot_data with a plain dict, write it all
+            changed, deleted = list(data.items()), []
+        self.write(BOT_DATA, changed, deleted)
+
+    def _get_keyed_data(self, kind):
+        data = defaultdict(dict)
+        for key, value in self.load_all(kind):
+            # Empty rows were written by earlier versions, defaultdict recreates them
+            if value:
+                data[key] = value
+                self.written[kind][key] = pickle.dumps(value)
+        return data
+
+    def _update_keyed_data(self, kind, key, data):
+        # PTB creates an empty dict for everyone who messages the bot, there's
+        # nothing to store until one is filled in
+        if not data and key not in self.written[kind]:
+            return
+        # Only write when the pickled value actually changed
+        pickled = pickle.dumps(data)
+        if self.written[kind].get(key) == pickled:
+            return
+        self.written[kind][key] = pickled
+        self.write(kind, [(key, data)])
+
+    def get_user_data(self):
+        if self.user_data is None:
+            self.user_data = self._get_keyed_data(USER_DATA)
+        return self.user_data
+
+    def get_chat_data(self):
+        if self.chat_data is None:
+            self.chat_data = self._get_keyed_data(CHAT_DATA)
+        return self.chat_data
+
+    def update_user_data(self, user_id, data):
+        self._update_keyed_data(USER_DATA, user_id, data)
+
+    def update_chat_data(self, chat_id, data):
+        self._update_keyed_data(CHAT_DATA, chat_id, data)
+
+    def get_conversations(self, name):
+        return dict(self.load_all(CONVERSATION + name))
+
+    def update_conversation(self, name, key, new_state):
+        if new_state is None:
+            self.write(CONVERSATION + name, [], [key])
+        else:
+            self.write(CONVERSATION + name, [(key, new_state)])
+
+    def flush(self):
+        if self.bot_data is not None:
+            self.update_bot_data(self.bot_data)
+        with self.lock:
+            self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
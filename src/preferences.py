@@ -0,0 +1,205 @@
+"""
+Per subscriber preferences for the daily update.
+
+Three columns on the users table hold them:
+
+    sections         comma separated LATEST_SECTIONS names, NULL for the full message
+    delivery_window  "START-END" hours the update may be sent in, NULL for any time
+    alerts           comma separated "metric:percent" thresholds, like fully:70
+
+Subscribers sharing a delivery window form a segment. Each segment is
+queued once per data date, when its window is open, and the
+segment_deliveries table records the date each shard last queued it. Queuing
+adds a row per subscriber to the outbox (see outbox.py), which stores their
+sections choice or alerts. As the outbox is sent, SegmentRenderer renders each
+distinct sections choice and each alert once, however many subscribers share
+it, so the formatting cost grows with the number of segments, not users.
+
+Alerts form their own segment. They're checked once per data date and sent
+to anyone whose threshold was crossed between the previous day and today,
+whether or not they get the daily update.
+"""
+import datetime, logging
+from collections import OrderedDict
+import subscribers, templates
+
+logger = logging.getLogger(__name__)
+
+ANY_TIME = ''
+ALERTS = 'alerts'
+DELIVERIES_TABLE = 'segment_deliveries'
+
+# Alert name, the stats field it watches and how it's described
+ALERT_METRICS = OrderedDict([
+    ('first', ('firstDose_eligible', "12+ population with a first dose")),
+    ('fully', ('secondDose_eligible', "12+ population fully vaccinated")),
+])
+
+
+def migrate(db):
+    """ Add the preference columns and the segment deliveries table. Safe to run on every startup """
+    users_table = db['users']
+    for column in ('sections', 'delivery_window', 'alerts'):
+        if not users_table.has_column(column):
+            users_table.create_column(column, db.types.text)
+    # Unsubscribing clears alerts, this catches users who unsubscribed before it did
+    db.query("UPDATE users SET alerts = NULL WHERE subscribed = 'False' AND alerts IS NOT NULL")
+
+    deliveries = db[DELIVERIES_TABLE]
+    if not deliveries.exists:
+        deliveries.create_column('shard', db.types.integer)
+        deliveries.create_column('segment', db.types.text)
+        deliveries.create_column('date', db.types.text)
+        deliveries.create_index(['shard', 'segment'])
+        # Carry over what each shard already sent, so upgrading doesn't resend today's update
+        if db['last_update'].exists:
+            for row in db['last_update'].all():
+                deliveries.insert(OrderedDict(shard=row['id'] - 1, segment=ANY_TIME, date=row['date']))
+
+
+def parse_sections(names):
+    """ Validated sections string from a list of names, None for everything """
+    names = [name.lower() for name in names]
+    if not names or names == ['all']:
+        return None
+    unknown = [name for name in names if name not in templates.LATEST_SECTIONS]
+    if unknown:
+        raise ValueError("Unknown section " + ", ".join(unknown))
+    return ','.join(name for name in templates.LATEST_SECTIONS if name in names)
+
+
+def parse_window(start, end):
+    """ "START-END" for a pair of hours, end may be less than start to wrap past midnight """
+    start, end = int(start), int(end)
+    if not (0 <= start <= 23 and 0 <= end <= 24) or start == end:
+        raise ValueError("Hours should be between 0 and 24, like /window 8 20")
+    return "%d-%d" % (start, end)
+
+
+def window_open(window, hour):
+    """ Whether a delivery window includes the given hour """
+    if window in (ANY_TIME, ALERTS):
+        return True
+    start, end = (int(value) for value in window.split('-'))
+    if start < end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+
+def next_opening(windows, now):
+    """ The hour, as a datetime, that the first of these closed windows opens after now """
+    base = now.replace(minute=0, second=0, microsecond=0)
+    starts = (int(window.split('-')[0]) for window in windows)
+    return min(base + datetime.timedelta(hours=(start - now.hour) % 24 or 24) for start in starts)
+
+
+def parse_alert(name, percent):
+    """ "metric:percent" for an alert. The ValueError messages are written for users """
+    if name not in ALERT_METRICS:
+        raise ValueError("Alerts can be " + " or ".join(ALERT_METRICS))
+    try:
+        percent = float(percent.rstrip('%'))
+    except ValueError:
+        raise ValueError("Give a percentage between 0 and 100") from None
+    if not 0 < percent <= 100:
+        raise ValueError("Give a percentage between 0 and 100")
+    return "%s:%g" % (name, percent)
+
+
+def add_alert(alerts, alert):
+    """ An alerts column value with alert added, unless it's already there """
+    current = [existing for existing in (alerts or '').split(',') if existing]
+    if alert not in current:
+        current.append(alert)
+    return ','.join(current)
+
+
+def parse_alerts(text):
+    """ [(name, percent)] from an alerts column value """
+    alerts = []
+    for alert in (text or '').split(','):
+        if alert:
+            name, percent = alert.split(':')
+            alerts.append((name, float(percent)))
+    return alerts
+
+
+def get_preferences(users_table, user):
+    row = users_table.find_one(user=str(user))
+    if row is None:
+        return {'sections': None, 'delivery_window': None, 'alerts': None}
+    return row
+
+
+def set_preference(users_table, user, **values):
+    """ Update preference columns for a user, leaving everything else alone """
+    row = OrderedDict(user=str(user), bucket=subscribers.bucket_for(user))
+    row.update(values)
+    users_table.upsert(row, ['user'])
+
+
+def active_windows(db):
+    """ Every delivery window active subscribers have picked, ANY_TIME included """
+    rows = db.executable.exec_driver_sql(
+        "SELECT DISTINCT COALESCE(delivery_window, '') FROM users WHERE active = 1").fetchall()
+    return [row[0] for row in rows]
+
+
+def iter_alerts(db, shard_index=0, shard_count=1):
+    """ Yield (user, alerts) for everyone in a shard with alerts set
+
+    Few users set alerts, so this is one pass over the table rather than a
+    query per bucket.
+    """
+    buckets = set(subscribers.shard_buckets(shard_index, shard_count))
+    sql = "SELECT user, alerts, bucket FROM users WHERE alerts IS NOT NULL AND alerts != ''"
+    for user, alerts, bucket in db.executable.exec_driver_sql(sql).fetchall():
+        if bucket in buckets:
+            yield user, alerts
+
+
+def delivered_date(db, shard_index, segment):
+    row = db[DELIVERIES_TABLE].find_one(shard=shard_index, segment=segment)
+    return row['date'] if row is not None else None
+
+
+def mark_delivered(db, shard_index, segment, date):
+    db[DELIVERIES_TABLE].upsert(OrderedDict(shard=shard_index, segment=segment, date=date), ['shard', 'segment'])
+
+
+class SegmentRenderer:
+    """ Renders each distinct message once for a fan-out """
+
+    def __init__(self, stats, previous_stats, full_message):
+        self.stats = stats
+        self.previous_stats = previous_stats
+        self.full_message = full_message
+        self.messages = {}
+        self.alert_messages = {}
+
+    def message(self, sections):
+        if sections is None:
+            return self.full_message
+        text = self.messages.get(sections)
+        if text is None:
+            text = self.messages[sections] = templates.render_sections(sections.split(','), self.stats)
+        return text
+
+    def alert_message(self, alerts):
+        """ Message for the alerts crossed today, or None. alerts is an alerts column value """
+        text = self.alert_messages.get(alerts, False)
+        if text is not False:
+            return text
+        lines = []
+        for name, percent in parse_alerts(alerts):
+            field, description = ALERT_METRICS[name]
+            if self.previous_stats[field] * 100 < percent <= self.stats[field] * 100:
+                lines.append("🎯 " + description + " has passed " + '{:g}'.format(percent) + "%, now "
+                             + '{0:.2%}'.format(self.stats[field]))
+        text = self.alert_messages[alerts] = ("<b>📣 Vaccine alert " + self.stats['date'] + "</b>\n\n"
+                                              + "\n".join(lines)) if lines else None
+        return text
+
+    @property
+    def rendered(self):
+        return len(self.messages) + len(self.alert_messages)
@@ -0,0 +1,92 @@
+"""
+Rendered message cache.
+
+The daily update, /latest, /overall and /week messages only change when
+updateDB.py inserts a new row. The ingester bumps a single row in the
+data_version table whenever it writes, so the bot can tell whether anything
+changed with one primary key lookup and otherwise serve the messages it
+already rendered.
+"""
+import logging, threading
+
+logger = logging.getLogger(__name__)
+
+DATA_VERSION_TABLE = 'data_version'
+
+
+def migrate(db):
+    """ Create the data_version row. Safe to run on every startup
+
+    Creating it here rather than on the first bump keeps the schema change
+    out of the ingester's insert transaction.
+    """
+    db.query('CREATE TABLE IF NOT EXISTS %s (id INTEGER PRIMARY KEY, version INTEGER, date TEXT)' % DATA_VERSION_TABLE)
+    db.query('INSERT OR IGNORE INTO %s (id, version) VALUES (1, 0)' % DATA_VERSION_TABLE)
+
+
+def get_data_version(db):
+    """ Return the current data version, 0 if the ingester hasn't written since the upgrade """
+    row = db[DATA_VERSION_TABLE].find_one(id=1)
+    if row is None:
+        return 0
+    return row['version']
+
+
+def bump_data_version(db, date=None):
+    """ Mark the data as changed. Called by the ingester after every insert
+
+    date is the latest covid figures date, leave it out when other tables change.
+    migrate() must have created the table first.
+    """
+    # Single statement so the bump is one round trip inside the caller's transaction
+    if date is None:
+        db.query('UPDATE %s SET version = version + 1 WHERE id = 1' % DATA_VERSION_TABLE)
+    else:
+        db.query('UPDATE %s SET version = version + 1, date = :date WHERE id = 1' % DATA_VERSION_TABLE, date=date)
+
+
+class RenderCache:
+    """ Holds the rendered payloads for the current data version
+
+    render_func is called with no arguments and should return a dict of
+    payloads, including a 'date' key for the data date they were built from.
+    version_func returns an opaque value that changes whenever the data does.
+    If version_func returns None the cache can't tell when data changes, so
+    it re-renders on every call, as the bot did before the cache existed.
+    """
+
+    def __init__(self, version_func, render_func):
+        self.version_func = version_func
+        self.render_func = render_func
+        self.version = None
+        self.payloads = None
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        with self.lock:
+            self.payloads = None
+
+    def current(self):
+        """ Return the payloads for the latest data, rendering only if it changed """
+        version = self.version_func()
+        with self.lock:
+            if self.payloads is None or version is None or version != self.version:
+                logger.info("Data version changed to %s, rendering messages", version)
+                self.payloads = self.render_func()
+                self.version = version
+            return self.payloads
+
+    def peek(self):
+        """ Return the last rendered payloads without checking the data version
+
+        For request paths that mustn't touch the database. Something else has
+        to call current() when data changes for these to be refreshed.
+        """
+        with self.lock:
+            payloads = self.payloads
+        if payloads is None:
+            return self.current()
+        return payloads
+
+    def get(self, name):
+        return self.current()[name]
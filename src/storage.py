@@ -0,0 +1,116 @@
+"""
+Data access layer for the covid and supply tables.
+
+Dates have always been stored as "D/MM/YYYY" text, which can't be sorted or
+range queried, so every lookup used to probe backwards one day at a time.
+migrate() adds an ISO "YYYY-MM-DD" day column with a unique index to each
+table. The old date column is kept as is for display, so existing covid.db
+files keep working and only gain the new column.
+"""
+import datetime, logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+DATED_TABLES = ('covid', 'supply')
+
+# How many rows latest_pair() will look through for a matching previous row
+PAIR_WINDOW = 64
+
+
+def parse_date(date_string):
+    """ Turn a "D/MM/YYYY" date string from the database into a date """
+    day, month, year = date_string.split("/")
+    return datetime.date(int(year), int(month), int(day))
+
+
+def format_date(date_object):
+    """ Turn a date into the "D/MM/YYYY" format stored in the date column """
+    return str(date_object.day) + "/" + "{:02d}".format(date_object.month) + "/" + str(date_object.year)
+
+
+def day_key(value):
+    """ ISO day key for a date, datetime or "D/MM/YYYY" string """
+    if isinstance(value, str):
+        value = parse_date(value)
+    elif isinstance(value, datetime.datetime):
+        value = value.date()
+    return value.isoformat()
+
+
+def migrate(db):
+    """ Add and backfill the indexed day column. Safe to run on every startup """
+    for table_name in DATED_TABLES:
+        table = db[table_name]
+        if not table.exists:
+            continue
+        if not table.has_column('day'):
+            logger.info("Migrating %s table to ISO day keys", table_name)
+            table.create_column('day', db.types.text)
+
+        missing = list(db.query('SELECT rowid, date FROM "%s" WHERE day IS NULL' % table_name))
+        if missing:
+            with db as tx:
+                for row in missing:
+                    tx.query('UPDATE "%s" SET day = :day WHERE rowid = :rowid' % table_name,
+                             day=day_key(row['date']), rowid=row['rowid'])
+
+        # Older versions of updateDB.py could insert the same date twice. Keep
+        # the most recent insert so the unique index can be built.
+        duplicates = db.query('DELETE FROM "%s" WHERE rowid NOT IN '
+                              '(SELECT MAX(rowid) FROM "%s" GROUP BY day)' % (table_name, table_name))
+        if duplicates.result_proxy.rowcount:
+            logger.info("Removed %s duplicate rows from %s", duplicates.result_proxy.rowcount, table_name)
+
+        db.query('CREATE UNIQUE INDEX IF NOT EXISTS "ix_%s_day" ON "%s" (day)' % (table_name, table_name))
+
+
+def with_day(row):
+    """ Return a copy of a row dict with its day key filled in from its date """
+    row = OrderedDict(row)
+    row['day'] = day_key(row['date'])
+    return row
+
+
+def row_for_date(table, date):
+    """ The row for a given date, or None """
+    return table.find_one(day=day_key(date))
+
+
+def latest_rows(table, count):
+    """ The most recent count rows, newest first """
+    return list(table.find(order_by='-day', _limit=count))
+
+
+def latest_pair(table, gap_days):
+    """ The newest row that has a row gap_days before it, and that earlier row
+
+    Fetches a bounded window of recent rows in one indexed query instead of
+    scanning backwards a day at a time.
+    """
+    rows = latest_rows(table, PAIR_WINDOW)
+    by_day = dict((row['day'], row) for row in rows)
+    for row in rows:
+        previous_day = datetime.date.fromisoformat(row['day']) - datetime.timedelta(days=gap_days)
+        previous = by_day.get(previous_day.isoformat())
+        if previous is None and previous_day.isoformat() < rows[-1]['day']:
+            # Falls outside the window we fetched, look it up by key
+            previous = row_for_date(table, previous_day)
+        if previous is not None:
+            return row, previous
+    raise LookupError("No pair of rows %s days apart in %s" % (gap_days, table.name))
+
+
+class QueryCounter:
+    """ Counts the statements a dataset connection sends to the database """
+
+    def __init__(self, db):
+        from sqlalchemy import event
+        self.count = 0
+        event.listen(db.engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+    def reset(self):
+        self.count = 0
@@ -0,0 +1,92 @@
+"""
+Subscriber storage and sharded iteration.
+
+The users table keeps its original text 'subscribed' column for older tools,
+and gains an integer 'active' flag and a 'bucket' number with a composite
+index on (active, bucket). Every user hashes to one of BUCKETS buckets, and
+a shard of a delivery owns the buckets where bucket % shard_count equals its
+shard index. Each shard walks its own buckets through the index. It never
+reads inactive users or users that belong to another shard.
+"""
+import logging, zlib
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = 1024
+
+
+def bucket_for(user):
+    return zlib.crc32(str(user).encode()) % BUCKETS
+
+
+def migrate(db):
+    """ Add and backfill the active flag and bucket columns. Safe to run on every startup """
+    users_table = db['users']
+    if not users_table.exists:
+        users_table.create_column('user', db.types.text)
+    if not users_table.has_column('subscribed'):
+        users_table.create_column('subscribed', db.types.text)
+    if not users_table.has_column('active'):
+        logger.info("Adding active flag to the users table")
+        users_table.create_column('active', db.types.boolean)
+    if not users_table.has_column('bucket'):
+        users_table.create_column('bucket', db.types.integer)
+
+    missing = db.executable.exec_driver_sql(
+        'SELECT user, subscribed FROM users WHERE bucket IS NULL OR active IS NULL').fetchall()
+    if missing:
+        logger.info("Backfilling %s users", len(missing))
+        with db as tx:
+            tx.executable.exec_driver_sql('UPDATE users SET active = ?, bucket = ? WHERE user = ?',
+                                          [(subscribed == 'True', bucket_for(user), user)
+                                           for user, subscribed in missing])
+    db.query('CREATE INDEX IF NOT EXISTS ix_users_active_bucket ON users (active, bucket)')
+
+
+def set_subscribed(users_table, user, subscribed):
+    """ Subscribe or unsubscribe a user. Unsubscribing clears their alerts too """
+    user_data = OrderedDict(user=str(user),
+                            subscribed=str(bool(subscribed)),
+                            active=bool(subscribed),
+                            bucket=bucket_for(user))
+    if not subscribed:
+        # Alerts go to anyone who set them, subscribed or not
+        user_data['alerts'] = None
+    users_table.upsert(user_data, ['user'])
+
+
+def deactivate(db, users):
+    """ Unsubscribe every user in users in one statement, for chats that can't be sent to any more """
+    users = [(str(user),) for user in users]
+    if users:
+        db.executable.exec_driver_sql(
+            "UPDATE users SET subscribed = 'False', active = 0, alerts = NULL WHERE user = ?", users)
+    return len(users)
+
+
+def shard_buckets(shard_index=0, shard_count=1):
+    if not 0 <= shard_index < shard_count:
+        raise ValueError("Shard index %s is out of range for %s shards" % (shard_index, shard_count))
+    return range(shard_index, BUCKETS, shard_count)
+
+
+def iter_active(db, shard_index=0, shard_count=1):
+    """ Yield the ids of active subscribers in a shard, a bucket at a time
+
+    Each bucket is a single index range read, so memory stays at roughly
+    active users / BUCKETS however big the table grows.
+    """
+    sql = 'SELECT user FROM users WHERE active = 1 AND bucket = ?'
+    for bucket in shard_buckets(shard_index, shard_count):
+        for row in db.executable.exec_driver_sql(sql, (bucket,)).fetchall():
+            yield row[0]
+
+
+def count_active(db, shard_index=0, shard_count=1):
+    buckets = list(shard_buckets(shard_index, shard_count))
+    if shard_count == 1:
+        return db.executable.exec_driver_sql('SELECT COUNT(*) FROM users WHERE active = 1').scalar()
+    placeholders = ', '.join('?' for _ in buckets)
+    return db.executable.exec_driver_sql(
+        'SELECT COUNT(*) FROM users WHERE active = 1 AND bucket IN (%s)' % placeholders, tuple(buckets)).scalar()
@@ -0,0 +1,252 @@
+"""
+Message templates for the stats commands.
+
+Each command's layout is written once, with [b]...[/b] for bold, and
+compiled at import into a function that joins the literal text with the
+formatted values in a single pass. It is compiled once for each output
+markup, so the same layout renders as Telegram HTML or Markdown.
+
+Layouts are filled from a flat stats dict. build_stats() works out every
+value the layouts use from a day's figures, so the population percentages
+and deltas are calculated in one place. render_all() then renders every
+command's message from that dict.
+"""
+from collections import OrderedDict
+from string import Formatter
+import storage
+
+HTML = 'HTML'
+MARKDOWN = 'Markdown'
+
+MARKUP = {
+    HTML: (('[b]', '<b>'), ('[/b]', '</b>')),
+    MARKDOWN: (('[b]', '*'), ('[/b]', '*')),
+}
+
+# Sent for the covid commands until there are two days of figures to compare
+NO_FIGURES = "There are no figures yet, check back once the first daily update is out."
+
+# Telegram rejects longer messages
+MAX_MESSAGE_LENGTH = 4096
+
+# Population figures used for the vaccinated percentages, unless a tenant sets its own
+POPULATION = 4977400
+POPULATION_12_PLUS = 4183700
+
+VACCINES = ('pfizer', 'astraZeneca', 'moderna', 'jj')
+WEEKDAYS = ("Mon", "Tue", "Wed", "Thur", "Fri", "Sat", "Sun")
+
+
+class Template:
+    """ A layout compiled to a render(stats) function for one markup """
+
+    def __init__(self, layout, markup=HTML):
+        self.markup = markup
+        source = layout
+        for tag, replacement in MARKUP[markup]:
+            source = source.replace(tag, replacement)
+        self.source = source
+
+        pieces = []
+        self.fields = []
+        for literal, field, spec, conversion in Formatter().parse(source):
+            if literal:
+                pieces.append(repr(literal))
+            if field is not None:
+                if conversion:
+                    raise ValueError("Conversions aren't supported in templates: {%s!%s}" % (field, conversion))
+                pieces.append('format(stats[%r], %r)' % (field, spec))
+                self.fields.append(field)
+        code = 'lambda stats: "".join((%s,))' % ', '.join(pieces or ['""'])
+        self.render = eval(compile(code, '<template>', 'eval'), {'format': format})
+
+    def __repr__(self):
+        return "Template(%s, %d fields)" % (self.markup, len(self.fields))
+
+
+def population_lines(suffix):
+    return ("\n\t\t\t🌓 First dose (of a two dose vaccine) - {firstDose_" + suffix + ":.2%}"
+            "\n\t\t\t🌓 Single dose vaccine - {jj_" + suffix + ":.2%}"
+            "\n\t\t\t🌝 Fully vaccinated - {secondDose_" + suffix + ":.2%}")
+
+
+def population_block(gap="\n\n"):
+    return ("[b]🧑 Total population vaccinated[/b]\n" + population_lines('population')
+            + gap + "[b]🧑 12+ population vaccinated[/b]\n" + population_lines('eligible'))
+
+
+ROLLING_LINES = ("\n\t\t\t📈 Rolling 7 Day Doses - {seven_day:,}"
+                 "\n\t\t\t💉 Average Daily Doses - {rolling_avg:,}")
+
+LATEST_HEADER = "[b]📊{day_of_week} {date}[/b]\n"
+
+# The daily update in sections subscribers can pick from, in message order
+LATEST_SECTIONS = OrderedDict([
+    ('doses', "\n📈 Daily Total : {dailyVaccinations:,}"
+              "\n\n\t\t\t1️⃣ First dose (of a two dose vaccine) : +{firstDose_change:,}"
+              "\n\t\t\t🏁 Fully Vaccinated : +{secondDose_change:,}"),
+    ('vaccines', "\n\n\t\t\t🅿️ Pfizer : {pfizer_change:,}"
+                 "\n\t\t\t🅰️ AstraZeneca : {astraZeneca_change:,}"
+                 "\n\t\t\tⓂ️ Moderna : {moderna_change:,}"
+                 "\n\t\t\t🇯 J&J : {jj_change:,}"),
+    ('population', "\n\n" + population_block()),
+    ('rolling', "\n\n[b]📅 Rolling 7 Day Stats[/b]\n" + ROLLING_LINES),
+    ('commands', "\n\n[b]👇 Commands[/b]\n\n\t\t\t/daily - Subscribe for daily updates"
+                 "\n\n\t\t\t/unsubscribe - Unsubscribe from updates"
+                 "\n\n\t\t\t/start - See all commands"
+                 "\n\nIf you have any feedback or suggestions, just send the bot a message and I'll get it."),
+])
+
+LATEST = LATEST_HEADER + "".join(LATEST_SECTIONS.values())
+
+OVERALL = (
+    "📊[b]Overall stats as of {date}[/b]\n\n"
+    "\t\t\t🔢 Overall Total - {totalVaccinations:,}"
+    "\n\n\t\t\t🅿️ Pfizer : {pfizer:,}"
+    "\n\t\t\t🅰️ AstraZeneca : {astraZeneca:,}"
+    "\n\t\t\tⓂ️ Moderna : {moderna:,}"
+    "\n\t\t\t🇯 J&J - {jj:,}"
+    "\n\n" + population_block("\n\n\n") + "\n"
+    "\n📅 [b]Rolling 7 Day Stats[/b]\n" + ROLLING_LINES +
+    "{projection}"
+    "\n\n👇[b] Commands [/b]"
+    "\n\n\t\t\t/daily - Subscribe for daily updates"
+    "\n\n\t\t\t/unsubscribe - Unsubscribe from updates"
+    "\n\n\t\t\t/start - See all commands"
+)
+
+PROJECTION = "\n\t\t\t🎯 12+ fully vaccinated at current rate by {projected_date:%d/%m/%Y}"
+
+WEEK = (
+    "\n📅 [b]Rolling 7 Day Stats[/b]\n" + ROLLING_LINES +
+    "\n\t\t\t🗓 28 Day Average Daily Doses - {four_week_average:,}"
+    "\n\n\t\t\t🅿️ Pfizer : {pfizer_week:,}"
+    "\n\t\t\t🅰️ AstraZeneca : {astraZeneca_week:,}"
+    "\n\t\t\tⓂ️ Moderna : {moderna_week:,}"
+    "\n\t\t\t🇯 J&J : {jj_week:,}"
+)
+
+SUPPLY = (
+    "📊[b]Overall supply as of {date}[/b]\n\n"
+    "\t\t\t🔢 Overall Total - {total:,}"
+    "\n\n\t\t\t🅿️ Pfizer - {pfizer:,}"
+    "\n\t\t\t🅰️ AstraZeneca - {astraZeneca:,}"
+    "\n\t\t\tⓂ️ Moderna - {moderna:,}"
+    "\n\t\t\t🇯 J&J - {jj:,}\n\n"
+    "📊[b]Latest weeks deliveries {previous_date} - {date}[/b]\n\n"
+    "\t\t\t🔢 Overall Total - {total_change:,}"
+    "\n\n\t\t\t🅿️ Pfizer - {pfizer_change:,}"
+    "\n\t\t\t🅰️ AstraZeneca - {astraZeneca_change:,}"
+    "\n\t\t\tⓂ️ Moderna - {moderna_change:,}"
+    "\n\t\t\t🇯 J&J - {jj_change:,}\n\n"
+    "\n\n👇[b] Commands [/b]"
+    "\n\n\t\t\t/latest - See latest stats on doses given"
+    "\n\n\t\t\t/overall - See overall stats on doses given"
+    "\n\n\t\t\t/start - See all commands"
+)
+
+# Layout and the markup each command is sent with
+LAYOUTS = {
+    'latest': (LATEST, HTML),
+    'overall': (OVERALL, MARKDOWN),
+    'projection': (PROJECTION, MARKDOWN),
+    'week': (WEEK, MARKDOWN),
+    'supply': (SUPPLY, MARKDOWN),
+}
+
+TEMPLATES = dict(((name, markup), Template(layout, markup))
+                 for name, (layout, _) in LAYOUTS.items() for markup in MARKUP)
+
+
+def render(name, stats, markup=None):
+    """ Render one layout, in the markup its command uses unless one is given """
+    return TEMPLATES[(name, markup or LAYOUTS[name][1])].render(stats)
+
+
+_section_templates = {}
+
+
+def render_sections(sections, stats, markup=HTML):
+    """ Render the daily update with only the given LATEST_SECTIONS, in their usual order
+
+    Each combination is compiled the first time it's used.
+    """
+    key = (tuple(name for name in LATEST_SECTIONS if name in sections), markup)
+    template = _section_templates.get(key)
+    if template is None:
+        layout = LATEST_HEADER + "".join(LATEST_SECTIONS[name] for name in key[0])
+        template = _section_templates[key] = Template(layout, markup)
+    return template.render(stats)
+
+
+def split_message(text, limit=MAX_MESSAGE_LENGTH):
+    """ Split text into messages short enough to send, between lines where it can """
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit + 1)
+        if cut <= 0:
+            # A single line longer than a message
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    if text:
+        parts.append(text)
+    return parts
+
+
+def day_of_week(date_string):
+    """ Short weekday name for a "D/MM/YYYY" date """
+    return WEEKDAYS[storage.parse_date(date_string).weekday()]
+
+
+def add_changes(stats, today, previous, fields):
+    for field in fields:
+        stats[field + '_change'] = today[field] - previous[field]
+
+
+def build_stats(today, previous_day=None, seven_day=None, rolling_avg=None, four_week_average=None,
+                vaccine_week=None, projected_date=None, population=POPULATION, population_12_plus=POPULATION_12_PLUS):
+    """ Everything the covid layouts need, from a day's figures and the analytics """
+    stats = dict(today)
+    stats['day_of_week'] = day_of_week(today['date'])
+    if previous_day is not None:
+        add_changes(stats, today, previous_day, VACCINES + ('firstDose', 'secondDose'))
+    for field in ('firstDose', 'secondDose', 'jj'):
+        stats[field + '_population'] = today[field] / population
+        stats[field + '_eligible'] = today[field] / population_12_plus
+    stats['seven_day'] = seven_day
+    stats['rolling_avg'] = rolling_avg
+    stats['four_week_average'] = four_week_average
+    for vaccine, total in (vaccine_week or {}).items():
+        stats[vaccine + '_week'] = total
+    stats['projected_date'] = projected_date
+    stats['projection'] = render('projection', stats) if projected_date is not None else ''
+    return stats
+
+
+def build_supply_stats(this_week, previous_week):
+    stats = dict(this_week)
+    stats['previous_date'] = previous_week['date']
+    add_changes(stats, this_week, previous_week, ('total',) + VACCINES)
+    return stats
+
+
+def render_all(stats, supply_stats=None):
+    """ Render every covid command, and /supply if its stats are given, in one pass
+
+    stats is None when there aren't two days of figures yet. The covid
+    commands then say so, and date is None.
+    """
+    if stats is None:
+        payloads = dict((name, NO_FIGURES) for name in ('latest', 'overall', 'week'))
+        payloads['date'] = None
+    else:
+        payloads = {
+            'date': stats['date'],
+            'latest': render('latest', stats),
+            'overall': render('overall', stats),
+            'week': render('week', stats),
+        }
+    if supply_stats is not None:
+        payloads['supply'] = render('supply', supply_stats)
+    return payloads
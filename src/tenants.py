@@ -0,0 +1,155 @@
+"""
+Several bots and datasets served from one process.
+
+A tenant is a Telegram bot with its own token, admin chat, database, source
+URLs and population figures. config.cfg lists them in [Tenant:name]
+sections:
+
+    [Tenant:ireland]
+    telegram_token = 123:abc
+    admin_conversation_id = 12345
+    db = sqlite:///covid.db
+    url = https://services-eu1.arcgis.com/...
+    population = 4977400
+    population_12_plus = 4183700
+
+Settings a tenant leaves out come from [Credentials], [Ingest] and
+[Persistence]. With no tenant sections, those sections make up a single
+tenant, so existing config files keep working.
+
+updateDB.py polls every tenant's sources on one event loop through one
+aiohttp session. vaccineBot.py runs an Updater for each tenant, but they all
+share one connection pool to Telegram, one job scheduler, the chart worker
+processes and the metrics server. Each tenant keeps its own database, tables
+and render caches as attributes on its Tenant.
+
+The handlers use module level names like DB and render_cache. These are
+TenantLocal proxies that look the name up on the tenant active in the current
+thread, and bind() wraps a handler or job so it runs with its tenant active.
+New threads don't inherit the active tenant, so work handed to another thread
+has to be bound too, or be given the real objects. When there's only one
+tenant, it is always active.
+"""
+import contextvars, functools
+from collections import OrderedDict
+from contextlib import contextmanager
+import templates
+from bootstrap import Proxy
+
+SECTION_PREFIX = 'Tenant:'
+# Name of the tenant made from the old single bot settings
+DEFAULT = 'default'
+
+TENANTS = OrderedDict()
+_active = contextvars.ContextVar('tenant', default=None)
+
+
+class Tenant:
+    """ One bot and its dataset. The bot adds its runtime state, like db, as attributes """
+
+    def __init__(self, name, token=None, admin_id=None, db_url="sqlite:///covid.db",
+                 persistence_filename='bot_persistence.db', pickle_filename='conv_persistence',
+                 vaccine_url=None, supply_url=None, age_group_url=None,
+                 population=templates.POPULATION, population_12_plus=templates.POPULATION_12_PLUS):
+        self.name = name
+        self.token = token
+        self.admin_id = admin_id
+        self.db_url = db_url
+        self.persistence_filename = persistence_filename
+        self.pickle_filename = pickle_filename
+        # None means the ingester's default
+        self.vaccine_url = vaccine_url
+        self.supply_url = supply_url
+        self.age_group_url = age_group_url
+        self.population = population
+        self.population_12_plus = population_12_plus
+
+    def __repr__(self):
+        return "Tenant(%s)" % self.name
+
+
+def load_tenants(config):
+    """ Tenants from config.cfg, in the order they're listed """
+    names = [section[len(SECTION_PREFIX):] for section in config.sections() if section.startswith(SECTION_PREFIX)]
+    tenants = []
+    for name in names or [DEFAULT]:
+        section = config[SECTION_PREFIX + name] if names else {}
+
+        def get(key, fallback_section=None, fallback_key=None, fallback=None):
+            if key in section:
+                return section.get(key)
+            if fallback_section is None:
+                return fallback
+            return config.get(fallback_section, fallback_key or key, fallback=fallback)
+
+        # Each tenant gets its own persistence files unless it names them
+        suffix = '' if name == DEFAULT else '.' + name
+        tenants.append(Tenant(
+            name,
+            token=get('telegram_token', 'Credentials'),
+            admin_id=get('admin_conversation_id', 'Credentials'),
+            db_url=get('db', 'Ingest', fallback="sqlite:///covid.db"),
+            persistence_filename=get('persistence_filename', fallback=config.get(
+                'Persistence', 'filename', fallback='bot_persistence.db') + suffix),
+            pickle_filename=get('pickle_filename', fallback='conv_persistence' + suffix),
+            vaccine_url=get('url', 'Ingest') or None,
+            supply_url=get('supply_url', 'Ingest') or None,
+            age_group_url=get('age_group_url', 'Ingest') or None,
+            population=int(get('population', fallback=templates.POPULATION)),
+            population_12_plus=int(get('population_12_plus', fallback=templates.POPULATION_12_PLUS))))
+
+    for attribute in ('token', 'db_url', 'persistence_filename', 'pickle_filename'):
+        values = [getattr(tenant, attribute) for tenant in tenants]
+        if len(set(values)) != len(values):
+            raise ValueError("Every tenant needs its own %s" % attribute)
+    return tenants
+
+
+def register(tenants):
+    """ Make tenants the ones this process serves """
+    TENANTS.clear()
+    for tenant in tenants:
+        TENANTS[tenant.name] = tenant
+
+
+def active():
+    """ The tenant active in this thread, or the only tenant if there's one """
+    tenant = _active.get()
+    if tenant is None:
+        if len(TENANTS) == 1:
+            return next(iter(TENANTS.values()))
+        raise RuntimeError("No tenant is active in this thread")
+    return tenant
+
+
+@contextmanager
+def activate(tenant):
+    token = _active.set(tenant)
+    try:
+        yield tenant
+    finally:
+        _active.reset(token)
+
+
+def bind(callback, tenant=None):
+    """ Wrap callback so it runs with tenant active, by default the one active now """
+    tenant = tenant or active()
+
+    @functools.wraps(callback)
+    def wrapper(*args, **kwargs):
+        with activate(tenant):
+            return callback(*args, **kwargs)
+    return wrapper
+
+
+class TenantLocal(Proxy):
+    """ Proxy for an attribute of the active tenant """
+
+    def __init__(self, attribute):
+        self._attribute = attribute
+
+    def _target(self):
+        return getattr(active(), self._attribute)
+
+    def __repr__(self):
+        return "TenantLocal(%s)" % self._attribute
@@ -10,10 +10,19 @@ Modify the config.cfg file to add configuration information.
 
 updateDB.py should be runninng to periodically query the HSE APIs for figure updates. 
 """
-import logging, dataset, datetime, configparser, sys, time
+import time
+# Taken before the other imports, so they're included in the startup timings
+_import_started = time.perf_counter()
+import logging, datetime, configparser, sys, argparse, threading, io
 from collections import OrderedDict
-from telegram import Update, ForceReply, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, CallbackQueryHandler, PicklePersistence
+from telegram import Bot, Update, ForceReply, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent
+from telegram.utils.request import Request
+from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, CallbackQueryHandler, InlineQueryHandler, PicklePersistence
+from delivery import DeliveryEngine
+from persistence import SQLitePersistence
+from notify import NotificationListener
+from render_cache import RenderCache, get_data_version, migrate as migrate_data_version
+import storage, analytics, subscribers, metrics, templates, charts, answers, preferences, outbox, bootstrap, tenants
 
 # Enable logging
 logging.basicConfig(
@@ -21,33 +30,101 @@ logging.basicConfig(
 )
 logging.getLogger('apscheduler').setLevel(logging.WARNING)
 
+startup = bootstrap.Startup(_import_started)
+startup.record('imports', time.perf_counter() - _import_started)
+
 config = configparser.ConfigParser()
 config.read('config.cfg')
-TELEGRAM_TOKEN = config['Credentials'].get('telegram_token')
-ADMIN_CONVERSATION_ID = config['Credentials'].get('admin_conversation_id')
+DELIVERY_WORKERS = config.getint('Delivery', 'workers', fallback=8)
+DELIVERY_GLOBAL_RATE = config.getfloat('Delivery', 'global_rate', fallback=30)
+DELIVERY_PER_CHAT_RATE = config.getfloat('Delivery', 'per_chat_rate', fallback=1)
+DELIVERY_MAX_RETRIES = config.getint('Delivery', 'max_retries', fallback=3)
+DELIVERY_SHARD_INDEX = config.getint('Delivery', 'shard_index', fallback=0)
+DELIVERY_SHARD_COUNT = config.getint('Delivery', 'shard_count', fallback=1)
+DELIVERY_OUTBOX_BATCH = config.getint('Delivery', 'outbox_batch', fallback=outbox.BATCH_SIZE)
+NOTIFY_SOCKET_DIR = config.get('Notify', 'socket_dir', fallback='notify')
+PERSISTENCE_BACKEND = config.get('Persistence', 'backend', fallback='sqlite')
+PERSISTENCE_FILENAME = config.get('Persistence', 'filename', fallback='bot_persistence.db')
+WEBHOOK_LISTEN = config.get('Webhook', 'listen', fallback='127.0.0.1')
+WEBHOOK_PORT = config.getint('Webhook', 'port', fallback=8443)
+WEBHOOK_URL = config.get('Webhook', 'url', fallback='')
+WEBHOOK_PATH = config.get('Webhook', 'path', fallback='')
+WEBHOOK_WORKERS = config.getint('Webhook', 'workers', fallback=16)
+WEBHOOK_MAX_IN_FLIGHT = config.getint('Webhook', 'max_in_flight', fallback=64)
+WEBHOOK_SECRET = config.get('Webhook', 'secret_token', fallback='') or None
+METRICS_LISTEN = config.get('Metrics', 'listen', fallback='127.0.0.1')
+METRICS_PORT = config.getint('Metrics', 'port', fallback=0)
+METRICS_PROFILE_INTERVAL = config.getfloat('Metrics', 'profile_interval', fallback=0)
+CHART_WORKERS = config.getint('Charts', 'workers', fallback=2)
 
 
 logger = logging.getLogger(__name__)
 logger.info("Starting bot.")
-logger.info ("Admin ID = " + str(ADMIN_CONVERSATION_ID))
-logger.info("Started bot." + str(TELEGRAM_TOKEN))
+# Each tenant is a bot with its own token, admin and database, see src/tenants.py
+tenants.register(tenants.load_tenants(config))
+for tenant in tenants.TENANTS.values():
+    logger.info("Tenant " + tenant.name + ", admin ID = " + str(tenant.admin_id))
 logger.info("Bot ready")
             
 
-DB = dataset.connect("sqlite:///covid.db")
-covid_table = DB['covid']
-users_table = DB['users']
-supply_table = DB['supply']
-last_update_table = DB['last_update']
+def open_database(tenant):
+    """ Connect to a tenant's database and bring its tables up to date. Runs the first time DB is used """
+    with startup.phase('database'):
+        import dataset
+        db = dataset.connect(tenant.db_url)
+        storage.migrate(db)
+        migrate_data_version(db)
+        subscribers.migrate(db)
+        preferences.migrate(db)
+        outbox.migrate(db)
+        metrics.instrument_db(db, **metric_labels(tenant))
+    return db
+
+
+def metric_labels(tenant):
+    """ Labels that keep each tenant's metrics apart. A single bot's metrics have none """
+    return {'tenant': tenant.name} if tenant.name != tenants.DEFAULT else {}
+
+
+# The active tenant's database, tables and caches. setup_tenant() creates them
+DB = tenants.TenantLocal('db')
+covid_table = tenants.TenantLocal('covid_table')
+users_table = tenants.TenantLocal('users_table')
+supply_table = tenants.TenantLocal('supply_table')
+render_cache = tenants.TenantLocal('render_cache')
+answer_cache = tenants.TenantLocal('answer_cache')
+# None unless main() found matplotlib
+chart_cache = tenants.TenantLocal('chart_cache')
+# Set in main() when [Metrics] profile_interval is configured
+profiler = None
+
+
+def admin_id():
+    return tenants.active().admin_id
+
+
+def population():
+    """ The active tenant's population figures, as build_stats() keyword arguments """
+    tenant = tenants.active()
+    return dict(population=tenant.population, population_12_plus=tenant.population_12_plus)
+
+
+def get_delivery_engine(bot):
+    """ Build a delivery engine for fanning messages out to subscribers """
+    return DeliveryEngine(bot,
+                          workers=DELIVERY_WORKERS,
+                          global_rate=DELIVERY_GLOBAL_RATE,
+                          per_chat_rate=DELIVERY_PER_CHAT_RATE,
+                          max_retries=DELIVERY_MAX_RETRIES)
 
 
 # Define a few command handlers. These usually take the two arguments update and
 # context.
 def start(update: Update, _: CallbackContext) -> None:
     """Send a message when the command /start is issued."""
-    latest_day, previous_day = get_latest_stats_from_db()
-    logger.info(latest_day['date'])
-    _.bot_data.update({'date': str(latest_day['date'])})
+    latest_date = render_cache.get('date')
+    logger.info(latest_date)
+    _.bot_data.update({'date': str(latest_date)})
     update.message.reply_markdown \
             (
             "*💉I'm the Irish Vaccine Data bot!💉* \n\n "
@@ -57,6 +134,9 @@ def start(update: Update, _: CallbackContext) -> None:
             "🗓 /week - Get the stats for the last 7 days.\n\n"
             "📈 /overall - Overall rollout statistics.\n\n"
             "📈 /supply - See the latest supply updates from the HSE.\n\n"
+            "📉 /chart - Charts of the rollout so far.\n\n"
+            "⏪ /history - Browse the figures for previous days.\n\n"
+            "⚙️ /sections, /window and /alert - Personalise your daily updates.\n\n"
             "❎ /unsubscribe - Unsubscribe from daily updates.\n\n"
         )
 
@@ -67,94 +147,10 @@ def help_command(update: Update, _: CallbackContext) -> None:
     """Send a message when the command /help is issued."""
     update.message.reply_text('Help!')
 
-def return_daily_figure(date_object):
-    day_str = str(date_object.day) + "/" + "{:02d}".format(date_object.month) + "/" + str(date_object.year)
-    match = covid_table.find(date=day_str)
-    result = match.next()
-    return result['dailyVaccinations']
-
-def return_weekly_figure():
-    """ Get the previous 7 days doses """
-    today = datetime.datetime.now()
-
-    while 1:
-        try:
-            today_str = str(today.day) + "/" + "{:02d}".format(today.month) + "/" + str(today.year)
-            match = covid_table.find(date=today_str)
-            match.next()
-            running_total = 0
-            for i in range(7):
-                running_total += return_daily_figure(today)
-                today = today - datetime.timedelta(days=1)
-                average_dose_per_day = round(running_total/7)
-            return running_total, average_dose_per_day           
-        except:
-            today = today - datetime.timedelta(days=1)
-
-
 def get_latest_supply_from_db():
-
-    #Start scanning back from todays date
-    search_day = datetime.datetime.now()
+    """ Get the latest supply figures and the figures from the week before """
     #Supply stats are 7 days apart, so use days=7
-    previous_day = search_day - datetime.timedelta(days=7)
-    while 1:
-        try:
-            search_day_string = str(search_day.day) + "/" + "{:02d}".format(search_day.month) + "/" + str(search_day.year)
-            logger.debug("Searching for %s", search_day_string)
-            search_day_match = supply_table.find(date=search_day_string)
-            search_day_data = search_day_match.next()
-
-            # If we get here, it means we found a match.
-            previous_day_string = str(previous_day.day) + "/" + "{:02d}".format(previous_day.month) + "/" + str(
-                previous_day.year)
-            previous_day_match = supply_table.find(date=previous_day_string)
-            previous_day_data = previous_day_match.next()
-
-            break
-        except:
-            search_day = search_day - datetime.timedelta(days=1)
-            previous_day = previous_day - datetime.timedelta(days=1)
-    
-    return (search_day_data, previous_day_data)
-
-def get_latest_stats_from_db():
-    #Start scanning back from todays date
-    search_day = datetime.datetime.now()
-    logger.debug("Search day %s", search_day)
-    previous_day = search_day - datetime.timedelta(days=1)
-    while 1:
-        try:
-            search_day_string = str(search_day.day) + "/" + "{:02d}".format(search_day.month) + "/" + str(search_day.year)
-            logger.debug("Searching for %s", search_day_string)
-            search_day_match = covid_table.find(date=search_day_string)
-            search_day_data = search_day_match.next()
-
-            # If we get here, it means we found a match.
-            previous_day_string = str(previous_day.day) + "/" + "{:02d}".format(previous_day.month) + "/" + str(
-                previous_day.year)
-            previous_day_match = covid_table.find(date=previous_day_string)
-            previous_day_data = previous_day_match.next()
-
-            break
-        except:
-            e = sys.exc_info()[0]
-            logger.debug(str(e))
-            search_day = search_day - datetime.timedelta(days=1)
-            previous_day = search_day - datetime.timedelta(days=1)
-            
-    return (search_day_data, previous_day_data)
-
-def get_day_of_week_string(date_string):
-    
-    """ Get the day of the week based on the date string from the database """
-
-    # Split on / string, and feed to a datetime object, to use weekday function
-    date_strings = date_string.split("/")
-    update_date = datetime.datetime(int(date_strings[2]), int(date_strings[1]), int(date_strings[0]))
-    weekDays = ("Mon", "Tue", "Wed", "Thur", "Fri", "Sat", "Sun")
-    day_of_week = str(weekDays[update_date.weekday()])
-    return day_of_week
+    return storage.latest_pair(supply_table, 7)
 
 def today(update: Update, _: CallbackContext) -> None:
     
@@ -162,11 +158,8 @@ def today(update: Update, _: CallbackContext) -> None:
     
     logger.info("Getting latest update for " + str(update.message.chat_id))
     
-    # Get latest day from db
-    today, previous_day = get_latest_stats_from_db()
-    
-    # Get latest update string
-    update_string = get_update_string(today, previous_day)
+    # Get latest update string, only rendered when the data changes
+    update_string = render_cache.get('latest')
    
     # Send update
     update.message.reply_html(update_string)
@@ -175,35 +168,34 @@ def today(update: Update, _: CallbackContext) -> None:
 def unset_response(update: Update, context: CallbackContext) -> None:
     """ Set users update to False """
     context.bot_data.update({str(update.message.chat_id) : 'False'})
-    user_data = OrderedDict(user=str(update.message.chat_id),subscribed='False')   
-    users_table.upsert(user_data, ['user'])
+    subscribers.set_subscribed(users_table, update.message.chat_id, False)
     logger.info("Unsubscribing user " + str(update.message.chat_id))
-    text = "No worries, you've been unsubscribed.\n\n" \
+    text = "No worries, you've been unsubscribed and any alerts you set have been cleared.\n\n" \
             "To subscribe to daily updates again, just press /daily"
     update.message.reply_text(text)
 
     update_string = "User " + str(update.message.chat_id) + " unsubscribed"
     # Alert admin that user unsubscribed. 
-    context.bot.send_message(ADMIN_CONVERSATION_ID, parse_mode='HTML', text=update_string)
+    context.bot.send_message(admin_id(), parse_mode='HTML', text=update_string)
    
 
 def set_respond(update: Update, context: CallbackContext) -> None:
     """ Add this user to the list of subscribers """
     context.bot_data.update({str(update.message.chat_id) : 'True'})
-    user_data = OrderedDict(user=str(update.message.chat_id),subscribed='True')
-    users_table.upsert(user_data, ['user'])
+    subscribers.set_subscribed(users_table, update.message.chat_id, True)
     try:
         
         # Get current jobs and remove them from the queue.
+        # The scheduler is shared, so only this tenant's delivery job
         jq = context.job_queue
-        jlist = jq.jobs()
+        jlist = jq.get_jobs_by_name(delivery_job_name(tenants.active()))
         for job in jlist:
             job.schedule_removal()
         #except:
         #    logging.info("Got no jobs from the list, continue")
 
         # Recreate the job. 
-        context.job_queue.run_repeating(schedule_response, 200, context="Daily")
+        schedule_delivery(context.job_queue, tenants.active())
         logger.info("Created updated job.")
         text = "I'll message you every day, as soon as the vaccine stats update.\n\n" \
                 "To unsubscribe, just press /unsubscribe. \n\n" \
@@ -212,237 +204,613 @@ def set_respond(update: Update, context: CallbackContext) -> None:
 
         # Alert Admin that someone has subscribed
         update_string = "User " + str(update.message.chat_id) + " subscribed"
-        context.bot.send_message(ADMIN_CONVERSATION_ID, parse_mode='HTML', text=update_string)
+        context.bot.send_message(admin_id(), parse_mode='HTML', text=update_string)
 
     except (IndexError, ValueError):
         update.message.reply_text('Usage: /daily')
 
 def users(update: Update, context: CallbackContext) -> None:
     """ Allow admin to query subscribed users """
-    if str(update.message.chat_id) == str(ADMIN_CONVERSATION_ID):
+    if str(update.message.chat_id) == str(admin_id()):
         logger.info("Admin queried users")
         users_list = users_table.all()
-        update_string = ""
+        update_string = "Active subscribers - " + str(subscribers.count_active(DB)) + "\n"
         for user in users_list:
             update_string += "\nUser - " + str(user['user']) + " Sub - " + str(user['subscribed'])
-        context.bot.send_message(ADMIN_CONVERSATION_ID, parse_mode='HTML', text=update_string)
-           
-            
+        for part in templates.split_message(update_string):
+            context.bot.send_message(admin_id(), parse_mode='HTML', text=part)
+
+
+def metrics_command(update: Update, context: CallbackContext) -> None:
+    """ Allow admin to see handler, database and send timings """
+    if str(update.message.chat_id) == str(admin_id()):
+        logger.info("Admin queried metrics")
+        summary = metrics.render_summary(profiler=profiler, tenant=tenants.active().name)
+        # Long once there are many handlers, statements and profiler entries
+        for part in templates.split_message(summary):
+            context.bot.send_message(admin_id(), text=part)
+
+
 def broadcast(update: Update, context: CallbackContext) -> None:
     """ Allow admin to send out broadcasts to all subscribed users """
     
-    if str(update.message.chat_id) == str(ADMIN_CONVERSATION_ID):
+    if str(update.message.chat_id) == str(admin_id()):
         update_string = update.message.text[11:]
         logger.info("Admin did a broadcast of " + str(update_string))
-        users_list = users_table.all()
-        for user in users_list:
-            if user['subscribed'] == "True":
-                try:
-                    context.bot.send_message(user['user'], parse_mode='HTML', text=update_string)
-                    logger.info("Broadcasted message to user " + str(user['user']))
-                except:
-                    e = sys.exc_info()[0]
-                    logger.info(str(e))
-                    logger.info("Got an exception sending message to " + str(user['user']))
+        # Read by the delivery threads, which have no active tenant
+        chat_ids = subscribers.iter_active(DB.get())
+        labels = metric_labels(tenants.active())
+        with metrics.REGISTRY.time('bot_delivery_seconds', kind='broadcast', **labels):
+            report = get_delivery_engine(context.bot).deliver(chat_ids, update_string)
+        metrics.record_delivery(report, 'broadcast', **labels)
+        subscribers.deactivate(DB, report.blocked)
+        logger.info("Broadcast sent to " + str(report.sent) + " users, "
+                    + str(report.failed) + " failed, " + str(report.retried) + " retries")
 
 
 def week(update: Update, _: CallbackContext) -> None:
     """Send a message when the command /week is issued."""
-    running_total, average_dose_per_day = return_weekly_figure()
-    text = \
-        (
-            "\n📅 *Rolling 7 Day Stats*\n" 
-            + "\n\t\t\t📈 Rolling 7 Day Doses - " + str('{:,}'.format(running_total))
-            + "\n\t\t\t💉 Average Daily Doses - " + str('{:,}'.format(average_dose_per_day))  
-        )
-    update.message.reply_markdown(text)
+    update.message.reply_markdown(render_cache.get('week'))
     logger.info("Getting week update for " + str(update.message.chat_id))
 
-def get_update_string(today, previous_day):   
-    """ Get the string for daily updates """
-
-    pfizer = today['pfizer'] - previous_day['pfizer']
-    az = today['astraZeneca'] - previous_day['astraZeneca']
-    moderna = today['moderna'] - previous_day['moderna']
-    johnson = today['jj'] - previous_day['jj']
-    seven_day, rolling_avg = return_weekly_figure()
-    day_of_week = get_day_of_week_string(today['date'])
-
-    text =  \
-        (
-            "<b>📊" + day_of_week + " " + str(today['date']) + "</b>\n"
-            +"\n📈 Daily Total : " + str('{:,}'.format(today['dailyVaccinations']))
-            +"\n\n\t\t\t1️⃣ First dose (of a two dose vaccine) : +" + str('{:,}'.format(today['firstDose']-previous_day['firstDose']))
-            +"\n\t\t\t🏁 Fully Vaccinated : +" + str('{:,}'.format(today['secondDose']-previous_day['secondDose']))
-            +"\n\n\t\t\t🅿️ Pfizer : " + str('{:,}'.format(pfizer))
-            +"\n\t\t\t🅰️ AstraZeneca : " + str('{:,}'.format(az))
-            +"\n\t\t\tⓂ️ Moderna : " + str('{:,}'.format(moderna))
-            +"\n\t\t\t🇯 J&J : " + str('{:,}'.format(johnson))
-            +"\n\n<b>🧑 Total population vaccinated</b>\n"
-            +"\n\t\t\t🌓 First dose (of a two dose vaccine) - " + str('{0:.2%}'.format(today['firstDose']/4977400))
-            +"\n\t\t\t🌓 Single dose vaccine - " + str('{0:.2%}'.format(today['jj']/4977400))
-            +"\n\t\t\t🌝 Fully vaccinated - " + str('{0:.2%}'.format(today['secondDose']/4977400))
-            +"\n\n<b>🧑 12+ population vaccinated</b>\n"
-            +"\n\t\t\t🌓 First dose (of a two dose vaccine) - " + str('{0:.2%}'.format(today['firstDose']/4183700))
-            +"\n\t\t\t🌓 Single dose vaccine - " + str('{0:.2%}'.format(today['jj']/4183700))
-            +"\n\t\t\t🌝 Fully vaccinated - " + str('{0:.2%}'.format(today['secondDose']/4183700))
-            +"\n\n<b>📅 Rolling 7 Day Stats</b>"
-            +"\n\n\t\t\t📈 Rolling 7 Day Doses - " + str('{:,}'.format(seven_day))
-            +"\n\t\t\t💉 Average Daily Doses - " + str('{:,}'.format(rolling_avg))
-            +"\n\n<b>👇 Commands</b>\n\n\t\t\t/daily - Subscribe for daily updates"
-            +"\n\n\t\t\t/unsubscribe - Unsubscribe from updates"
-            +"\n\n\t\t\t/start - See all commands"
-            +"\n\nIf you have any feedback or suggestions, just send the bot a message and I'll get it."
-            )
-    return text
+def get_week_stats(series):
+    """ Rolling 7 and 28 day figures for the /week command """
+    daily = series['dailyVaccinations']
+    running_total = int(series.rolling_sum(daily, 7)[-1])
+    vaccine_totals = dict((vaccine, int(series.rolling_sum(deltas, 7)[-1]))
+                          for vaccine, deltas in series.vaccine_deltas().items())
+    return dict(seven_day=running_total,
+                rolling_avg=round(running_total/7),
+                four_week_average=round(series.rolling_average(daily, 28)[-1]),
+                vaccine_week=vaccine_totals)
 
 
 def overall(update: Update, context: CallbackContext) -> None:
     """ Returns stats on overall rollout """
 
-    today, _ = get_latest_stats_from_db()
-    seven_day, rolling_avg = return_weekly_figure()
-    
     logger.info("Getting overall stats for " + str(update.message.chat_id))
-    
-    text =  \
-    (
-                "📊*Overall stats as of " + today['date'] + "*\n\n"
-                + "\t\t\t🔢 Overall Total - " + str('{:,}'.format(today['totalVaccinations']))
-                + "\n\n\t\t\t🅿️ Pfizer : " + str('{:,}'.format(today['pfizer']))
-                + "\n\t\t\t🅰️ AstraZeneca : " + str('{:,}'.format(today['astraZeneca']))
-                + "\n\t\t\tⓂ️ Moderna : " + str('{:,}'.format(today['moderna']))
-                + "\n\t\t\t🇯 J&J - " + str('{:,}'.format(today['jj'])) + "\n\n"
-                + "*🧑 Total population vaccinated*\n\n"
-                + "\t\t\t🌓 First dose (of a two dose vaccine) - " + str('{0:.2%}'.format(today['firstDose']/4977400)) + "\n"
-                + "\t\t\t🌓 Single dose vaccine - " + str('{0:.2%}'.format(today['jj']/4977400)) + "\n"
-                + "\t\t\t🌝 Fully vaccinated - " + str('{0:.2%}'.format(today['secondDose']/4977400)) + "\n"
-                +"\n\n*🧑 12+ population vaccinated*\n"
-                +"\n\t\t\t🌓 First dose (of a two dose vaccine) - " + str('{0:.2%}'.format(today['firstDose']/4183700))
-                +"\n\t\t\t🌓 Single dose vaccine - " + str('{0:.2%}'.format(today['jj']/4183700))
-                +"\n\t\t\t🌝 Fully vaccinated - " + str('{0:.2%}'.format(today['secondDose']/4183700)) + "\n"
-                + "\n📅 *Rolling 7 Day Stats*\n" 
-                + "\n\t\t\t📈 Rolling 7 Day Doses - " + str('{:,}'.format(seven_day))
-                + "\n\t\t\t💉 Average Daily Doses - " + str('{:,}'.format(rolling_avg))
-                + "\n\n👇* Commands *"
-                + "\n\n\t\t\t/daily - Subscribe for daily updates"
-                + "\n\n\t\t\t/unsubscribe - Unsubscribe from updates"
-                + "\n\n\t\t\t/start - See all commands"
-    )
+    update.message.reply_markdown(render_cache.get('overall'))
 
-    update.message.reply_markdown(text)
+
+def render_messages():
+    """ Render every message that depends on the latest data in one pass """
+    supply_stats = None
+    if supply_table.exists:
+        try:
+            supply_stats = templates.build_supply_stats(*get_latest_supply_from_db())
+        except LookupError:
+            logger.info("Not enough supply figures for /supply yet")
+
+    series = analytics.load_series(covid_table)
+    try:
+        today, previous_day = series.latest_pair(1)
+    except LookupError:
+        # A new tenant, until updateDB.py has stored two days of figures
+        logger.info("Not enough figures for the daily update yet")
+        return templates.render_all(None, supply_stats)
+    week_stats = get_week_stats(series)
+    projected_date = series.projected_date('secondDose', tenants.active().population_12_plus)
+    stats = templates.build_stats(today, previous_day, projected_date=projected_date, **week_stats, **population())
+    payloads = templates.render_all(stats, supply_stats)
+    # For personalised updates and alerts
+    payloads['stats'] = stats
+    payloads['previous_stats'] = templates.build_stats(previous_day, **population())
+    return payloads
+
+
+def build_answers():
+    """ Answer index for inline queries and /history, rebuilt when the data changes """
+    return answers.build_index(analytics.load_series(covid_table), render_cache.current(), **population())
+
+
+def setup_tenant(tenant):
+    """ Give a tenant its database, tables and caches. The database isn't opened until it's used """
+    tenant.db = bootstrap.Lazy(lambda: open_database(tenant))
+    tenant.covid_table = bootstrap.Lazy(lambda: tenant.db['covid'])
+    tenant.users_table = bootstrap.Lazy(lambda: tenant.db['users'])
+    tenant.supply_table = bootstrap.Lazy(lambda: tenant.db['supply'])
+    # Rendering reads the tables above, so it runs with the tenant active whichever thread asks
+    tenant.render_cache = RenderCache(lambda: get_data_version(tenant.db), tenants.bind(render_messages, tenant))
+    tenant.answer_cache = RenderCache(lambda: get_data_version(tenant.db), tenants.bind(build_answers, tenant))
+    tenant.chart_cache = None
+    # Date of the last update we know was delivered, saves a DB read on quiet ticks
+    tenant.last_delivered_date = None
+    # (date, when the next delivery window opens) while segments wait for their window
+    tenant.next_window = None
+    # Polls and notifications can both trigger a delivery, only run one at a time
+    tenant.delivery_lock = threading.Lock()
+    tenant.updater = None
+
+
+for tenant in tenants.TENANTS.values():
+    setup_tenant(tenant)
+
+
+def history_keyboard(index, day):
+    """ Buttons to step to the day before or after """
+    older, newer = index.neighbours(day)
+    buttons = []
+    if older is not None:
+        buttons.append(InlineKeyboardButton("⬅️ " + index.dates[older], callback_data="day:" + older))
+    if newer is not None:
+        buttons.append(InlineKeyboardButton(index.dates[newer] + " ➡️", callback_data="day:" + newer))
+    rows = [buttons]
+    if newer is not None and newer != index.latest_day:
+        rows.append([InlineKeyboardButton("Latest ⏭", callback_data="day:" + index.latest_day)])
+    return InlineKeyboardMarkup(rows)
+
+
+def history(update: Update, context: CallbackContext) -> None:
+    """ Show the latest daily figures with buttons to page back through earlier days """
+    index = answer_cache.peek()
+    day = index.latest_day
+    if day is None:
+        update.message.reply_text("There are no figures yet.")
+        return
+    update.message.reply_html(index.page(day), reply_markup=history_keyboard(index, day))
+    logger.info("History for " + str(update.message.chat_id))
+
+
+def history_button(update: Update, context: CallbackContext) -> None:
+    """ Move a /history message to the day on the pressed button """
+    query = update.callback_query
+    day = query.data.split(":", 1)[1]
+    index = answer_cache.peek()
+    text = index.page(day)
+    if text is None:
+        query.answer("No figures for that day")
+        return
+    query.answer()
+    query.edit_message_text(text, parse_mode='HTML', reply_markup=history_keyboard(index, day))
+
+
+def inline_query(update: Update, context: CallbackContext) -> None:
+    """ Answer @bot latest, @bot week or @bot 14/05/2021 from the answer index """
+    index = answer_cache.peek()
+    results = []
+    for result_id, title, text, markup in index.search(update.inline_query.query):
+        results.append(InlineQueryResultArticle(
+            id=result_id, title=title,
+            input_message_content=InputTextMessageContent(text, parse_mode=markup)))
+    update.inline_query.answer(results[:answers.MAX_RESULTS], cache_time=300)
 
 def supply(update: Update, context: CallbackContext) -> None: 
-    this_week, previous_week = get_latest_supply_from_db()
-
-    text =  \
-    (
-                "📊*Overall supply as of " + this_week['date'] + "*\n\n"
-                + "\t\t\t🔢 Overall Total - " + str('{:,}'.format(this_week['total']))
-                + "\n\n\t\t\t🅿️ Pfizer - " + str('{:,}'.format(this_week['pfizer']))
-                + "\n\t\t\t🅰️ AstraZeneca - " + str('{:,}'.format(this_week['astraZeneca']))
-                + "\n\t\t\tⓂ️ Moderna - " + str('{:,}'.format(this_week['moderna']))
-                + "\n\t\t\t🇯 J&J - " + str('{:,}'.format(this_week['jj'])) + "\n\n"
-                + "📊*Latest weeks deliveries " + previous_week['date'] + " - " + this_week['date'] + "*\n\n"
-                + "\t\t\t🔢 Overall Total - " + str('{:,}'.format(this_week['total']- previous_week['total'] ))
-                + "\n\n\t\t\t🅿️ Pfizer - " + str('{:,}'.format(this_week['pfizer']-previous_week['pfizer']))
-                + "\n\t\t\t🅰️ AstraZeneca - " + str('{:,}'.format(this_week['astraZeneca']-previous_week['astraZeneca']))
-                + "\n\t\t\tⓂ️ Moderna - " + str('{:,}'.format(this_week['moderna']-previous_week['moderna']))
-                + "\n\t\t\t🇯 J&J - " + str('{:,}'.format(this_week['jj']-previous_week['jj'])) + "\n\n"
-                + "\n\n👇* Commands *"
-                + "\n\n\t\t\t/latest - See latest stats on doses given"
-                + "\n\n\t\t\t/overall - See overall stats on doses given"
-                + "\n\n\t\t\t/start - See all commands"
-
-    )
+    text = render_cache.current().get('supply')
+    if text is None:
+        update.message.reply_text("There are no supply figures yet.")
+        return
     update.message.reply_markdown(text)
     
 
+def chart(update: Update, context: CallbackContext) -> None:
+    """ Send a chart, rendered in the chart worker processes the first time it's asked for """
+    kind = context.args[0].lower() if context.args else None
+    if kind not in charts.CHARTS:
+        text = "Try one of these charts\n"
+        for name, description in charts.CHARTS.items():
+            text += "\n\t\t\t/chart " + name + " - " + description
+        update.message.reply_text(text)
+        return
+    if tenants.active().chart_cache is None:
+        update.message.reply_text("Sorry, charts aren't available at the moment.")
+        return
+    if render_cache.get('date') is None:
+        update.message.reply_text(templates.NO_FIGURES)
+        return
+
+    if kind == charts.SUPPLY:
+        latest_supply = storage.latest_rows(supply_table, 1) if supply_table.exists else []
+        if not latest_supply:
+            update.message.reply_text("There are no supply figures yet.")
+            return
+        # The chart plots doses given too, so it changes with either table
+        date = "delivered to %s, given to %s" % (latest_supply[0]['date'], render_cache.get('date'))
+    else:
+        date = render_cache.get('date')
+
+    # Charts already uploaded for this date are resent by file_id
+    file_id = chart_cache.file_id(kind, date)
+    if file_id is not None:
+        update.message.reply_photo(file_id)
+        return
+
+    def load_data():
+        series = analytics.load_series(covid_table)
+        supply_series = charts.load_supply_series(supply_table) if kind == charts.SUPPLY else None
+        return charts.chart_data(kind, series, supply_series, tenants.active().population_12_plus)
+
+    chat_id = update.message.chat_id
+    logger.info("Rendering %s chart for %s", kind, chat_id)
+    future = chart_cache.render(kind, date, load_data)
+    # Reply from the dispatcher's worker threads once the render is done
+    send = tenants.bind(send_chart)
+    future.add_done_callback(
+        lambda done: context.dispatcher.run_async(send, context.bot, chat_id, kind, date, done))
+
+
+def send_chart(bot, chat_id, kind, date, future) -> None:
+    """ Upload a rendered chart and remember its file_id """
+    try:
+        png = future.result()
+    except Exception:
+        logger.exception("Failed to render %s chart", kind)
+        bot.send_message(chat_id, text="Sorry, I couldn't draw that chart.")
+        return
+    message = bot.send_photo(chat_id, photo=io.BytesIO(png))
+    chart_cache.remember_upload(kind, date, message.photo[-1].file_id)
+
+
+def sections(update: Update, context: CallbackContext) -> None:
+    """ Pick which parts of the daily update to get """
+    if context.args:
+        try:
+            chosen = preferences.parse_sections(context.args)
+        except ValueError as e:
+            update.message.reply_text(str(e))
+            return
+        preferences.set_preference(users_table, update.message.chat_id, sections=chosen)
+    else:
+        chosen = preferences.get_preferences(users_table, update.message.chat_id)['sections']
+    available = ", ".join(templates.LATEST_SECTIONS)
+    text = "Your daily update has " + (chosen.replace(",", ", ") if chosen else "every section") + ".\n\n" \
+           "To change it, list the sections you want from " + available + ", like /sections doses rolling. " \
+           "/sections all goes back to everything."
+    update.message.reply_text(text)
+
+
+def window(update: Update, context: CallbackContext) -> None:
+    """ Only deliver the daily update between certain hours """
+    if context.args:
+        try:
+            if context.args[0].lower() == 'any':
+                chosen = None
+            else:
+                chosen = preferences.parse_window(*context.args[:2])
+        except (TypeError, ValueError):
+            update.message.reply_text("Usage: /window 8 20 for between 8am and 8pm, or /window any")
+            return
+        preferences.set_preference(users_table, update.message.chat_id, delivery_window=chosen)
+        # The new window may open before the one delivery is waiting for
+        tenants.active().next_window = None
+    else:
+        chosen = preferences.get_preferences(users_table, update.message.chat_id)['delivery_window']
+    if chosen:
+        start_hour, end_hour = chosen.split("-")
+        text = "You'll get the daily update between " + start_hour + ":00 and " + end_hour + ":00."
+    else:
+        text = "You'll get the daily update as soon as it's out."
+    update.message.reply_text(text + "\n\nTo change it, use /window 8 20 or /window any.")
+
+
+def alert(update: Update, context: CallbackContext) -> None:
+    """ Get a message when a vaccination milestone is passed """
+    current = preferences.get_preferences(users_table, update.message.chat_id)['alerts']
+    if context.args:
+        if context.args[0].lower() == 'off':
+            current = None
+        else:
+            usage = "Usage: /alert fully 70, /alert first 90 or /alert off."
+            if len(context.args) < 2:
+                update.message.reply_text(usage)
+                return
+            try:
+                new_alert = preferences.parse_alert(context.args[0].lower(), context.args[1])
+            except ValueError as e:
+                update.message.reply_text(usage + " " + str(e))
+                return
+            current = preferences.add_alert(current, new_alert)
+        preferences.set_preference(users_table, update.message.chat_id, alerts=current)
+    if current:
+        lines = ["🎯 " + preferences.ALERT_METRICS[name][1] + " passes " + '{:g}'.format(percent) + "%"
+                 for name, percent in preferences.parse_alerts(current)]
+        text = "You'll get a message when\n\n" + "\n".join(lines)
+    else:
+        text = "You don't have any alerts."
+    update.message.reply_text(text + "\n\nAdd one with /alert fully 70 or /alert first 90, clear them with /alert off.")
+
+
 def test_update(update: Update, context: CallbackContext) -> None:
-    today, previous_day = get_latest_stats_from_db()
-    update_string = get_update_string(today, previous_day)
-    context.bot.send_message(ADMIN_CONVERSATION_ID, parse_mode='HTML', text=update_string)
+    update_string = render_cache.get('latest')
+    context.bot.send_message(admin_id(), parse_mode='HTML', text=update_string)
     
 
 def log_text(update: Update, context: CallbackContext) -> None:
     """Echo the user message."""
     logger.info("Didn't match - " + str(update.message.text))
-    context.bot.send_message(ADMIN_CONVERSATION_ID, parse_mode='HTML', text="Got a non matched message from " + str(update.message.chat_id))
-    context.bot.send_message(ADMIN_CONVERSATION_ID, parse_mode='HTML', text=str(update.message.text))
+    context.bot.send_message(admin_id(), parse_mode='HTML', text="Got a non matched message from " + str(update.message.chat_id))
+    context.bot.send_message(admin_id(), parse_mode='HTML', text=str(update.message.text))
+
+
+def delivery_job_name(tenant):
+    return 'delivery:' + tenant.name
+
+
+def schedule_delivery(job_queue, tenant, interval=200):
+    """ Check for a new update to deliver every interval seconds, or once now if interval is None """
+    callback = tenants.bind(schedule_response, tenant)
+    if interval is None:
+        return job_queue.run_once(callback, 0, context="Notify", name=delivery_job_name(tenant))
+    return job_queue.run_repeating(callback, interval, context="Daily", name=delivery_job_name(tenant))
 
 
 def schedule_response(context: CallbackContext) -> None:
     """ Send an update to the subscribed users """
-    
-    today, previous_day = get_latest_stats_from_db()
-    update_string = get_update_string(today, previous_day)
-    
-    # From DB get the date of our last update
-    last_update = last_update_table.find_one(id=1)
-    logger.debug("Last update - %s.", last_update)
-    # Get the list of users
-    users_list = users_table.all()
-
-    if last_update['date'] == today['date']:
-        #If the dates are the same, skip updating
-        logger.debug("Last update and todays date were the same - %s.", today)
+    with tenants.active().delivery_lock:
+        deliver_update(context)
+
+
+def deliver_update(context: CallbackContext) -> None:
+    """ Send the latest update to every segment that hasn't had it yet. Call with delivery_lock held """
+    tenant = tenants.active()
+    # The delivery workers have no active tenant, so they're given the database itself
+    db = tenant.db.get()
+
+    # Only re-renders when updateDB.py has written new data, so most ticks
+    # are a single lookup on the data_version table.
+    payloads = render_cache.current()
+    # Keep inline answers and /history up to date with the new data
+    answer_cache.current()
+    date = payloads['date']
+    if date is None or date == tenant.last_delivered_date:
+        return None
+    now = datetime.datetime.now()
+    if tenant.next_window is not None and tenant.next_window[0] == date and now < tenant.next_window[1]:
+        # Everything due is sent, the rest waits for a window to open
         return None
 
-    #If we get this far, dates were different, so let's send an update
-    logger.info("Dates were different, time for an update!")
-
-    #Update the last updated date in the db
-    last_update_data = OrderedDict(id=1,date=today['date'])
-    last_update_table.upsert(last_update_data, ['id'])
-    
-    #Send updates to users
-    user_counter = 0
-    for user in users_list:
-        if user['subscribed'] == 'True':
-            try:
-                context.bot.send_message(user['user'], parse_mode='HTML', text=update_string)
-                user_counter += 1
-            except:
-                e = sys.exc_info()[0]
-                logger.info(str(e))
-                logger.info("Got exception when sending update to " + user['user'])
-    logger.info("Sent update to " + str(user_counter) + " users")
-    
+    day = storage.day_key(date)
+    hour = now.hour
+    renderer = preferences.SegmentRenderer(payloads['stats'], payloads['previous_stats'], payloads['latest'])
+
+    # Queue each segment whose window is open. The segment is marked in the
+    # same transaction, so it's queued once however often this runs.
+    waiting = []
+    for segment in preferences.active_windows(db) + [preferences.ALERTS]:
+        if preferences.delivered_date(db, DELIVERY_SHARD_INDEX, segment) == date:
+            continue
+        if not preferences.window_open(segment, hour):
+            waiting.append(segment)
+            continue
+        with db as tx:
+            if segment == preferences.ALERTS:
+                rows = ((user, alerts) for user, alerts
+                        in preferences.iter_alerts(tx, DELIVERY_SHARD_INDEX, DELIVERY_SHARD_COUNT)
+                        if renderer.alert_message(alerts) is not None)
+                queued = outbox.enqueue_alerts(tx, day, rows, DELIVERY_SHARD_INDEX)
+            else:
+                queued = outbox.enqueue_segment(tx, day, segment, DELIVERY_SHARD_INDEX, DELIVERY_SHARD_COUNT)
+            preferences.mark_delivered(tx, DELIVERY_SHARD_INDEX, segment, date)
+        logger.info("Queued %s messages for %s to the %s segment", queued, date, segment or "any time")
+
+    # Sends everything pending for today, including anything a restart interrupted
+    engine = None
+    for kind, render in ((outbox.UPDATE, renderer.message), (outbox.ALERT, renderer.alert_message)):
+        if not outbox.pending_count(db, day, DELIVERY_SHARD_INDEX, kind):
+            continue
+        engine = engine or get_delivery_engine(context.bot)
+        with metrics.REGISTRY.time('bot_delivery_seconds', kind='daily', **metric_labels(tenant)):
+            report, unsubscribed = outbox.deliver(db, engine, day, kind, render,
+                                                  DELIVERY_SHARD_INDEX, DELIVERY_OUTBOX_BATCH)
+        metrics.record_delivery(report, 'daily', **metric_labels(tenant))
+        logger.info("Sent " + kind + " to " + str(report.sent) + " users, "
+                    + str(report.failed) + " failed, " + str(report.retried) + " retries, "
+                    + str(unsubscribed) + " unsubscribed, " + str(renderer.rendered) + " messages rendered")
+
+    if outbox.pending_count(db, day, DELIVERY_SHARD_INDEX):
+        return None
+    if waiting:
+        tenant.next_window = (date, preferences.next_opening(waiting, now))
+        logger.debug("Waiting until %s to send %s to the next segment", tenant.next_window[1], date)
+    else:
+        logger.debug("Every segment has the update for %s", date)
+        tenant.last_delivered_date = date
+        outbox.expire(db, day)
 
 
-def main() -> None:
-    """Start the bot."""
-    # Create the Updater and pass it your bot's token.
-    #updater = Updater("1653123514:AAGFi2oLMPIky2BcsuCTQGbQS5vhCY6nFsQ")
-    persistence = PicklePersistence(filename='conv_persistence')
-    updater = Updater(TELEGRAM_TOKEN, persistence=persistence, use_context=True)
+def add_handlers(dispatcher, tenant) -> None:
+    """ Register every command and callback handler, each runs with tenant active """
+    def instrument(name, callback):
+        # Every handler is timed for /metrics
+        return metrics.instrument_handler(name, tenants.bind(callback, tenant), **metric_labels(tenant))
 
-    # Get the dispatcher to register handlers
-    dispatcher = updater.dispatcher
+    def add_command(command, callback):
+        dispatcher.add_handler(CommandHandler(command, instrument(command, callback)))
 
     # on different commands - answer in Telegram
-    dispatcher.add_handler(CommandHandler("start", start))
-    dispatcher.add_handler(CommandHandler("help", help_command))
-    dispatcher.add_handler(CommandHandler("latest", today))
-    dispatcher.add_handler(CommandHandler("week", week))
-    dispatcher.add_handler(CommandHandler("daily", set_respond))
-    dispatcher.add_handler(CommandHandler("unsubscribe", unset_response))
-    dispatcher.add_handler(CommandHandler("overall", overall)),
-    dispatcher.add_handler(CommandHandler("broadcast", broadcast))
-    dispatcher.add_handler(CommandHandler("users", users))
-    dispatcher.add_handler(CommandHandler("test_update", test_update))
-    dispatcher.add_handler(CommandHandler("supply", supply))
-    
+    add_command("start", start)
+    add_command("help", help_command)
+    add_command("latest", today)
+    add_command("week", week)
+    add_command("daily", set_respond)
+    add_command("unsubscribe", unset_response)
+    add_command("overall", overall)
+    add_command("broadcast", broadcast)
+    add_command("users", users)
+    add_command("metrics", metrics_command)
+    add_command("test_update", test_update)
+    add_command("supply", supply)
+    add_command("chart", chart)
+    add_command("history", history)
+    add_command("sections", sections)
+    add_command("window", window)
+    add_command("alert", alert)
+    dispatcher.add_handler(CallbackQueryHandler(instrument("history_button", history_button), pattern="^day:"))
+    dispatcher.add_handler(InlineQueryHandler(instrument("inline", inline_query)))
+
+    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, instrument("text", log_text)))
+
+
+def warm_up() -> None:
+    """ Render every tenant's cached messages and inline answer index, then count as ready """
+    for tenant in tenants.TENANTS.values():
+        with tenants.activate(tenant):
+            # Opened first so its migrations are timed as their own phase
+            DB.get()
+            with startup.phase('warm_up'):
+                try:
+                    render_cache.current()
+                    answer_cache.current()
+                except Exception:
+                    # The caches render again when they're next used, don't hold up the other tenants
+                    logger.exception("Failed to warm up tenant %s", tenant.name)
+    startup.mark_ready()
+
+
+def health_checks(serving=True):
+    """ Checks for /healthz. serving is False when this process doesn't handle updates """
+    checks = OrderedDict([('ready', startup.ready.is_set)])
+    several = len(tenants.TENANTS) > 1
+    for tenant in tenants.TENANTS.values():
+        # Named after the tenant when there's more than one
+        prefix = tenant.name + '_' if several else ''
+        checks[prefix + 'database'] = lambda tenant=tenant: get_data_version(tenant.db) is not None
+        if tenant.updater is not None:
+            checks[prefix + 'jobs'] = lambda tenant=tenant: tenant.updater.job_queue.scheduler.running
+            if serving:
+                checks[prefix + 'updates'] = lambda tenant=tenant: tenant.updater.dispatcher.running
+    return checks
+
+
+def create_updater(tenant, request, deliver_only=False) -> Updater:
+    """ An Updater for tenant's bot, sending through the shared connection pool """
+    with startup.phase('persistence'):
+        if deliver_only:
+            # Delivery workers don't handle updates, so they don't need persistence
+            persistence = None
+        elif PERSISTENCE_BACKEND == 'pickle':
+            persistence = PicklePersistence(filename=tenant.pickle_filename,
+                                            store_user_data=False, store_chat_data=False)
+        else:
+            # Only bot_data is used. Picks up an existing pickle file the first time it runs
+            persistence = SQLitePersistence(filename=tenant.persistence_filename,
+                                            store_user_data=False, store_chat_data=False,
+                                            import_pickle=tenant.pickle_filename)
+    with startup.phase('updater'):
+        # Loads user and chat data from persistence
+        updater = Updater(bot=Bot(tenant.token, request=request), persistence=persistence, use_context=True)
+    metrics.instrument_bot(updater.bot, **metric_labels(tenant))
+    tenant.updater = updater
+    return updater
 
 
-    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, log_text))
-    # Start the Bot
-    updater.start_polling()
+def main() -> None:
+    """Start the bot."""
+    global DELIVERY_SHARD_INDEX, DELIVERY_SHARD_COUNT, profiler
+    parser = argparse.ArgumentParser(description="Irish Vaccine Bot")
+    parser.add_argument('--deliver-only', action='store_true',
+                        help="only send daily updates for this shard, don't answer commands")
+    parser.add_argument('--shard-index', type=int, default=DELIVERY_SHARD_INDEX)
+    parser.add_argument('--shard-count', type=int, default=DELIVERY_SHARD_COUNT)
+    parser.add_argument('--webhook', action='store_true',
+                        help="receive updates through the webhook server instead of polling")
+    parser.add_argument('--check', action='store_true',
+                        help="start up without connecting to Telegram, print how long each phase took "
+                             "and exit with the health check result")
+    args = parser.parse_args()
+    DELIVERY_SHARD_INDEX, DELIVERY_SHARD_COUNT = args.shard_index, args.shard_count
+    subscribers.shard_buckets(DELIVERY_SHARD_INDEX, DELIVERY_SHARD_COUNT)
+    logger.info("Delivering shard %s of %s", DELIVERY_SHARD_INDEX, DELIVERY_SHARD_COUNT)
+
+    several = len(tenants.TENANTS) > 1
+    if args.webhook and several:
+        parser.error("--webhook serves a single tenant, config.cfg lists %s" % len(tenants.TENANTS))
+
+    if charts.AVAILABLE and not args.deliver_only and not args.check:
+        # Fork the chart workers before any other threads are running.
+        # Every tenant renders on the same pool of processes.
+        with startup.phase('charts'):
+            shared_charts = charts.ChartCache(CHART_WORKERS)
+            shared_charts.start()
+        for number, tenant in enumerate(tenants.TENANTS.values()):
+            tenant.chart_cache = shared_charts if number == 0 else shared_charts.sharing()
+    elif not charts.AVAILABLE:
+        logger.info("matplotlib isn't installed, /chart is disabled")
+
+    # One connection pool to Telegram for every tenant's bot, with enough
+    # connections for each tenant's delivery workers to send in parallel
+    con_pool_size = len(tenants.TENANTS) * (DELIVERY_WORKERS + 4)
+    if args.webhook:
+        # and the webhook workers enough to reply in parallel too
+        con_pool_size += WEBHOOK_WORKERS
+    request = Request(con_pool_size=con_pool_size)
+    updaters = [create_updater(tenant, request, args.deliver_only) for tenant in tenants.TENANTS.values()]
+    updater = updaters[0]
+    # and one scheduler thread runs every tenant's jobs. Jobs still run with
+    # their own tenant's bot, only the first tenant's persistence is flushed
+    # after each job, the others are flushed as they handle updates.
+    for other in updaters[1:]:
+        other.job_queue.scheduler = updater.job_queue.scheduler
+
+    if args.check:
+        for tenant in tenants.TENANTS.values():
+            add_handlers(tenant.updater.dispatcher, tenant)
+            tenant.updater = None
+        warm_up()
+        healthy, results = bootstrap.check_health(health_checks())
+        print(startup.summary())
+        for name, result in results.items():
+            print("%-12s %s" % (name, result))
+        sys.exit(0 if healthy else 1)
+
+    if METRICS_PORT:
+        checks = health_checks(serving=not args.deliver_only)
+        metrics.start_http_server(METRICS_PORT, METRICS_LISTEN,
+                                  health=lambda: bootstrap.check_health(checks))
+    if METRICS_PROFILE_INTERVAL:
+        profiler = metrics.SamplingProfiler(METRICS_PROFILE_INTERVAL)
+        profiler.start()
+
+    # Check for new data to deliver every 200 seconds. This is the fallback,
+    # updateDB.py normally notifies us as soon as it stores new figures.
+    for tenant in tenants.TENANTS.values():
+        schedule_delivery(tenant.updater.job_queue, tenant)
+
+    def notified(message):
+        # Only the tenant whose data changed, or all of them if the message doesn't say
+        name = message.get('tenant')
+        for tenant in tenants.TENANTS.values():
+            if name is None or name == tenant.name:
+                schedule_delivery(tenant.updater.job_queue, tenant, interval=None)
+
+    listener = NotificationListener(NOTIFY_SOCKET_DIR, notified)
+    listener.start()
+    # Caches are warmed while updates start coming in. Anything that needs
+    # them first waits on the cache's lock rather than rendering twice.
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+
+    if args.deliver_only:
+        updater.job_queue.start()
+        updater.idle()
+        listener.stop()
+        request.stop()
+        return
+
+    for tenant in tenants.TENANTS.values():
+        add_handlers(tenant.updater.dispatcher, tenant)
+
+    if args.webhook:
+        # aiohttp is only imported when it's used
+        from webhook import run_webhook
+        # Serves until SIGINT/SIGTERM, then drains in flight updates
+        run_webhook(updater, webhook_url=WEBHOOK_URL, listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT,
+                    url_path=WEBHOOK_PATH or updater.bot.token, workers=WEBHOOK_WORKERS,
+                    max_in_flight=WEBHOOK_MAX_IN_FLIGHT, secret_token=WEBHOOK_SECRET)
+        listener.stop()
+        return
+
+    # Start the Bots
+    for other in updaters:
+        other.start_polling()
 
     # Run the bot until you press Ctrl-C or the process receives SIGINT,
     # SIGTERM or SIGABRT. This should be used most of the time, since
     # start_polling() is non-blocking and will stop the bot gracefully.
     updater.idle()
+    # idle() only stops the first tenant's updater
+    for other in updaters[1:]:
+        other.stop()
+    listener.stop()
+    request.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,177 @@
+"""
+Webhook serving mode.
+
+Telegram POSTs each update to an aiohttp server running on its own asyncio
+loop. The request is answered as soon as the update has been handed to a
+pool of dispatcher worker threads, which call dispatcher.process_update(),
+so updates from different chats are processed concurrently. Updates from
+the same chat are chained and run one at a time in the order they arrived,
+as they would be with polling, so a chat's handlers and its chat_data never
+race. Handlers registered on the dispatcher work exactly as they do with
+polling.
+
+In flight updates are capped at max_in_flight. Once the cap is hit, new
+requests wait for a free slot, which holds back Telegram's delivery instead
+of queueing without limit. On shutdown the server stops accepting requests,
+waits for in flight updates to finish (up to drain_timeout seconds) and then
+flushes persistence.
+
+The server only needs a python-telegram-bot Dispatcher, so a local fake
+Telegram can drive it by POSTing update JSON to http://listen:port/url_path.
+"""
+import asyncio, json, logging, signal, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookServer:
+    """ Receive updates over HTTP and process them on a worker pool """
+
+    def __init__(self, dispatcher, listen='127.0.0.1', port=8443, url_path='', workers=8,
+                 max_in_flight=None, drain_timeout=30, secret_token=None):
+        self.dispatcher = dispatcher
+        self.listen = listen
+        self.port = port
+        self.url_path = '/' + url_path.lstrip('/')
+        self.workers = workers
+        self.max_in_flight = max_in_flight or workers * 4
+        self.drain_timeout = drain_timeout
+        self.secret_token = secret_token
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='webhook-worker')
+        self.in_flight = set()
+        # Chat ID to the task for that chat's most recent update
+        self.chats = {}
+        self.processed = 0
+        self.failed = 0
+        self.counter_lock = threading.Lock()
+        self.slots = None
+        self.runner = None
+        self.stopping = None
+
+    def process(self, update):
+        try:
+            self.dispatcher.process_update(update)
+        except Exception:
+            logger.exception("Failed to process update %s", update.update_id)
+            with self.counter_lock:
+                self.failed += 1
+        else:
+            with self.counter_lock:
+                self.processed += 1
+
+    @staticmethod
+    def chat_key(update):
+        """ Updates with the same key are processed in order. None for updates without a chat or user """
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            # Inline queries have no chat
+            return update.effective_user.id
+        return None
+
+    async def process_after(self, previous, update):
+        if previous is not None:
+            # process() logs its own failures, so only the ordering matters here
+            await asyncio.wait([previous])
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.process, update)
+
+    async def handle(self, request):
+        if self.stopping.is_set():
+            # Telegram will retry once we're back
+            return web.Response(status=503)
+        if self.secret_token and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != self.secret_token:
+            return web.Response(status=403)
+        try:
+            data = await request.json(loads=json.loads)
+            update = Update.de_json(data, self.dispatcher.bot)
+        except (ValueError, KeyError, TypeError):
+            return web.Response(status=400)
+
+        await self.slots.acquire()
+        key = self.chat_key(update)
+        future = asyncio.ensure_future(self.process_after(self.chats.get(key), update))
+        self.in_flight.add(future)
+        if key is not None:
+            self.chats[key] = future
+
+        def done(finished):
+            self.in_flight.discard(finished)
+            if self.chats.get(key) is finished:
+                del self.chats[key]
+            self.slots.release()
+        future.add_done_callback(done)
+        return web.Response()
+
+    async def health(self, request):
+        return web.json_response({'processed': self.processed,
+                                  'failed': self.failed,
+                                  'in_flight': len(self.in_flight)})
+
+    async def start(self):
+        self.slots = asyncio.Semaphore(self.max_in_flight)
+        self.stopping = asyncio.Event()
+        app = web.Application()
+        app.router.add_post(self.url_path, self.handle)
+        app.router.add_get('/healthz', self.health)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.listen, self.port)
+        await site.start()
+        logger.info("Webhook listening on %s:%s%s with %s workers", self.listen, self.port, self.url_path, self.workers)
+
+    async def drain(self):
+        """ Stop taking updates and wait for the ones in flight to finish """
+        self.stopping.set()
+        if self.in_flight:
+            logger.info("Draining %s in flight updates", len(self.in_flight))
+            done, pending = await asyncio.wait(list(self.in_flight), timeout=self.drain_timeout)
+            if pending:
+                logger.warning("Gave up waiting for %s updates", len(pending))
+        await self.runner.cleanup()
+        self.executor.shutdown(wait=False)
+
+    async def serve(self, stop_signals=(signal.SIGINT, signal.SIGTERM)):
+        """ Run until one of stop_signals is received, then drain """
+        await self.start()
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in stop_signals:
+            loop.add_signal_handler(sig, stop.set)
+        await stop.wait()
+        await self.drain()
+
+
+def run_webhook(updater, webhook_url=None, **kwargs):
+    """ Serve updater's dispatcher over a webhook until SIGINT/SIGTERM
+
+    Replaces updater.start_polling() + updater.idle(). The job queue and the
+    dispatcher's own thread (needed for run_async handlers) are started here
+    and stopped after draining, then persistence is flushed.
+    """
+    dispatcher = updater.dispatcher
+    server = WebhookServer(dispatcher, **kwargs)
+    if webhook_url:
+        # Telegram allows at most 100 concurrent connections per webhook
+        api_kwargs = {'secret_token': server.secret_token} if server.secret_token else None
+        updater.bot.set_webhook(url=webhook_url.rstrip('/') + server.url_path,
+                                max_connections=min(server.max_in_flight, 100),
+                                api_kwargs=api_kwargs)
+
+    updater.job_queue.start()
+    dispatcher_thread = threading.Thread(target=dispatcher.start, name='dispatcher', daemon=True)
+    dispatcher_thread.start()
+    started = time.time()
+    try:
+        asyncio.run(server.serve())
+    finally:
+        updater.job_queue.stop()
+        dispatcher.stop()
+        dispatcher_thread.join()
+        if dispatcher.persistence:
+            dispatcher.update_persistence()
+            dispatcher.persistence.flush()
+        logger.info("Webhook stopped after %.0fs, processed %s updates, %s failed",
+                    time.time() - started, server.processed, server.failed)
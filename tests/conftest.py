@@ -0,0 +1,24 @@
+import os, sys
+
+import dataset
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The bot's modules import each other from src/, the scripts live in the root
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+sys.path.insert(1, ROOT)
+
+import outbox, preferences, render_cache, storage, subscribers
+
+
+@pytest.fixture
+def db(tmp_path):
+    """ A migrated database, as open_database() in vaccineBot.py leaves it """
+    db = dataset.connect('sqlite:///' + str(tmp_path / 'covid.db'))
+    storage.migrate(db)
+    render_cache.migrate(db)
+    subscribers.migrate(db)
+    preferences.migrate(db)
+    outbox.migrate(db)
+    yield db
+    db.close()
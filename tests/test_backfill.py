@@ -0,0 +1,38 @@
+import logging, shutil, sys
+
+import dataset
+
+import backfill, storage
+from conftest import ROOT
+
+
+def replay(monkeypatch, db_url):
+    monkeypatch.setattr(sys, 'argv', ['backfill.py', '--replay', '--db', db_url])
+    backfill.main()
+
+
+def test_replay_an_empty_database(tmp_path, monkeypatch, caplog):
+    caplog.set_level(logging.INFO)
+    replay(monkeypatch, 'sqlite:///' + str(tmp_path / 'covid.db'))
+    assert "nothing to replay" in caplog.text
+
+
+def test_replay_a_database_from_before_jj_was_tracked(tmp_path, monkeypatch):
+    path = str(tmp_path / 'covid.db')
+    shutil.copy(ROOT + '/src/sample_database.db', path)
+    db = dataset.connect('sqlite:///' + path)
+    before = dict((storage.day_key(row['date']), row) for row in db['covid'].all())
+    db.close()
+
+    replay(monkeypatch, 'sqlite:///' + path)
+
+    db = dataset.connect('sqlite:///' + path)
+    after = list(db['covid'].find(order_by='day'))
+    assert len(after) == len(before)
+    for row in after[1:]:
+        stored = before[row['day']]
+        # The stored doses didn't have J&J taken out yet
+        assert row['firstDose'] + row['jj'] == stored['firstDose']
+        assert row['secondDose'] - row['jj'] == stored['secondDose']
+        assert row['totalVaccinations'] == stored['totalVaccinations']
+    db.close()
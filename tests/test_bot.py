@@ -0,0 +1,82 @@
+import collections
+
+import pytest
+
+import metrics, tenants
+import vaccineBot
+
+ROW = collections.OrderedDict(date='16/07/2021', firstDose=3000000, secondDose=2500000, totalVaccinations=5500000,
+                              pfizer=4000000, moderna=500000, astraZeneca=900000, dailyVaccinations=50000, jj=100000,
+                              day='2021-07-16')
+
+
+class FakeMessage:
+    def __init__(self):
+        self.chat_id = 1
+        self.replies = []
+
+    def reply_text(self, text, *args, **kwargs):
+        self.replies.append(text)
+
+    reply_markdown = reply_html = reply_text
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, chat_id, text, *args, **kwargs):
+        self.sent.append(text)
+
+
+class FakeContext:
+    def __init__(self):
+        self.bot = FakeBot()
+
+
+class FakeUpdate:
+    def __init__(self):
+        self.message = FakeMessage()
+
+
+@pytest.fixture
+def tenant(tmp_path):
+    """ A newly added tenant, its database has no figures yet """
+    tenant = tenants.Tenant('new', admin_id=1, db_url='sqlite:///' + str(tmp_path / 'covid.db'))
+    vaccineBot.setup_tenant(tenant)
+    registered = list(tenants.TENANTS.values())
+    # Only this tenant, so nothing touches a covid.db in the working directory
+    tenants.register([tenant])
+    with tenants.activate(tenant):
+        yield tenant
+    tenants.register(registered)
+    tenant.db.close()
+
+
+@pytest.mark.parametrize('rows', [0, 1])
+def test_tenant_without_two_days_of_figures(tenant, rows):
+    if rows:
+        tenant.db['covid'].insert(ROW)
+    vaccineBot.warm_up()
+    assert vaccineBot.startup.ready.is_set()
+    assert tenant.render_cache.get('date') is None
+
+    for command in (vaccineBot.today, vaccineBot.week, vaccineBot.overall, vaccineBot.history):
+        update = FakeUpdate()
+        command(update, None)
+        assert update.message.replies[-1].startswith("There are no figures yet")
+    # Nothing to deliver
+    assert vaccineBot.deliver_update(None) is None
+
+
+def test_long_metrics_summary_is_split(tenant):
+    for i in range(200):
+        metrics.REGISTRY.observe('bot_handler_seconds', 0.01, command='command_%s' % i, tenant=tenant.name)
+    context = FakeContext()
+    try:
+        vaccineBot.metrics_command(FakeUpdate(), context)
+    finally:
+        metrics.REGISTRY.reset()
+    assert len(context.bot.sent) > 1
+    assert all(len(text) <= 4096 for text in context.bot.sent)
+    assert sum(text.count("command_") for text in context.bot.sent) == 200
@@ -0,0 +1,90 @@
+import threading
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, Unauthorized
+
+import delivery
+from delivery import BLOCKED, FAILED, SENT, DeliveryEngine, DeliveryReport
+
+
+class FakeClock:
+    """ Time that only moves when something sleeps """
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+        self.lock = threading.Lock()
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        with self.lock:
+            self.sleeps.append(seconds)
+            # Like a real sleep, some time always passes, however short the wait
+            self.now += max(seconds, 1e-6)
+
+
+class FakeBot:
+    """ Raises the queued errors for a chat, in order, then sends """
+
+    def __init__(self, errors=None):
+        self.errors = dict((chat_id, list(queued)) for chat_id, queued in (errors or {}).items())
+        self.sent = []
+
+    def send_message(self, chat_id, text=None, parse_mode=None):
+        queued = self.errors.get(chat_id)
+        if queued:
+            raise queued.pop(0)
+        self.sent.append((chat_id, text))
+
+
+def make_engine(bot, clock, **kwargs):
+    return DeliveryEngine(bot, workers=1, clock=clock.clock, sleep=clock.sleep, **kwargs)
+
+
+def test_retry_after_pauses_every_send():
+    clock = FakeClock()
+    bot = FakeBot({1: [RetryAfter(5)]})
+    report = make_engine(bot, clock).deliver([1, 2], "hi")
+    assert bot.sent == [(1, "hi"), (2, "hi")]
+    assert (report.sent, report.retried, report.failed) == (2, 1, 0)
+    # Nothing else went out until the flood pause was over
+    assert clock.now >= 5
+
+
+def test_network_errors_back_off_exponentially():
+    clock = FakeClock()
+    bot = FakeBot({1: [NetworkError("reset"), NetworkError("reset")]})
+    report = DeliveryReport()
+    assert make_engine(bot, clock, backoff=1.0).send_one(1, "hi", report) == SENT
+    assert [seconds for seconds in clock.sleeps if seconds >= 1] == [1.0, 2.0]
+    assert (report.sent, report.retried) == (1, 2)
+
+
+def test_network_errors_give_up_after_max_retries():
+    clock = FakeClock()
+    bot = FakeBot({1: [NetworkError("reset")] * 3})
+    report = DeliveryReport()
+    assert make_engine(bot, clock, max_retries=2).send_one(1, "hi", report) == FAILED
+    assert bot.sent == []
+    assert (report.failed, report.retried, report.blocked) == (1, 2, [])
+
+
+def test_blocked_chats():
+    clock = FakeClock()
+    bot = FakeBot({1: [Unauthorized("Forbidden: bot was blocked by the user")],
+                   2: [BadRequest("Chat not found")],
+                   3: [BadRequest("Message is too long")]})
+    results = {}
+    report = make_engine(bot, clock).deliver_each(
+        [(chat_id, "hi") for chat_id in (1, 2, 3, 4)],
+        on_result=lambda chat_id, result: results.__setitem__(chat_id, result))
+    assert results == {1: BLOCKED, 2: BLOCKED, 3: FAILED, 4: SENT}
+    assert sorted(report.blocked) == [1, 2]
+    assert (report.sent, report.failed, report.retried) == (1, 3, 0)
+
+
+def test_is_blocked():
+    assert delivery.is_blocked(Unauthorized("Forbidden: user is deactivated"))
+    assert delivery.is_blocked(BadRequest("Chat not found"))
+    assert not delivery.is_blocked(BadRequest("Message is too long"))
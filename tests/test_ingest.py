@@ -0,0 +1,160 @@
+import asyncio, datetime, socket
+from collections import OrderedDict
+
+import aiohttp, dataset
+from aiohttp import web
+
+import pipeline
+from ingest import (ERROR, INSERTED, NOT_MODIFIED, UNCHANGED, UPDATED, IngestService, PollSchedule,
+                    VACCINES, builtin_sources, combine_results, parse_vaccine_figures, schedule_result,
+                    store_vaccine_figures)
+
+PUBLISHING = datetime.datetime(2021, 7, 16, 15)
+
+# The administration API's single feature for 16/07/2021
+FEATURE = {'attributes': {'relDate': 1626393600000, 'firstDose': 110, 'secondDose': 60, 'totalAdministered': 170,
+                          'pf': 110, 'modern': 25, 'az': 35}}
+
+
+def database_with_previous_day(tmp_path):
+    """ A covid.db holding the figures for the day before FEATURE, returns its URL """
+    db_url = 'sqlite:///' + str(tmp_path / 'covid.db')
+    db = dataset.connect(db_url)
+    db['covid'].insert(OrderedDict(date='15/07/2021', firstDose=100, secondDose=50, totalVaccinations=150,
+                                   pfizer=100, moderna=20, astraZeneca=30, dailyVaccinations=10, jj=0,
+                                   day='2021-07-15'))
+    db.close()
+    return db_url
+
+
+class StubArcGIS:
+    """ Serves FEATURE like the ArcGIS query endpoint, with an ETag, on a free local port """
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.requests = []
+        self.runner = None
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.port = sock.getsockname()[1]
+        self.url = 'http://127.0.0.1:%s/query' % self.port
+
+    async def query(self, request):
+        self.requests.append(request.headers.get('If-None-Match'))
+        await asyncio.sleep(self.delay)
+        if request.headers.get('If-None-Match') == '"v1"':
+            return web.Response(status=304)
+        return web.json_response({'features': [FEATURE]}, headers={'ETag': '"v1"'})
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_get('/query', self.query)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '127.0.0.1', self.port).start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.runner.cleanup()
+
+
+def vaccine_service(db_url, url, timeout=30):
+    source = pipeline.Source(VACCINES, url, parse_vaccine_figures, store_vaccine_figures)
+    return IngestService(db_url=db_url, sources=[source], timeout=timeout)
+
+
+def test_other_sources_dont_back_off_the_schedule():
+    results = {'vaccines': NOT_MODIFIED, 'supply': INSERTED, 'age_groups': UPDATED}
+    assert combine_results(results.values()) == INSERTED
+    assert schedule_result(results) == UNCHANGED
+    assert PollSchedule().next_interval(schedule_result(results), PUBLISHING) == 60
+
+
+def test_new_vaccine_figures_back_off_the_schedule():
+    results = {'vaccines': INSERTED, 'supply': NOT_MODIFIED}
+    assert schedule_result(results) == INSERTED
+    assert PollSchedule().next_interval(schedule_result(results), PUBLISHING) == 3600
+
+
+def test_schedule_result_without_a_vaccine_source():
+    assert schedule_result({'supply': INSERTED}) == INSERTED
+    assert schedule_result({'vaccines': ERROR, 'supply': ERROR}) == ERROR
+
+
+def test_each_tenant_gets_its_own_sources():
+    registered = dict(pipeline.SOURCES)
+    ie = builtin_sources(vaccine_url='http://ie.example.com')
+    ni = builtin_sources(vaccine_url='http://ni.example.com')
+    assert [source.url for source in ie if source.name == VACCINES] == ['http://ie.example.com']
+    assert [source.url for source in ni if source.name == VACCINES] == ['http://ni.example.com']
+    assert not set(map(id, ie)) & set(map(id, ni))
+    assert pipeline.SOURCES == registered
+
+
+def test_round_trips_reset_on_cycles_that_store_nothing(tmp_path):
+    async def not_modified(session, source):
+        return None
+
+    source = pipeline.Source('vaccines', 'http://example.com', None, None, fetch=not_modified)
+    service = IngestService(db_url='sqlite:///' + str(tmp_path / 'covid.db'), sources=[source])
+    service.last_round_trips = 5
+    assert asyncio.run(service.run_cycle(None)) == {'vaccines': NOT_MODIFIED}
+    assert service.last_round_trips == 0
+    service.db_executor.shutdown()
+
+
+def test_first_insert_bumps_the_data_version_without_a_schema_change(tmp_path, recwarn):
+    from render_cache import get_data_version
+
+    db_url = database_with_previous_day(tmp_path)
+    today = FEATURE['attributes']
+    source = pipeline.Source('vaccines', 'http://example.com', None, store_vaccine_figures)
+    service = IngestService(db_url=db_url, sources=[source])
+    assert service.store([(source, today)]) == {'vaccines': INSERTED}
+    # Read both days, insert and bump the version
+    assert service.last_round_trips == 3
+    assert get_data_version(service.db) == 1
+    assert not [warning for warning in recwarn if 'schema' in str(warning.message)]
+    service.db.close()
+    service.db_executor.shutdown()
+
+
+def test_run_cycle_stores_new_figures_then_sends_the_etag(tmp_path):
+    service = vaccine_service(database_with_previous_day(tmp_path), None)
+
+    async def poll_twice():
+        async with StubArcGIS() as stub:
+            service.sources[0].url = stub.url
+            async with aiohttp.ClientSession(timeout=service.timeout) as session:
+                first = await service.run_cycle(session)
+                second = await service.run_cycle(session)
+        return stub, first, second
+
+    stub, first, second = asyncio.run(poll_twice())
+    assert first == {VACCINES: INSERTED}
+    assert service.schedule.next_interval(schedule_result(first), PUBLISHING) == 3600
+    assert stub.requests == [None, '"v1"']
+    assert second == {VACCINES: NOT_MODIFIED}
+    assert service.last_round_trips == 0
+    assert service.schedule.next_interval(schedule_result(second), PUBLISHING) == 60
+    assert service.db['covid'].find_one(day='2021-07-16')['dailyVaccinations'] == 20
+    service.db.close()
+    service.db_executor.shutdown()
+
+
+def test_run_cycle_times_out_as_an_error_and_backs_off(tmp_path):
+    service = vaccine_service(database_with_previous_day(tmp_path), None, timeout=0.1)
+
+    async def poll_slow_server():
+        async with StubArcGIS(delay=1) as stub:
+            service.sources[0].url = stub.url
+            async with aiohttp.ClientSession(timeout=service.timeout) as session:
+                return [await service.run_cycle(session) for _ in range(2)]
+
+    results = asyncio.run(poll_slow_server())
+    assert results == [{VACCINES: ERROR}, {VACCINES: ERROR}]
+    assert service.db is None
+    assert [service.schedule.next_interval(schedule_result(result), PUBLISHING) for result in results] == [300, 600]
+    # The first poll that gets through resets the back off
+    assert service.schedule.next_interval(NOT_MODIFIED, PUBLISHING) == 60
+    service.db_executor.shutdown()
@@ -0,0 +1,21 @@
+import metrics
+
+
+def test_summary_for_one_tenant_leaves_out_the_others():
+    registry = metrics.Registry()
+    registry.observe('bot_handler_seconds', 0.01, command='latest', tenant='ie')
+    registry.observe('bot_handler_seconds', 0.02, command='week', tenant='ni')
+    registry.inc('bot_delivery_messages_total', 5, kind='daily', result='sent', tenant='ie')
+    registry.inc('bot_delivery_messages_total', 7, kind='daily', result='sent', tenant='ni')
+    registry.inc('bot_send_total', 3, result='ok')
+
+    summary = metrics.render_summary(registry, tenant='ie')
+    assert "latest - 1 calls" in summary
+    assert "week" not in summary
+    assert "bot_delivery_messages_total kind=daily,result=sent - 5" in summary
+    assert "- 7" not in summary
+    # Metrics without a tenant label are shared
+    assert "bot_send_total result=ok - 3" in summary
+
+    assert 'tenant="ni"' in metrics.render_prometheus(registry)
+    assert "week,ni - 1 calls" in metrics.render_summary(registry)
@@ -0,0 +1,84 @@
+import collections, threading
+
+import pytest
+from telegram.error import Unauthorized
+
+import outbox, preferences, subscribers
+from delivery import DeliveryEngine
+
+DAY = '2021-07-16'
+USERS = range(1000, 1250)
+
+# StoppingBot ends its worker thread with SystemExit
+stops_worker = pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning')
+
+
+class StoppingBot:
+    """ Sends until stop_after messages have gone out, then stops the worker like a shutdown would """
+
+    def __init__(self, stop_after=None, blocked=()):
+        self.stop_after = stop_after
+        self.blocked = set(blocked)
+        self.sent = collections.Counter()
+        self.lock = threading.Lock()
+
+    def send_message(self, chat_id, text=None, parse_mode=None):
+        if chat_id in self.blocked:
+            raise Unauthorized("Forbidden: bot was blocked by the user")
+        with self.lock:
+            if self.stop_after is not None and sum(self.sent.values()) >= self.stop_after:
+                raise SystemExit
+            self.sent[chat_id] += 1
+
+
+def queue_update(db):
+    for user in USERS:
+        subscribers.set_subscribed(db['users'], user, True)
+    return outbox.enqueue_segment(db, DAY, preferences.ANY_TIME)
+
+
+def deliver(db, bot, batch_size=50):
+    engine = DeliveryEngine(bot, workers=1, global_rate=1e6, per_chat_rate=1e6)
+    return outbox.deliver(db, engine, DAY, outbox.UPDATE, lambda sections: "update", batch_size=batch_size)
+
+
+@stops_worker
+def test_resume_after_stopping_part_way(db):
+    assert queue_update(db) == 250
+    blocked = ['1010', '1200']
+    first = StoppingBot(stop_after=120, blocked=blocked)
+    report, first_unsubscribed = deliver(db, first)
+    # Blocked chats reached before the stop are unsubscribed, the rest are still pending
+    assert (report.sent, first_unsubscribed) == (120, len(report.blocked))
+    assert outbox.pending_count(db, DAY) == 250 - 120 - first_unsubscribed
+
+    second = StoppingBot(blocked=blocked)
+    report, unsubscribed = deliver(db, second)
+    assert report.sent == 250 - 120 - len(blocked)
+    assert first_unsubscribed + unsubscribed == len(blocked)
+    assert not set(first.sent) & set(second.sent)
+    assert set(first.sent) | set(second.sent) | set(blocked) == set(str(user) for user in USERS)
+    assert outbox.pending_count(db, DAY) == 0
+    assert subscribers.count_active(db) == 248
+
+    third = StoppingBot()
+    deliver(db, third)
+    assert not third.sent
+
+
+@stops_worker
+def test_resume_after_a_crash_resends_at_most_a_batch(db, monkeypatch):
+    queue_update(db)
+    first = StoppingBot(stop_after=120)
+    # The process dies before the results it's holding are written
+    monkeypatch.setattr(outbox.Progress, 'flush', lambda self: None)
+    deliver(db, first, batch_size=50)
+    monkeypatch.undo()
+    assert outbox.pending_count(db, DAY) == 250 - 100
+
+    second = StoppingBot()
+    deliver(db, second, batch_size=50)
+    resent = set(first.sent) & set(second.sent)
+    assert len(resent) == 20
+    assert set(first.sent) | set(second.sent) == set(str(user) for user in USERS)
+    assert outbox.pending_count(db, DAY) == 0
@@ -0,0 +1,29 @@
+import asyncio
+
+import pipeline
+
+
+async def fetch_features(session, source):
+    return {'features': [{'attributes': {'total': 1}}]}
+
+
+def parse_total(data):
+    return [data['features'][0]['attributes']['total']]
+
+
+def parse_changed_payload(data):
+    # Raises AttributeError, like a parser hitting a payload of a new shape
+    return data['features'].items()
+
+
+def test_parser_errors_only_fail_their_own_source():
+    good = pipeline.Source('good', 'http://example.com/good', parse_total, None, fetch=fetch_features)
+    broken = pipeline.Source('broken', 'http://example.com/broken', parse_changed_payload, None,
+                             fetch=fetch_features)
+    broken.body_hash = 'seen'
+
+    results = dict(asyncio.run(pipeline.fetch_all(None, [broken, good])))
+    assert isinstance(results[broken], AttributeError)
+    assert results[good] == [1]
+    # Forgotten so the next poll parses the body again
+    assert broken.body_hash is None
@@ -0,0 +1,62 @@
+import datetime
+
+import pytest
+
+import preferences, subscribers
+
+
+def add_user(db, user, alerts='fully:70'):
+    subscribers.set_subscribed(db['users'], user, True)
+    preferences.set_preference(db['users'], user, alerts=alerts)
+
+
+def test_iter_alerts_skips_unsubscribed_users(db):
+    add_user(db, 1)
+    add_user(db, 2)
+    subscribers.set_subscribed(db['users'], 2, False)
+    assert list(preferences.iter_alerts(db)) == [('1', 'fully:70')]
+
+
+def test_iter_alerts_skips_deactivated_users(db):
+    add_user(db, 1)
+    add_user(db, 2)
+    add_user(db, 3)
+    subscribers.deactivate(db, [2, 3])
+    assert list(preferences.iter_alerts(db)) == [('1', 'fully:70')]
+
+
+def test_alerts_without_a_subscription(db):
+    preferences.set_preference(db['users'], 1, alerts='first:90')
+    assert list(preferences.iter_alerts(db)) == [('1', 'first:90')]
+
+
+def test_migrate_clears_alerts_of_earlier_unsubscribes(db):
+    add_user(db, 1)
+    db.query("UPDATE users SET subscribed = 'False', active = 0")
+    preferences.migrate(db)
+    assert list(preferences.iter_alerts(db)) == []
+
+
+def test_next_opening():
+    now = datetime.datetime(2021, 7, 16, 15, 30)
+    assert preferences.next_opening(['18-22', '20-23'], now) == datetime.datetime(2021, 7, 16, 18)
+    # Windows that opened earlier today open again tomorrow
+    assert preferences.next_opening(['8-12'], now) == datetime.datetime(2021, 7, 17, 8)
+    assert preferences.next_opening(['22-6', '7-9'], now) == datetime.datetime(2021, 7, 16, 22)
+
+
+def test_parse_alert_messages():
+    assert preferences.parse_alert('fully', '70') == 'fully:70'
+    assert preferences.parse_alert('first', '92.5%') == 'first:92.5'
+    for name, percent, message in (('fully', 'lots', "Give a percentage between 0 and 100"),
+                                   ('fully', '120', "Give a percentage between 0 and 100"),
+                                   ('booster', '50', "Alerts can be first or fully")):
+        with pytest.raises(ValueError) as error:
+            preferences.parse_alert(name, percent)
+        assert str(error.value) == message
+
+
+def test_add_alert_skips_repeats():
+    alerts = preferences.add_alert(None, 'fully:70')
+    alerts = preferences.add_alert(alerts, 'first:90')
+    assert preferences.add_alert(alerts, 'fully:70') == 'fully:70,first:90'
@@ -0,0 +1,64 @@
+import asyncio, socket, threading, time
+from queue import Queue
+
+import aiohttp
+from telegram import Bot, User
+from telegram.ext import Dispatcher, MessageHandler, Filters
+
+from webhook import WebhookServer
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def make_update(update_id, chat_id, text):
+    chat = {'id': chat_id, 'type': 'private', 'first_name': 'Test'}
+    return {'update_id': update_id,
+            'message': {'message_id': update_id, 'date': int(time.time()), 'chat': chat,
+                        'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Test'}, 'text': text}}
+
+
+def test_updates_from_one_chat_are_processed_in_order():
+    bot = Bot('123456:fake-token')
+    bot._bot = User(123456, 'Test', True, username='test_bot')
+    dispatcher = Dispatcher(bot, Queue(), use_context=True)
+    seen = dict((chat_id, []) for chat_id in (1, 2))
+    running = set()
+    overlapped = []
+    lock = threading.Lock()
+
+    def record(update, context):
+        chat_id = update.effective_chat.id
+        with lock:
+            if chat_id in running:
+                overlapped.append(chat_id)
+            running.add(chat_id)
+        # The first message is the slowest, so later ones would overtake it on another worker
+        time.sleep(0.05 if update.message.text == '0' else 0.001)
+        with lock:
+            running.discard(chat_id)
+            seen[chat_id].append(update.message.text)
+
+    dispatcher.add_handler(MessageHandler(Filters.text, record))
+    port = free_port()
+    server = WebhookServer(dispatcher, port=port, url_path='hook', workers=4)
+
+    async def post_all():
+        await server.start()
+        async with aiohttp.ClientSession() as session:
+            for i in range(10):
+                for chat_id in seen:
+                    update = make_update(i * 10 + chat_id, chat_id, str(i))
+                    async with session.post('http://127.0.0.1:%s/hook' % port, json=update) as response:
+                        assert response.status == 200
+        await server.drain()
+
+    asyncio.run(post_all())
+    assert server.processed == 20
+    assert not overlapped
+    for texts in seen.values():
+        assert texts == [str(i) for i in range(10)]
+    assert not server.chats